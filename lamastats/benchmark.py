@@ -0,0 +1,352 @@
+#Benchmark suite: generates reproducible synthetic logs and measures the throughput and peak memory of the log parsers and report generators, and the startup time of the command line tool. Every benchmark runs in a fresh process so its peak RSS is its own. Results can be stored as a baseline, later runs fail when they regress past it.
+
+import sys
+import os
+import json
+import time
+import gzip
+import random
+import argparse
+import resource
+import subprocess
+from datetime import datetime, timedelta
+
+NAMES = ['frog','ucto','timbl','colibri-core','foliapy','clam','mbt','LaMachine','flat','piccl','alpino','gecco','wikiente','labirinto','folia-tools','pynlpl','python-ucto','python-frog','clamservices','oersetter']
+CLAMSERVICES = ['frog','ucto','colibri','timbl','piccl','alpino']
+USERAGENTS = [
+    'Mozilla/5.0 (X11; Linux x86_64; rv:60.0) Gecko/20100101 Firefox/60.0',
+    'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/67.0.3396.99 Safari/537.36',
+    'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_13_5) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/11.1.1 Safari/605.1.15',
+    'Mozilla/5.0 (Linux; Android 8.0.0; SM-G930F) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/67.0.3396.87 Mobile Safari/537.36',
+    'Mozilla/5.0 (iPhone; CPU iPhone OS 11_4 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/11.0 Mobile/15E148 Safari/604.1',
+    'Mozilla/5.0 (X11; FreeBSD amd64; rv:60.0) Gecko/20100101 Firefox/60.0',
+    'curl/7.58.0',
+    'python-requests/2.19.1',
+]
+CAMO = 'github-camo (876de43e)'
+BOTS = [
+    'Mozilla/5.0 (compatible; Googlebot/2.1; +http://www.google.com/bot.html)',
+    'Mozilla/5.0 (compatible; bingbot/2.0; +http://www.bing.com/bingbot.htm)',
+    'Mozilla/5.0 (compatible; SemrushCrawler/1.0)',
+]
+REFERERS = ['-', 'https://proycon.github.io/folia/', 'https://languagemachines.github.io/frog/', 'https://github.com/proycon/lamastats', 'http://example.org/page.html']
+NOISE = ['/', '/index.html', '/favicon.ico', '/robots.txt', '/css/style.css', '/js/main.js', '/images/logo.png', '/frog/', '/ucto/info/', '/wp-login.php']
+INTERNALBLOCK = '131.174.'
+MONTHS = ['Jan','Feb','Mar','Apr','May','Jun','Jul','Aug','Sep','Oct','Nov','Dec']
+
+BENCHMARKS = ('parselog', 'parselog-nginx', 'parseclamlog', 'parseflatlog', 'outputreport', 'outputlamachinereport', 'outputclamreport', 'outputflatreport', 'startup-help', 'startup-flat')
+#the report benchmarks render the state left behind by a parse benchmark
+REPORTSTATE = {
+    'outputreport': 'parselog',
+    'outputlamachinereport': 'parselog',
+    'outputclamreport': 'parseclamlog',
+    'outputflatreport': 'parseflatlog',
+}
+SAMPLESIZE = 20000 #number of generated lines checked against the reference parser
+REPORTTIME = 1.0 #keep rendering a report for at least this many seconds and take the best time
+STARTUPREPEATS = 10 #number of times a startup benchmark runs lamastats, the best time is taken
+STARTUPLINES = 100 #number of lines of the FLAT log processed by the startup-flat benchmark, few enough for the startup to dominate
+
+
+def generatelines(kind, n, seed=1, days=365):
+    """Yields n synthetic log lines of the given kind (apache, nginx or flat), spread evenly over the past number of days. The same seed yields the same lines, up to the current date."""
+    rng = random.Random(seed)
+    start = datetime.combine(datetime.now().date() - timedelta(days), datetime.min.time())
+    span = days * 86400
+    if kind == 'flat':
+        for i in range(n):
+            t = start + timedelta(seconds=i * span // n)
+            r = rng.random()
+            if r < 0.4:
+                msg = "Loading " + rng.choice(NAMES) + "/doc" + str(rng.randint(1,5000)) + ".folia.xml"
+            elif r < 0.6:
+                msg = "Saving " + rng.choice(NAMES) + "/doc" + str(rng.randint(1,5000)) + ".folia.xml"
+            elif r < 0.8:
+                msg = "[QUERY ON doc" + str(rng.randint(1,5000)) + "] " + rng.choice(('EDIT','ADD','DELETE','SELECT')) + " w WHERE text = \"x\""
+            else:
+                msg = "Unloading doc" + str(rng.randint(1,5000))
+            yield t.strftime('%Y-%m-%d %H:%M:%S') + " - " + msg + "\n"
+        return
+    #a pool of visitors, a few of them internal and most of them returning
+    ips = [ "%d.%d.%d.%d" % (rng.randint(1,223), rng.randint(0,255), rng.randint(0,255), rng.randint(1,254)) for _ in range(5000) ]
+    ips += [ INTERNALBLOCK + "%d.%d" % (rng.randint(0,255), rng.randint(1,254)) for _ in range(250) ]
+    timestamp = None
+    second = None
+    for i in range(n):
+        t = start + timedelta(seconds=i * span // n)
+        if t != second:
+            second = t
+            timestamp = "%02d/%s/%d:%02d:%02d:%02d +0200" % (t.day, MONTHS[t.month-1], t.year, t.hour, t.minute, t.second)
+        ip = rng.choice(ips)
+        r = rng.random()
+        useragent = rng.choice(BOTS) if rng.random() < 0.05 else rng.choice(USERAGENTS)
+        referer = rng.choice(REFERERS)
+        method = 'GET'
+        status = 200
+        if r < 0.35:
+            url = "/lamabadge.php/" + rng.choice(NAMES)
+            if rng.random() < 0.3:
+                useragent = CAMO
+                referer = '-'
+        elif r < 0.4:
+            url = "/lamachinetracker.php/" + "/".join((rng.choice(('local','docker','vagrant','remote')), rng.choice(('new','update')), rng.choice(('stable','development')), rng.choice(('2.7','3.5','3.6','3.7')), rng.choice(('linux','mac')), rng.choice(('debian','ubuntu','centos','fedora','arch')), rng.choice(('9','10','16.04','18.04','7'))))
+        elif r < 0.5:
+            url = "/" + rng.choice(CLAMSERVICES) + "/actions/" + rng.choice(('tokenize','parse','convert')) + "/"
+            method = rng.choice(('GET','POST'))
+            status = rng.choice((200,200,200,404))
+        elif r < 0.55:
+            url = "/" + rng.choice(CLAMSERVICES) + "/project" + str(i)
+            method = 'PUT'
+            status = 201
+        else:
+            url = rng.choice(NOISE)
+            status = rng.choice((200,200,200,304,404))
+        if kind == 'nginx':
+            yield '%s - - [%s] "%s %s HTTP/1.1" %d %d "%s" "%s" "%s"\n' % (ip, timestamp, method, url, status, rng.randint(100,50000), referer, useragent, ip)
+        else:
+            yield '%s - - [%s] "%s %s HTTP/1.1" %d %d "%s" "%s"\n' % (ip, timestamp, method, url, status, rng.randint(100,50000), referer, useragent)
+
+
+def writelog(filename, kind, n, seed=1, days=365, blocksize=10000):
+    """Writes a synthetic log, gzip compressed if the filename ends in .gz"""
+    with (gzip.open(filename,'wt',encoding='utf-8',compresslevel=1) if filename.endswith('.gz') else open(filename,'w',encoding='utf-8')) as f:
+        block = []
+        for line in generatelines(kind, n, seed, days):
+            block.append(line)
+            if len(block) >= blocksize:
+                f.write("".join(block))
+                block = []
+        f.write("".join(block))
+
+
+def preparelogs(workdir, n, seed=1, days=365):
+    """Generates the benchmark logs in the work directory, unless they were already generated with the same parameters today"""
+    manifestfile = os.path.join(workdir, 'manifest.json')
+    manifest = { 'lines': n, 'seed': seed, 'days': days, 'date': datetime.now().strftime('%Y-%m-%d') }
+    if os.path.exists(manifestfile):
+        with open(manifestfile,'r',encoding='utf-8') as f:
+            if json.load(f) == manifest:
+                return
+    for kind in ('apache','nginx','flat'):
+        print("[benchmark] Generating " + str(n) + " " + kind + " log lines",file=sys.stderr)
+        writelog(os.path.join(workdir, kind + '.log'), kind, n, seed, days)
+    with open(manifestfile,'w',encoding='utf-8') as f:
+        json.dump(manifest, f)
+
+
+def checkparsers(workdir, samplesize=SAMPLESIZE):
+    """Correctness gate: the specialised apache parser must agree with apache_log_parser, and every generated nginx line must parse"""
+    from itertools import islice
+    from lamastats.lamastats import parserdiscrepancies, nginx_line_parser
+    failures = 0
+    with open(os.path.join(workdir,'apache.log'),'r',encoding='utf-8') as f:
+        for line, key, fastvalue, referencevalue in parserdiscrepancies(line.rstrip('\n') for line in islice(f, samplesize)):
+            failures += 1
+            if failures <= 10:
+                print("[benchmark] Parser discrepancy on " + str(key) + ": " + repr(fastvalue) + " != " + repr(referencevalue) + " in " + line,file=sys.stderr)
+    with open(os.path.join(workdir,'nginx.log'),'r',encoding='utf-8') as f:
+        for line in islice(f, samplesize):
+            try:
+                nginx_line_parser(line)
+            except Exception as e:
+                failures += 1
+                if failures <= 10:
+                    print("[benchmark] Unable to parse nginx line (" + str(e) + "): " + line,file=sys.stderr)
+    return failures == 0
+
+
+def peakrss():
+    """Peak resident set size of this process, or of its largest worker process, in megabytes"""
+    maxrss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    return maxrss / (1024 * 1024) if sys.platform == 'darwin' else maxrss / 1024 #bytes on macOS, kilobytes elsewhere
+
+
+def environment():
+    """The environment for subprocesses, in which this copy of lamastats is importable"""
+    env = dict(os.environ)
+    packagedir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env['PYTHONPATH'] = packagedir + (os.pathsep + env['PYTHONPATH'] if env.get('PYTHONPATH') else '')
+    return env
+
+
+def measurestartup(name, workdir, repeats=STARTUPREPEATS):
+    """Times complete runs of lamastats in fresh interpreters, where importing and initialising take most of the time: 'lamastats --help', and a FLAT-only run on a short log (which needs neither the GeoIP database nor the access log parsers)"""
+    statedir = os.path.join(workdir, name)
+    os.makedirs(statedir, exist_ok=True)
+    os.chdir(statedir)
+    if name == 'startup-help':
+        args = ['--help']
+    else:
+        logfile = os.path.join(workdir, 'flat-startup.log')
+        with open(os.path.join(workdir,'flat.log'),'r',encoding='utf-8') as f, open(logfile,'w',encoding='utf-8') as out:
+            for i, line in enumerate(f):
+                if i >= STARTUPLINES:
+                    break
+                out.write(line)
+        args = ['--trackflat', '-F', logfile, logfile]
+    env = environment()
+    seconds = None
+    for _ in range(repeats):
+        for filename in os.listdir(statedir):
+            os.unlink(filename) #start without state, so every run does the same work
+        begin = time.perf_counter()
+        subprocess.run([sys.executable, '-m', 'lamastats.lamastats'] + args, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+        elapsed = time.perf_counter() - begin
+        seconds = elapsed if seconds is None else min(seconds, elapsed)
+    return { 'seconds': seconds, 'rate': 1 / seconds, 'unit': 'starts/s', 'peakrss': peakrss() }
+
+
+def measure(name, workdir, lines, jobs=1):
+    """Runs a single benchmark in this process and returns its result"""
+    if name in ('startup-help', 'startup-flat'):
+        return measurestartup(name, workdir) #before lamastats is imported here, so the peak RSS is that of the runs
+    from lamastats import lamastats
+    lamastats.internalblocks = [INTERNALBLOCK]
+    lamastats.compileclassifiers()
+    if name in REPORTSTATE:
+        os.chdir(os.path.join(workdir, REPORTSTATE[name]))
+        if name == 'outputclamreport':
+            tracker = lamastats.ClamTracker()
+        elif name == 'outputflatreport':
+            tracker = lamastats.FlatTracker()
+        else:
+            tracker = lamastats.LamaTracker()
+        report = getattr(lamastats, name)
+        track = {'badges','lamachine','clam','flat'}
+        #reports are quick to render, repeat them for a stable best time
+        seconds = None
+        total = 0.0
+        repeats = 0
+        while repeats == 0 or (total < REPORTTIME and repeats < 20):
+            size = 0
+            begin = time.perf_counter()
+            for chunk in report(tracker.data, track):
+                size += len(chunk)
+            elapsed = time.perf_counter() - begin
+            seconds = elapsed if seconds is None else min(seconds, elapsed)
+            total += elapsed
+            repeats += 1
+        return { 'seconds': seconds, 'rate': size / seconds if seconds else 0.0, 'unit': 'chars/s', 'peakrss': peakrss() }
+    statedir = os.path.join(workdir, name)
+    os.makedirs(statedir, exist_ok=True)
+    os.chdir(statedir)
+    for filename in os.listdir(statedir):
+        os.unlink(filename) #start without state, every line is new
+    if name == 'parselog':
+        trackers, logfile = [lamastats.LamaTracker()], 'apache:' + os.path.join(workdir,'apache.log')
+    elif name == 'parselog-nginx':
+        trackers, logfile = [lamastats.LamaTracker()], 'nginx:' + os.path.join(workdir,'nginx.log')
+    elif name == 'parseclamlog':
+        trackers, logfile = [lamastats.ClamTracker()], 'apache:' + os.path.join(workdir,'apache.log')
+    elif name == 'parseflatlog':
+        trackers, logfile = [lamastats.FlatTracker()], os.path.join(workdir,'flat.log')
+    else:
+        raise ValueError("Unknown benchmark: " + name)
+    begin = time.perf_counter()
+    lamastats.scanlogs([logfile], trackers, jobs)
+    seconds = time.perf_counter() - begin
+    return { 'seconds': seconds, 'rate': lines / seconds if seconds else 0.0, 'unit': 'lines/s', 'peakrss': peakrss() }
+
+
+def runbenchmark(name, workdir, lines, jobs=1, verbose=False):
+    """Runs a benchmark in a fresh Python process"""
+    process = subprocess.run([sys.executable, '-m', 'lamastats.benchmark', 'measure', name, '--workdir', workdir, '--lines', str(lines), '--jobs', str(jobs)], env=environment(), stdout=subprocess.PIPE, stderr=None if verbose else subprocess.DEVNULL, universal_newlines=True)
+    if process.returncode != 0:
+        raise RuntimeError("Benchmark " + name + " failed with exit code " + str(process.returncode))
+    return json.loads(process.stdout)
+
+
+def compare(results, baseline, tolerance):
+    """Yields a message for every result that regressed past the baseline: a rate that dropped, or a peak RSS that grew, by more than the tolerance (a fraction)"""
+    samesize = baseline.get('lines') == results['lines']
+    for name, result in results['results'].items():
+        reference = baseline['results'].get(name)
+        if reference is None:
+            continue
+        if result['rate'] < reference['rate'] * (1 - tolerance):
+            yield name + ": " + "%.0f %s is slower than the baseline of %.0f %s" % (result['rate'], result['unit'], reference['rate'], reference['unit'])
+        if samesize and result['peakrss'] > reference['peakrss'] * (1 + tolerance):
+            yield name + ": " + "peak RSS of %.1f MB exceeds the baseline of %.1f MB" % (result['peakrss'], reference['peakrss'])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m lamastats.benchmark", description="Benchmark suite for lamastats", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command')
+    generateparser = subparsers.add_parser('generate', help="Write a synthetic log to standard output or a file", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    generateparser.add_argument('kind', choices=('apache','nginx','flat'), help="Log format")
+    generateparser.add_argument('-n','--lines', type=int, help="Number of lines", default=100000)
+    generateparser.add_argument('-s','--seed', type=int, help="Random seed", default=1)
+    generateparser.add_argument('--days', type=int, help="Spread the lines over this many past days", default=365)
+    generateparser.add_argument('-o','--output', type=str, help="Output file, gzip compressed if it ends in .gz (default: standard output)", required=False)
+    runparser = subparsers.add_parser('run', help="Run the benchmarks", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    runparser.add_argument('-n','--lines', type=int, help="Number of lines per generated log", default=200000)
+    runparser.add_argument('-s','--seed', type=int, help="Random seed", default=1)
+    runparser.add_argument('--days', type=int, help="Spread the lines over this many past days", default=365)
+    runparser.add_argument('-w','--workdir', type=str, help="Directory for the generated logs and the state of the benchmarks, reused between runs", default="lamastats-benchmark")
+    runparser.add_argument('-b','--benchmarks', type=str, help="Comma separated list of benchmarks to run (" + ",".join(BENCHMARKS) + ")", default=",".join(BENCHMARKS))
+    runparser.add_argument('-j','--jobs', type=int, help="Number of worker processes for the parse benchmarks", default=1)
+    runparser.add_argument('--baseline', type=str, help="Baseline results (JSON) to check against", required=False)
+    runparser.add_argument('--savebaseline', help="Store the results as the new baseline instead of checking against it", action='store_true')
+    runparser.add_argument('--tolerance', type=float, help="Allowed regression relative to the baseline, as a fraction", default=0.2)
+    runparser.add_argument('-o','--output', type=str, help="Also write the results (JSON) to this file", required=False)
+    runparser.add_argument('-v','--verbose', help="Show the output of the benchmarked code", action='store_true')
+    measureparser = subparsers.add_parser('measure', help="Run a single benchmark in this process and print its result (used by run)")
+    measureparser.add_argument('name', choices=BENCHMARKS)
+    measureparser.add_argument('--workdir', type=str, required=True)
+    measureparser.add_argument('--lines', type=int, required=True)
+    measureparser.add_argument('--jobs', type=int, default=1)
+    args = parser.parse_args(argv)
+
+    if args.command == 'generate':
+        if args.output:
+            writelog(args.output, args.kind, args.lines, args.seed, args.days)
+        else:
+            for line in generatelines(args.kind, args.lines, args.seed, args.days):
+                sys.stdout.write(line)
+    elif args.command == 'measure':
+        print(json.dumps(measure(args.name, os.path.abspath(args.workdir), args.lines, args.jobs)))
+    elif args.command == 'run':
+        benchmarks = [ name.strip() for name in args.benchmarks.split(',') if name.strip() ]
+        for name in benchmarks:
+            if name not in BENCHMARKS:
+                print("Unknown benchmark: " + name,file=sys.stderr)
+                sys.exit(2)
+        for name in list(benchmarks):
+            #a report needs the state of its parse benchmark
+            if name in REPORTSTATE and REPORTSTATE[name] not in benchmarks and not os.path.exists(os.path.join(args.workdir, REPORTSTATE[name])):
+                benchmarks.insert(0, REPORTSTATE[name])
+        workdir = os.path.abspath(args.workdir)
+        os.makedirs(workdir, exist_ok=True)
+        preparelogs(workdir, args.lines, args.seed, args.days)
+        if not checkparsers(workdir):
+            print("[benchmark] Parser correctness check failed",file=sys.stderr)
+            sys.exit(1)
+        results = { 'lines': args.lines, 'jobs': args.jobs, 'python': sys.version.split()[0], 'results': {} }
+        for name in BENCHMARKS:
+            if name in benchmarks:
+                result = results['results'][name] = runbenchmark(name, workdir, args.lines, args.jobs, args.verbose)
+                print("%-24s %10.3f s %14.0f %-8s %8.1f MB peak RSS" % (name, result['seconds'], result['rate'], result['unit'], result['peakrss']))
+        if args.output:
+            with open(args.output,'w',encoding='utf-8') as f:
+                json.dump(results, f, indent=4)
+        if args.baseline and args.savebaseline:
+            with open(args.baseline,'w',encoding='utf-8') as f:
+                json.dump(results, f, indent=4)
+            print("[benchmark] Saved baseline to " + args.baseline,file=sys.stderr)
+        elif args.baseline:
+            with open(args.baseline,'r',encoding='utf-8') as f:
+                baseline = json.load(f)
+            if baseline.get('lines') != args.lines:
+                print("[benchmark] Baseline was measured on " + str(baseline.get('lines')) + " lines, only comparing rates",file=sys.stderr)
+            regressions = list(compare(results, baseline, args.tolerance))
+            for message in regressions:
+                print("REGRESSION " + message,file=sys.stderr)
+            if regressions:
+                sys.exit(1)
+            print("[benchmark] No regressions against " + args.baseline,file=sys.stderr)
+    else:
+        parser.print_help()
+        sys.exit(2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+#Diagnostics: leveled messages about the processing (skipped bots, parse errors, new hits, ...). Every message is counted by category, but only a rate limited sample of each category is written, through a buffer, and the counts are summarised at the end. This keeps large backfills from spending their time writing to stderr.
+
+import sys
+import time
+import atexit
+from collections import defaultdict
+
+QUIET, ERROR, WARNING, INFO, DEBUG = 0, 1, 2, 3, 4
+LEVELS = { 'quiet': QUIET, 'error': ERROR, 'warning': WARNING, 'info': INFO, 'debug': DEBUG }
+LEVELNAMES = { level: name for name, level in LEVELS.items() }
+
+
+class Diagnostics:
+    """Writes messages up to a verbosity level. At most samples messages per category are written per window (in seconds), the rest is only counted."""
+
+    def __init__(self, level=INFO, samples=5, window=60.0, stream=None, buffersize=256):
+        self.level = level
+        self.samples = samples
+        self.window = window
+        self.stream = stream
+        self.filename = None
+        self.buffersize = buffersize #number of buffered messages that triggers a flush
+        self.buffer = []
+        self.collect = False #collect the samples for the parent process (see snapshot()) instead of writing them
+        self.collected = []
+        self.counts = defaultdict(int)
+        self.shown = defaultdict(int)
+        self.levels = {}
+        self.windows = {} #category => [start of the current window, samples written in it]
+
+    def configure(self, level=None, samples=None, filename=None, collect=None):
+        if level is not None:
+            self.level = level
+        if samples is not None:
+            self.samples = samples
+        if filename is not None and filename != self.filename:
+            self.close()
+            self.stream = open(filename,'a',encoding='utf-8')
+            self.filename = filename
+        if collect is not None:
+            self.collect = collect
+
+    def enabled(self, level):
+        """Would a message of this level be written? Lets callers skip building expensive messages."""
+        return level <= self.level
+
+    def log(self, level, category, message, *args):
+        """Counts a message of the category, and writes it if it is sampled; like in the logging module, the message is only %-formatted with the args when it is written"""
+        self.counts[category] += 1
+        self.levels[category] = level
+        if level <= self.level:
+            self.sample(level, category, message, args)
+
+    def error(self, category, message, *args):
+        self.log(ERROR, category, message, *args)
+
+    def warning(self, category, message, *args):
+        self.log(WARNING, category, message, *args)
+
+    def info(self, category, message, *args):
+        self.log(INFO, category, message, *args)
+
+    def debug(self, category, message, *args):
+        self.log(DEBUG, category, message, *args)
+
+    def note(self, message, level=INFO):
+        """Writes a progress message immediately, these are neither counted nor rate limited"""
+        if level <= self.level:
+            if self.collect:
+                self.collected.append( (level, None, message) )
+            else:
+                self.buffer.append(message)
+                self.flush()
+
+    def sample(self, level, category, message, args=()):
+        now = time.monotonic()
+        window = self.windows.get(category)
+        if window is None or now - window[0] >= self.window:
+            window = self.windows[category] = [now, 0]
+        if window[1] >= self.samples:
+            return
+        window[1] += 1
+        self.shown[category] += 1
+        if args:
+            message = message % args
+        if self.collect:
+            self.collected.append( (level, category, message) )
+        else:
+            self.buffer.append(message)
+            if len(self.buffer) >= self.buffersize:
+                self.flush()
+
+    def flush(self):
+        if self.buffer:
+            stream = self.stream if self.stream is not None else sys.stderr
+            stream.write("\n".join(self.buffer) + "\n")
+            stream.flush()
+            self.buffer = []
+
+    def reset(self):
+        self.buffer = []
+        self.collected = []
+        self.counts.clear()
+        self.shown.clear()
+        self.levels.clear()
+        self.windows.clear()
+
+    def snapshot(self):
+        """Returns and resets the counts and collected samples, for merge() in the parent process"""
+        snapshot = { 'counts': dict(self.counts), 'levels': dict(self.levels), 'samples': self.collected }
+        self.counts.clear()
+        self.collected = []
+        return snapshot
+
+    def merge(self, snapshot):
+        for category, n in snapshot['counts'].items():
+            self.counts[category] += n
+        self.levels.update(snapshot['levels'])
+        for level, category, message in snapshot['samples']:
+            if category is None:
+                self.note(message, level)
+            elif level <= self.level:
+                self.sample(level, category, message)
+
+    def summary(self):
+        """Writes the number of messages per category, and how many of them were shown"""
+        if self.level >= ERROR and self.counts:
+            for category, n in sorted(self.counts.items()):
+                self.buffer.append("[diagnostics] " + category + ": " + str(n) + " (" + LEVELNAMES[self.levels[category]] + ", " + str(self.shown.get(category,0)) + " shown)")
+        self.flush()
+
+    def close(self):
+        self.flush()
+        if self.filename is not None:
+            self.stream.close()
+            self.stream = None
+            self.filename = None
+
+diagnostics = Diagnostics()
+atexit.register(diagnostics.flush)
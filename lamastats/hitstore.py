@@ -0,0 +1,128 @@
+#Compact storage of hit records. A hit is a small dict with a fixed set of fields ('type', 'ip', 'country', ...) whose values repeat a lot; instead of a dict per hit, the values are interned as small integer codes in a codebook per field (the Codebooks of a tracker) and a list of hits is a flat array of codes, one row of codes per hit. The lists behave as sequences of dicts where the rest of the code (JSON state files, journals, merging of worker results) needs them.
+
+from array import array
+
+
+MISSING = object() #value of a field that a hit does not have (hits from old state files may lack fields)
+
+
+class Codebook:
+    """Interns the values of a field: maps them to consecutive integer codes and back"""
+
+    __slots__ = ('codes', 'values')
+
+    def __init__(self):
+        self.codes = {}
+        self.values = []
+
+    def code(self, value):
+        code = self.codes.get(value)
+        if code is None:
+            code = self.codes[value] = len(self.values)
+            self.values.append(value)
+        return code
+
+    def __len__(self):
+        return len(self.values)
+
+
+class Codebooks:
+    """The codebooks of the fields of a tracker's hits, shared by its schemas so equal values of a field have equal codes. Codebooks only grow; the owner replaces them (see recode()) when the hits whose values they hold are dropped."""
+
+    def __init__(self):
+        self.books = {} #field => Codebook
+        self.schemas = {} #fields => HitSchema
+
+    def codebook(self, field):
+        book = self.books.get(field)
+        if book is None:
+            book = self.books[field] = Codebook()
+        return book
+
+    def schema(self, fields):
+        fields = tuple(fields)
+        schema = self.schemas.get(fields)
+        if schema is None:
+            schema = self.schemas[fields] = HitSchema(fields, self)
+        return schema
+
+
+class HitSchema:
+    """The fields of a kind of hit, in the order in which they appear in the dicts"""
+
+    def __init__(self, fields, codebooks):
+        self.fields = tuple(fields)
+        self.width = len(self.fields)
+        self.codebooks = [ codebooks.codebook(field) for field in self.fields ]
+        self.missing = [ book.code(MISSING) for book in self.codebooks ]
+
+    def encode(self, hit):
+        """Returns the row of codes of a hit (a dict), which also serves as its fingerprint for duplicate detection"""
+        return tuple( book.code(hit.get(field, MISSING)) for field, book in zip(self.fields, self.codebooks) )
+
+    def decode(self, row):
+        hit = {}
+        for field, book, code in zip(self.fields, self.codebooks, row):
+            value = book.values[code]
+            if value is not MISSING:
+                hit[field] = value
+        return hit
+
+
+class HitList:
+    """A list of hits of one schema, stored as a flat array of codes. Iterating yields the hits as dicts."""
+
+    __slots__ = ('schema', 'codes')
+
+    def __init__(self, schema, hits=()):
+        self.schema = schema
+        self.codes = array('I')
+        for hit in hits:
+            self.append(hit)
+
+    def append(self, hit):
+        self.codes.extend(self.schema.encode(hit))
+
+    def appendrow(self, row):
+        self.codes.extend(row)
+
+    def __len__(self):
+        return len(self.codes) // self.schema.width
+
+    def rows(self):
+        codes = self.codes
+        width = self.schema.width
+        for i in range(0, len(codes), width):
+            yield tuple(codes[i:i+width])
+
+    def __iter__(self):
+        decode = self.schema.decode
+        for row in self.rows():
+            yield decode(row)
+
+    def __eq__(self, other):
+        if isinstance(other, HitList):
+            return self.schema is other.schema and self.codes == other.codes
+        return list(self) == list(other)
+
+    def __repr__(self):
+        return "HitList(" + repr(list(self)) + ")"
+
+    def __reduce__(self):
+        #codes are only meaningful within their codebooks, pickle the hits themselves
+        return (unpickle, (self.schema.fields, list(self)))
+
+
+def unpickle(fields, hits):
+    return HitList(Codebooks().schema(fields), hits)
+
+
+def recode(hitlists, codebooks):
+    """Re-encodes hit lists with (fresh) codebooks, in place"""
+    for hits in hitlists:
+        schema = codebooks.schema(hits.schema.fields)
+        codes = array('I')
+        for hit in hits:
+            codes.extend(schema.encode(hit))
+        hits.schema = schema
+        hits.codes = codes
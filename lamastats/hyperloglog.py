@@ -0,0 +1,152 @@
+#HyperLogLog sketches, to estimate the number of distinct visitors (IP addresses) over any range of days: a sketch is kept per day, and the sketches of a range are merged (a union) to estimate its number of distinct visitors. A sketch takes at most 2**PRECISION bytes, however many visitors it has seen, and small ones are kept sparse.
+
+import math
+import base64
+import hashlib
+from functools import lru_cache
+
+PRECISION = 12 #2**12 registers, a standard error of about 1.6%
+SPARSELIMIT = 64 #registers that a sparse sketch can hold before it is converted to a dense one
+
+
+@lru_cache(maxsize=65536)
+def hashvalue(value):
+    """Stable 64-bit hash of a string (the builtin hash() is salted per process)"""
+    return int.from_bytes(hashlib.blake2b(value.encode('utf-8'), digest_size=8).digest(), 'big')
+
+
+class HyperLogLog:
+    """A HyperLogLog sketch of a set of strings. The registers are a dictionary (index => rank) while few are set, and a bytearray after that."""
+
+    __slots__ = ('p', 'sparse', 'dense')
+
+    def __init__(self, p=PRECISION):
+        self.p = p
+        self.sparse = {}
+        self.dense = None
+
+    def add(self, value):
+        h = hashvalue(value)
+        bits = 64 - self.p
+        index = h >> bits
+        rank = bits - (h & ((1 << bits) - 1)).bit_length() + 1
+        self.setregister(index, rank)
+
+    def setregister(self, index, rank):
+        if self.dense is not None:
+            if rank > self.dense[index]:
+                self.dense[index] = rank
+        elif rank > self.sparse.get(index, 0):
+            self.sparse[index] = rank
+            if len(self.sparse) > SPARSELIMIT:
+                self.densify()
+
+    def densify(self):
+        self.dense = bytearray(1 << self.p)
+        for index, rank in self.sparse.items():
+            self.dense[index] = rank
+        self.sparse = {}
+
+    def registers(self):
+        """Yields the (index, rank) pairs of the registers that are set"""
+        if self.dense is None:
+            yield from self.sparse.items()
+        else:
+            for index, rank in enumerate(self.dense):
+                if rank:
+                    yield index, rank
+
+    def update(self, other):
+        """Merges another sketch into this one, which then represents the union of both sets"""
+        if other.p != self.p:
+            raise ValueError("Can not merge sketches of different precision")
+        if other.dense is not None and self.dense is None:
+            self.densify()
+        if self.dense is not None and other.dense is not None:
+            self.dense = bytearray(map(max, self.dense, other.dense))
+        else:
+            for index, rank in other.registers():
+                self.setregister(index, rank)
+
+    def count(self):
+        """Estimates the number of distinct values that were added, with the improved estimator of Ertl (2017), which has no bias over the whole range of counts"""
+        m = 1 << self.p
+        q = 64 - self.p
+        histogram = [0] * (q + 2) #number of registers per rank
+        if self.dense is None:
+            for rank in self.sparse.values():
+                histogram[rank] += 1
+            histogram[0] = m - len(self.sparse)
+        else:
+            for rank in range(q + 2):
+                histogram[rank] = self.dense.count(rank)
+        if histogram[0] == m:
+            return 0
+        z = m * tau(1 - histogram[q + 1] / m)
+        for rank in range(q, 0, -1):
+            z = 0.5 * (z + histogram[rank])
+        z += m * sigma(histogram[0] / m)
+        return int(round(m * m / (2 * math.log(2) * z)))
+
+    def tobytes(self):
+        """Serialises the sketch: the precision, a flag for the representation, and the sparse (index, rank) pairs or the dense registers"""
+        if self.dense is None:
+            out = bytearray((self.p, 0))
+            for index, rank in sorted(self.sparse.items()):
+                out += index.to_bytes(2, 'big')
+                out.append(rank)
+            return bytes(out)
+        return bytes((self.p, 1)) + bytes(self.dense)
+
+    @classmethod
+    def frombytes(cls, b):
+        sketch = cls(b[0])
+        if b[1]:
+            sketch.dense = bytearray(b[2:])
+        else:
+            for i in range(2, len(b), 3):
+                sketch.sparse[int.from_bytes(b[i:i+2], 'big')] = b[i+2]
+        return sketch
+
+    def encode(self):
+        """Serialises the sketch to a string, for the JSON state files"""
+        return base64.b64encode(self.tobytes()).decode('ascii')
+
+    @classmethod
+    def decode(cls, s):
+        return cls.frombytes(base64.b64decode(s))
+
+
+def sigma(x):
+    if x == 1:
+        return math.inf
+    y = 1.0
+    z = x
+    while True:
+        x *= x
+        previous = z
+        z += x * y
+        y += y
+        if z == previous:
+            return z
+
+def tau(x):
+    if x == 0 or x == 1:
+        return 0.0
+    y = 1.0
+    z = 1 - x
+    while True:
+        x = math.sqrt(x)
+        previous = z
+        y *= 0.5
+        z -= (1 - x) ** 2 * y
+        if z == previous:
+            return z / 3
+
+
+def union(sketches, p=PRECISION):
+    """Returns a new sketch that is the union of the given ones"""
+    result = HyperLogLog(p)
+    for sketch in sketches:
+        result.update(sketch)
+    return result
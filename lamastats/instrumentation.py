@@ -0,0 +1,134 @@
+#Instrumentation of the log ingestion: event counters per tracker and timers per processing stage. The counters are always kept; they are only touched on (rare) events or once per logfile. The timers wrap the functions of each stage and are only installed when timing is enabled, so they cost nothing otherwise.
+
+import sys
+import io
+import json
+import time
+from collections import defaultdict
+
+#processing stages that can be timed
+STAGES = (
+    'read', #reading and decompressing the logs
+    'prefilter', #rejecting uninteresting lines on their raw bytes
+    'parse', #parsing log lines
+    'geoip', #country lookups
+    'dedup', #duplicate detection and aggregation of hits
+    'save', #writing the state files, journals or database
+    'report', #rendering and writing the HTML reports
+)
+
+
+class Stats:
+    """Counters of events, grouped by scope (a tracker label, or 'scan' for the reading of the logs), and accumulated time and calls per stage"""
+
+    def __init__(self):
+        self.counters = defaultdict(lambda: defaultdict(int))
+        self.timers = defaultdict(float)
+        self.calls = defaultdict(int)
+        self.timing = False
+        self.start = time.perf_counter()
+
+    def count(self, scope, event, n=1):
+        self.counters[scope][event] += n
+
+    def timed(self, stage, function):
+        """Returns a wrapper of the function that accounts its time to the stage"""
+        timers = self.timers
+        calls = self.calls
+        clock = time.perf_counter
+        def wrapper(*args, **kwargs):
+            begin = clock()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                timers[stage] += clock() - begin
+                calls[stage] += 1
+        wrapper.__wrapped__ = function
+        return wrapper
+
+    def timediterator(self, stage, iterator):
+        """Accounts the time spent waiting for the items of an iterator to the stage"""
+        timers = self.timers
+        calls = self.calls
+        clock = time.perf_counter
+        iterator = iter(iterator)
+        while True:
+            begin = clock()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                timers[stage] += clock() - begin
+                return
+            timers[stage] += clock() - begin
+            calls[stage] += 1
+            yield item
+
+    def reset(self):
+        #cleared in place, the installed timers hold references to these dictionaries
+        self.counters.clear()
+        self.timers.clear()
+        self.calls.clear()
+        self.start = time.perf_counter()
+
+    def snapshot(self, reset=True):
+        """Returns the counters and timers as a picklable dictionary, for merge() in another process"""
+        snapshot = {
+            'counters': { scope: dict(counts) for scope, counts in self.counters.items() },
+            'timers': dict(self.timers),
+            'calls': dict(self.calls),
+        }
+        if reset:
+            self.reset()
+        return snapshot
+
+    def merge(self, snapshot):
+        for scope, counts in snapshot['counters'].items():
+            for event, n in counts.items():
+                self.counters[scope][event] += n
+        for stage, seconds in snapshot['timers'].items():
+            self.timers[stage] += seconds
+        for stage, n in snapshot['calls'].items():
+            self.calls[stage] += n
+
+    def report(self):
+        elapsed = time.perf_counter() - self.start
+        report = {
+            'elapsed': round(elapsed, 6),
+            'counters': { scope: dict(sorted(counts.items())) for scope, counts in sorted(self.counters.items()) },
+        }
+        lines = self.counters['scan'].get('lines',0) if 'scan' in self.counters else 0
+        if lines and elapsed:
+            report['linespersecond'] = round(lines / elapsed, 1)
+        if self.timing:
+            #in parallel runs these are summed over all worker processes
+            report['timers'] = { stage: { 'seconds': round(self.timers.get(stage,0.0), 6), 'calls': self.calls.get(stage,0) } for stage in STAGES }
+        return report
+
+    def write(self, filename):
+        """Writes the report as JSON to a file, or to standard error if the filename is '-'"""
+        if filename == '-':
+            print(json.dumps(self.report(), indent=4),file=sys.stderr)
+        else:
+            with open(filename,'w',encoding='utf-8') as f:
+                json.dump(self.report(), f, indent=4)
+
+stats = Stats()
+
+
+def profile(function, filename, limit=50):
+    """Runs the function under cProfile and writes the hottest functions, sorted by cumulative and by internal time, to a file"""
+    import pstats
+    import cProfile
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        return function()
+    finally:
+        profiler.disable()
+        out = io.StringIO()
+        profilestats = pstats.Stats(profiler, stream=out)
+        profilestats.sort_stats('cumulative').print_stats(limit)
+        profilestats.sort_stats('tottime').print_stats(limit)
+        with open(filename,'w',encoding='utf-8') as f:
+            f.write(out.getvalue())
+        print("[profile] Written to " + filename,file=sys.stderr)
@@ -0,0 +1,60 @@
+#Append-only journal of state changes, next to each state file. A record is a single line: the CRC32 checksum of its JSON payload, a space, and the payload. Records are fsynced as they are appended; a torn last record (from a crash in the middle of a write) fails its checksum and is discarded. The journal is folded into the state file (the snapshot) when it grows too large or too old, see needscompaction().
+
+import os
+import json
+import time
+import zlib
+
+COMPACTRATIO = 0.5 #compact when the journal reaches this fraction of the size of the snapshot,
+COMPACTSIZE = 64 * 1024 * 1024 #or this many bytes,
+COMPACTAGE = 7 * 86400 #or when the snapshot is this many seconds old
+
+
+def journalfile(statefile):
+    return statefile + '.journal'
+
+
+def appendrecord(filename, record, encoder=None):
+    """Appends a record to the journal and waits until it is on disk, returns the number of bytes written"""
+    payload = json.dumps(record, cls=encoder, separators=(',',':')).encode('utf-8')
+    line = b"%08x " % zlib.crc32(payload) + payload + b"\n"
+    with open(filename,'ab') as f:
+        f.write(line)
+        f.flush()
+        os.fsync(f.fileno())
+    return len(line)
+
+
+def readrecords(filename, object_hook=None):
+    """Yields (record, offset) for every intact record in the journal, where offset is the end of the record. Stops at the first damaged record."""
+    offset = 0
+    with open(filename,'rb') as f:
+        for line in f:
+            if len(line) < 10 or line[-1:] != b'\n' or line[8:9] != b' ':
+                return
+            payload = line[9:-1]
+            try:
+                checksum = int(line[:8], 16)
+            except ValueError:
+                return
+            if zlib.crc32(payload) != checksum:
+                return
+            offset += len(line)
+            yield json.loads(payload.decode('utf-8'), object_hook=object_hook), offset
+
+
+def truncate(filename, size):
+    """Cuts a damaged tail off the journal, so new records are not appended to it"""
+    with open(filename,'r+b') as f:
+        f.truncate(size)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def needscompaction(statefile, journal):
+    try:
+        journalsize = os.path.getsize(journal)
+    except OSError:
+        return False
+    st = os.stat(statefile)
+    return journalsize >= COMPACTSIZE or journalsize >= st.st_size * COMPACTRATIO or time.time() - st.st_mtime >= COMPACTAGE
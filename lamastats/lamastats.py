@@ -2,27 +2,267 @@
 
 import sys
 import argparse
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
+from functools import lru_cache
+from contextlib import closing, nullcontext
+from itertools import chain
+from operator import itemgetter
+import heapq
 from datetime import timedelta, date, datetime
-import gzip
 import json
+import hashlib
 import re
-import apache_log_parser
-import pygeoip
 import os
-
-gi = pygeoip.GeoIP(os.path.join(os.path.dirname(__file__),'GeoIP.dat'))
+import time
+import signal
+import ipaddress
+from bisect import bisect_right
+from lamastats.logsource import readlines, detectcodec, sourcename, TailedFile, LogWatcher
+from lamastats.instrumentation import stats, profile
+from lamastats.diagnostics import diagnostics, LEVELS, WARNING, INFO
+from lamastats.journal import journalfile, appendrecord, readrecords, truncate, needscompaction
+from lamastats.hitstore import HitList, Codebooks, recode
+from lamastats.hyperloglog import HyperLogLog, union
+
+GEOIPDB = os.path.join(os.path.dirname(__file__),'GeoIP.dat')
+
+def isipv4(ip):
+    octets = ip.split('.')
+    if len(octets) != 4:
+        return False
+    for octet in octets:
+        if not octet.isdigit() or len(octet) > 3 or int(octet) > 255:
+            return False
+    return True
+
+class GeoIPLookup:
+    """Country lookups on the (IPv4) GeoIP database, which is held entirely in memory, with a bounded LRU cache of results per IP. The database is only loaded on the first lookup, so runs that need no lookups start faster."""
+
+    def __init__(self, filename=GEOIPDB, cachesize=65536):
+        self.filename = filename
+        self.cachesize = cachesize
+        self.cache = OrderedDict() #ip => country code, least recently used first
+        self._db = None
+
+    @property
+    def db(self):
+        if self._db is None:
+            import pygeoip
+            self._db = pygeoip.GeoIP(self.filename, pygeoip.MEMORY_CACHE)
+        return self._db
+
+    def lookup(self, ip):
+        if not isipv4(ip):
+            return 'unknown' #IPv6 (not covered by the database) or not an address at all
+        return self.db.country_code_by_addr(ip) #empty string if the address is not in the database
+
+    def country(self, ip):
+        cache = self.cache
+        country = cache.get(ip)
+        if country is None:
+            country = cache[ip] = self.lookup(ip)
+            if len(cache) > self.cachesize:
+                cache.popitem(last=False)
+        else:
+            cache.move_to_end(ip)
+        return country
+
+    def resolve_many(self, ips):
+        """Resolves many IPs at once, returns a dictionary of IP => country code. Every distinct IP is resolved once; those that are not cached are looked up in address order, so the addresses that follow one in the same network of the database (see last_netmask() of pygeoip) need no lookup of their own. All results are cached."""
+        result = {}
+        misses = []
+        for ip in set(ips):
+            country = self.cache.get(ip)
+            if country is not None:
+                result[ip] = country
+            elif isipv4(ip):
+                a, b, c, d = ip.split('.')
+                misses.append( ((int(a) << 24) | (int(b) << 16) | (int(c) << 8) | int(d), ip) )
+            else:
+                result[ip] = 'unknown'
+        misses.sort()
+        network = shift = None
+        for ipnum, ip in misses:
+            if network is None or ipnum >> shift != network:
+                country = self.db.country_code_by_addr(ip)
+                shift = 32 - self.db.last_netmask()
+                network = ipnum >> shift
+            result[ip] = country
+        cache = self.cache
+        for ip, country in result.items():
+            cache[ip] = country
+            cache.move_to_end(ip)
+        while len(cache) > self.cachesize:
+            cache.popitem(last=False)
+        return result
+
+geoip = GeoIPLookup()
 
 ignoreips = ['77.161.34.157'] #proycon@home, kobus@home,
 internalips = ['127.0.0.1', '131.174.30.3','131.174.30.4'] #localhost, spitfire, applejack
 internalblocks = ['131.174.']
-line_parser = apache_log_parser.make_parser("%h %l %u %t \"%r\" %>s %b \"%{Referer}i\" \"%{User-agent}i\"")
-
-def ininternalblock(ip):
-    for internalblock in internalblocks:
-        if ip.startswith(internalblock):
-            return True
-    return False
+line_parser = None #see apachelogparser()
+
+def apachelogparser():
+    """Returns the general parser of apache_log_parser. It is only imported when first needed, as importing it takes long (it loads the rules of a user agent parser)."""
+    global line_parser
+    if line_parser is None:
+        import apache_log_parser
+        line_parser = apache_log_parser.make_parser("%h %l %u %t \"%r\" %>s %b \"%{Referer}i\" \"%{User-agent}i\"")
+    return line_parser
+
+def parsenetwork(entry):
+    """Parses an IP address, a CIDR range, or a prefix in the traditional notation ('131.174.' or '2001:db8:') to an ipaddress network, returns None if it is none of these"""
+    try:
+        return ipaddress.ip_network(entry, strict=False)
+    except ValueError:
+        pass
+    if entry.endswith('.'):
+        octets = entry[:-1].split('.')
+        if len(octets) < 4 and all(octet.isdigit() and int(octet) <= 255 for octet in octets):
+            return ipaddress.ip_network('.'.join(octets + ['0'] * (4 - len(octets))) + '/' + str(8 * len(octets)))
+    elif entry.endswith(':') and '::' not in entry:
+        groups = entry[:-1].split(':')
+        if len(groups) < 8 and all(0 < len(group) <= 4 for group in groups):
+            try:
+                return ipaddress.ip_network(':'.join(groups) + '::/' + str(16 * len(groups)))
+            except ValueError:
+                pass
+    return None
+
+class IPClassifier:
+    """A compiled set of IP addresses and ranges (IPv4 and IPv6) that answers membership in logarithmic time, with a cache of results per IP. Entries that are not addresses or networks are matched as plain string prefixes."""
+
+    def __init__(self, entries=(), cachesize=65536):
+        self.entries = list(entries)
+        self.prefixes = []
+        ranges = { 4: [], 6: [] }
+        for entry in self.entries:
+            network = parsenetwork(entry)
+            if network is None:
+                self.prefixes.append(entry)
+            else:
+                ranges[network.version].append( (int(network.network_address), int(network.broadcast_address)) )
+        #merge overlapping and adjacent ranges so the range preceding an address is the only candidate
+        self.starts = {}
+        self.ends = {}
+        for version, versionranges in ranges.items():
+            starts, ends = [], []
+            for start, end in sorted(versionranges):
+                if ends and start <= ends[-1] + 1:
+                    ends[-1] = max(ends[-1], end)
+                else:
+                    starts.append(start)
+                    ends.append(end)
+            self.starts[version] = starts
+            self.ends[version] = ends
+        self.contains = lru_cache(maxsize=cachesize)(self.lookup)
+
+    def __contains__(self, ip):
+        return self.contains(ip)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def lookup(self, ip):
+        try:
+            address = ipaddress.ip_address(ip)
+        except ValueError:
+            address = None
+        if address is not None:
+            if address.version == 6 and address.ipv4_mapped is not None:
+                address = address.ipv4_mapped
+            value = int(address)
+            i = bisect_right(self.starts[address.version], value) - 1
+            if i >= 0 and value <= self.ends[address.version][i]:
+                return True
+        for prefix in self.prefixes:
+            if ip.startswith(prefix):
+                return True
+        return False
+
+
+def readiplist(filename):
+    """Reads IP addresses, ranges or prefixes from a file, one per line, # starts a comment"""
+    entries = []
+    with open(filename,'r',encoding='utf-8') as f:
+        for line in f:
+            line = line.split('#',1)[0].strip()
+            if line:
+                entries.append(line)
+    return entries
+
+#User-agent rules: (category, substring) pairs, matched case-insensitively. The category 'bot' marks bots (which are skipped), 'proxy' marks requests through a proxy such as GitHub's camo, any other category is a platform; the first platform in this order that matches wins.
+UARULES = [
+    ('bot', 'bot'),
+    ('bot', 'crawler'),
+    ('proxy', 'camo'),
+    ('proxy', 'github'),
+    ('android', 'android'),
+    ('linux', 'linux'),
+    ('ios', 'ios'),
+    ('mac', 'mac os x'),
+    ('bsd', 'bsd'),
+    ('windows', 'windows'),
+]
+
+class UserAgentClassifier:
+    """Classifies user-agent strings as (bot, proxied, platform) in a single pass of one compiled pattern, with a bounded LRU cache of results per user-agent string"""
+
+    def __init__(self, rules=UARULES, cachesize=65536):
+        self.rules = list(rules)
+        self.platforms = [] #in order of priority
+        self.categories = defaultdict(set) #substring => categories of the rules it implies
+        for category, substring in self.rules:
+            substring = substring.lower()
+            if category not in ('bot','proxy') and category not in self.platforms:
+                self.platforms.append(category)
+            self.categories[substring].add(category)
+        #several substrings may match at the same position only if one is a prefix of the other; the longest is tried first and implies the categories of its prefixes
+        substrings = sorted(self.categories, key=len, reverse=True)
+        for substring in substrings:
+            for prefix in substrings:
+                if prefix != substring and substring.startswith(prefix):
+                    self.categories[substring] |= self.categories[prefix]
+        #the lookahead reports a match at every position, so overlapping occurrences are not missed
+        self.pattern = re.compile('(?=(' + '|'.join(re.escape(substring) for substring in substrings) + '))') if substrings else None
+        self.classify = lru_cache(maxsize=cachesize)(self.lookup)
+
+    def lookup(self, useragent):
+        categories = set()
+        if self.pattern is not None:
+            for match in self.pattern.finditer(useragent.lower()):
+                categories |= self.categories[match.group(1)]
+        platform = 'unknown'
+        for candidate in self.platforms:
+            if candidate in categories:
+                platform = candidate
+                break
+        return 'bot' in categories, 'proxy' in categories, platform
+
+
+def readuarules(filename):
+    """Reads user-agent rules from a file, one per line: a category ('bot', 'proxy' or a platform name) followed by the substring to match, # starts a comment"""
+    rules = []
+    with open(filename,'r',encoding='utf-8') as f:
+        for i, line in enumerate(f):
+            line = line.split('#',1)[0].strip()
+            if line:
+                fields = line.split(None, 1)
+                if len(fields) != 2:
+                    raise ValueError("Invalid user-agent rule on line " + str(i+1) + " of " + filename + ": " + line)
+                rules.append( (fields[0], fields[1]) )
+    return rules
+
+uarules = UARULES
+
+def compileclassifiers():
+    global ignored, internal, useragents
+    ignored = IPClassifier(ignoreips)
+    internal = IPClassifier(internalips + internalblocks)
+    useragents = UserAgentClassifier(uarules)
+
+compileclassifiers()
 
 class PythonObjectEncoder(json.JSONEncoder):
     def default(self, obj):
@@ -30,6 +270,10 @@ class PythonObjectEncoder(json.JSONEncoder):
             return json.JSONEncoder.default(self, obj)
         elif isinstance(obj, set):
             return {'_set': list(obj)}
+        elif isinstance(obj, HitList):
+            return list(obj) #stored as a plain list of hits
+        elif isinstance(obj, HyperLogLog):
+            return {'_hll': obj.encode() }
         elif isinstance(obj, date):
             return {'_date': obj.strftime('%Y-%m-%d') }
         else:
@@ -40,6 +284,8 @@ def PythonObjectDecoder(dct):
         return set(dct['_set'])
     if '_date' in dct:
         return datetime.strptime(dct['_date'], '%Y-%m-%d').date()
+    if '_hll' in dct:
+        return HyperLogLog.decode(dct['_hll'])
     return dct
 
 def daterange(start_date, end_date):
@@ -57,26 +303,58 @@ def datestr(d):
     return d.strftime('%Y-%m-%d')
 
 
+#Timestamps are handled as integers of the form YYYYMMDDHHMMSS, which compare like the 'YYYY-MM-DD HH:MM:SS' strings in the state files. Consecutive log lines share their second and day, so decoding is memoized.
+MONTHS = {'Jan':'01', 'Feb':'02', 'Mar':'03', 'Apr':'04', 'May':'05', 'Jun':'06', 'Jul':'07', 'Aug':'08', 'Sep':'09', 'Oct':'10', 'Nov':'11', 'Dec':'12'}
+
+@lru_cache(maxsize=4096)
+def decodeday(s):
+    """Decodes a dd/Mon/yyyy day as found in access logs to a (YYYYMMDD integer, 'YYYY-MM-DD' date key) tuple"""
+    month = MONTHS[s[3:6]]
+    return int(s[7:11] + month + s[0:2]), s[7:11] + '-' + month + '-' + s[0:2]
+
+@lru_cache(maxsize=65536)
+def decodetimestamp(s):
+    """Decodes a fixed-width dd/Mon/yyyy:HH:MM:SS timestamp as found in access logs to a (YYYYMMDDHHMMSS integer, 'YYYY-MM-DD' date key) tuple"""
+    try:
+        if s[11] != ':' or s[14] != ':' or s[17] != ':':
+            raise ValueError
+        daykey, date = decodeday(s[:11])
+        return daykey * 1000000 + int(s[12:14] + s[15:17] + s[18:20]), date
+    except (KeyError, ValueError, IndexError):
+        raise ValueError("Invalid timestamp: " + s)
+
+@lru_cache(maxsize=65536)
+def timestampkey(s):
+    """Converts a 'YYYY-MM-DD HH:MM:SS' timestamp string to its integer key, the empty string maps to 0"""
+    if not s:
+        return 0
+    return int(s[0:4] + s[5:7] + s[8:10] + s[11:13] + s[14:16] + s[17:19])
+
+def timestampstr(key):
+    """Converts an integer timestamp key back to a 'YYYY-MM-DD HH:MM:SS' string"""
+    if not key:
+        return ""
+    s = str(key)
+    return s[0:4] + '-' + s[4:6] + '-' + s[6:8] + ' ' + s[8:10] + ':' + s[10:12] + ':' + s[12:14]
+
+def linetimestamp(parsed_line):
+    if 'timestamp' in parsed_line:
+        return parsed_line['timestamp']
+    return decodetimestamp(parsed_line['time_received'][1:21]) #parsed by apache_log_parser
+
+
 def parseuseragent(parsed_line):
-    useragent = ""
-    bot = False
-    if 'request_header_user_agent' in parsed_line:
-        useragent = parsed_line['request_header_user_agent']
-    else:
-        useragent = ""
-    if useragent.lower().find("bot") != -1:
+    """Returns a (bot, proxied, platform) tuple for the user agent of a parsed line"""
+    useragent = parsed_line.get('request_header_user_agent', "")
+    bot, proxied, platform = useragents.classify(useragent)
+    if bot:
         #no bots
-        print("- skipping bot: " + useragent, file=sys.stderr)
-        bot = True
-    elif useragent.lower().find("crawler") != -1:
-        #no bots
-        print("- skipping bot: " + useragent, file=sys.stderr)
-        bot = True
-    return useragent, bot
+        diagnostics.info('bot', "- skipping bot: %s", useragent)
+    return bot, proxied, platform
 
 def loaddata(filename, data):
     if os.path.exists(filename):
-        print("Loading previous data from " + filename,file=sys.stderr)
+        diagnostics.note("Loading previous data from " + filename)
         loadeddata = json.load(open(filename,'r',encoding='utf-8'),object_hook=PythonObjectDecoder)
         for key in loadeddata.keys():
             if isinstance(data[key], dict):
@@ -84,11 +362,143 @@ def loaddata(filename, data):
             else:
                 data[key] = loadeddata[key]
 
-NGINX_PARSER = re.compile(r'(?P<ipaddress>\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}) - "?(?P<remoteuser>[^\s]+)"? \[(?P<dateandtime>\d{2}\/[A-Za-z]{3}\/\d{4}:\d{2}:\d{2}:\d{2} (\+|\-)\d{4})\] \"(?P<request_method>(GET|POST|PUT|DELETE)) (?P<request_url>.+) (HTTP\/1\.1") (?P<status>\d{3}) (?P<bytessent>\d+) "?(?P<request_header_referer>[^"]+)"? "?(?P<request_header_user_agent>[^"]+)"? "?(?P<remote_host>[^"]+)"?.*')
+#Parser for nginx logs, compiled from the log_format of the server (see --nginxformat). The default is the combined format with the address of the client behind a proxy appended; as servers often append more fields to it, trailing fields are allowed after it.
+NGINX_FORMAT = '$remote_addr - $remote_user [$time_local] "$request" $status $body_bytes_sent "$http_referer" "$http_user_agent" "$http_x_forwarded_for"'
+NGINX_VARIABLES = { #nginx variable => field name as in the dictionaries of apache_log_parser
+    'remote_addr': 'remote_addr',
+    'http_x_forwarded_for': 'http_x_forwarded_for',
+    'remote_user': 'remote_user',
+    'time_local': 'time_received',
+    'request': 'request_first_line',
+    'status': 'status',
+    'body_bytes_sent': 'response_bytes_clf',
+    'http_referer': 'request_header_referer',
+    'http_user_agent': 'request_header_user_agent',
+}
+NGINX_VARIABLE = re.compile(r'\$(?:\{(\w+)\}|(\w+))')
+
+class NginxFormat:
+    """An nginx log_format compiled to a parser: one anchored regular expression in which every variable matches up to the delimiter that follows it (so it never backtracks and a line that does not match fails fast), and which only captures the variables the trackers need. Quoted variables may contain escaped quotes; as these are rare and make matching about twice as slow, a second expression that allows them is only used for lines that contain them."""
+
+    def __init__(self, format=NGINX_FORMAT, trailing=None):
+        self.format = format
+        if trailing is None:
+            trailing = format == NGINX_FORMAT #allow more fields (separated by a space) after those of the format, for the default format only: custom formats are taken to be exact
+        self.groups = {} #field name => group number
+        tokens = []
+        position = 0
+        for match in NGINX_VARIABLE.finditer(format):
+            tokens.append(format[position:match.start()])
+            tokens.append(match.group(1) or match.group(2))
+            position = match.end()
+        tokens.append(format[position:])
+        #tokens alternate between literals (even) and variables (odd)
+        pattern = []
+        escapedpattern = []
+        for i, token in enumerate(tokens):
+            if i % 2 == 0:
+                pattern.append(re.escape(token))
+                escapedpattern.append(re.escape(token))
+                continue
+            quoted = False
+            before, after = tokens[i-1], tokens[i+1]
+            if token == 'time_local':
+                fieldpattern = r'\d{2}/[A-Za-z]{3}/\d{4}:\d{2}:\d{2}:\d{2} [+-]\d{4}'
+            elif before.endswith('"') and after.startswith('"'):
+                fieldpattern = '[^"]*'
+                quoted = True
+            elif after:
+                fieldpattern = '[^' + re.escape(after[0]) + r'\n]*'
+            elif i == len(tokens) - 2:
+                fieldpattern = r'[^\n]*'
+            else:
+                raise ValueError("Variables must be separated in the nginx log format: $" + token + " is directly followed by $" + tokens[i+2])
+            escapedfieldpattern = r'[^"\\]*(?:\\.[^"\\]*)*' if quoted else fieldpattern
+            field = NGINX_VARIABLES.get(token)
+            if field is not None and field not in self.groups:
+                self.groups[field] = len(self.groups) + 1
+                pattern.append('(' + fieldpattern + ')')
+                escapedpattern.append('(' + escapedfieldpattern + ')')
+            else:
+                pattern.append('(?:' + fieldpattern + ')')
+                escapedpattern.append('(?:' + escapedfieldpattern + ')')
+        end = r'(?: [^\n]*)?\r?\n?$' if trailing else r'\r?\n?$'
+        pattern.append(end)
+        escapedpattern.append(end)
+        for field, variable in (('time_received', 'time_local'), ('request_first_line', 'request')):
+            if field not in self.groups:
+                raise ValueError("The nginx log format must contain $" + variable)
+        if 'remote_addr' not in self.groups and 'http_x_forwarded_for' not in self.groups:
+            raise ValueError("The nginx log format must contain $remote_addr or $http_x_forwarded_for")
+        self.pattern = re.compile(''.join(pattern))
+        self.escapedpattern = re.compile(''.join(escapedpattern))
+        self.keys = frozenset(self.groups) | {'remote_host', 'request_method', 'request_url', 'request_http_ver', 'timestamp'}
+
+    def parse(self, line):
+        match = (self.escapedpattern if '\\"' in line else self.pattern).match(line)
+        if match is None:
+            raise ValueError("Line does not match the nginx log format")
+        return NginxLine(match, self)
+
+
+class NginxLine:
+    """Lazily decoded fields of a log line parsed by an NginxFormat, accessed like the dictionary that apache_log_parser returns. The remote host is the client behind the proxy ($http_x_forwarded_for) if there is one, and $remote_addr otherwise."""
+
+    __slots__ = ('match', 'format', 'request')
+
+    def __init__(self, match, format):
+        self.match = match
+        self.format = format
+        self.request = None
+
+    def __contains__(self, key):
+        return key in self.format.keys
+
+    def field(self, key):
+        group = self.format.groups.get(key)
+        return self.match.group(group) if group is not None else None
+
+    def __getitem__(self, key):
+        if key in self.format.groups:
+            return self.match.group(self.format.groups[key])
+        elif key == 'remote_host':
+            forwarded = self.field('http_x_forwarded_for')
+            if forwarded and forwarded != '-':
+                return forwarded.split(',',1)[0].strip() #the client, followed by the proxies in between
+            addr = self.field('remote_addr')
+            return addr if addr is not None else forwarded
+        elif key == 'timestamp':
+            return decodetimestamp(self.field('time_received')[:20])
+        elif key in ('request_method', 'request_url', 'request_http_ver'):
+            if self.request is None:
+                parts = self.field('request_first_line').split(' ')
+                if len(parts) > 2 and parts[-1].startswith('HTTP/'):
+                    self.request = (parts[0], ' '.join(parts[1:-1]), parts[-1][5:])
+                elif len(parts) > 1:
+                    self.request = (parts[0], ' '.join(parts[1:]), None)
+                else:
+                    self.request = ('', '', None) #garbage request line
+            return self.request[('request_method', 'request_url', 'request_http_ver').index(key)]
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        if key in self.format.keys:
+            return self[key]
+        return default
+
+
+nginxlogformat = NGINX_FORMAT
+nginxformat = None #compiled from nginxlogformat by nginxparser()
+
+def nginxparser():
+    """Returns the NginxFormat of the nginx logs, compiled on first use"""
+    global nginxformat
+    if nginxformat is None:
+        nginxformat = NginxFormat(nginxlogformat)
+    return nginxformat
+
 def nginx_line_parser(line):
-    parsed_line = NGINX_PARSER.search(line).groupdict()
-    parsed_line['time_received_datetimeobj'] = datetime.strptime(parsed_line['dateandtime'][:-6], "%d/%b/%Y:%H:%M:%S")
-    return parsed_line
+    return nginxparser().parse(line)
 
 def get_mode(logfile):
     mode = "apache"
@@ -100,365 +510,1232 @@ def get_mode(logfile):
         mode = "nginx"
     return mode, logfile
 
+#Specialised parser for the Apache combined log format. It uses the same field patterns as apache_log_parser (so it agrees on what each field contains), but only extracts what the trackers need and only when they ask for it.
+APACHE_PARSER = re.compile(r'(\S*) (\S*) (\S*) \[([^\]]*)\] "(.*?)" (\d+|-) (\d+|-) "(.*?)" "(.*?)"')
+APACHE_FIELDS = {
+    'remote_host': 1,
+    'remote_logname': 2,
+    'remote_user': 3,
+    'time_received': 4,
+    'request_first_line': 5,
+    'status': 6,
+    'response_bytes_clf': 7,
+    'request_header_referer': 8,
+    'request_header_user_agent': 9,
+}
+REQUEST_PARSER = re.compile(r"^(GET|HEAD|POST|OPTIONS|PUT|CONNECT|PATCH|PROPFIND|DELETE)\s?(.{,10000}?)(\s+HTTP/(1.[01]))?$")
+
+class ApacheLine:
+    """Lazily decoded fields of a log line in Apache combined log format, accessed like the dictionary that apache_log_parser returns"""
+
+    __slots__ = ('match', 'request')
+
+    keys = frozenset(APACHE_FIELDS) | {'request_method', 'request_url', 'request_http_ver', 'time_received_datetimeobj', 'timestamp'}
+
+    def __init__(self, match):
+        self.match = match
+        self.request = None
+
+    def __contains__(self, key):
+        return key in self.keys
+
+    def __getitem__(self, key):
+        group = APACHE_FIELDS.get(key)
+        if group == 4:
+            return '[' + self.match.group(4) + ']'
+        elif group is not None:
+            return self.match.group(group)
+        elif key == 'timestamp':
+            return decodetimestamp(self.match.group(4)[:20])
+        elif key == 'time_received_datetimeobj':
+            return datetime.strptime(self.match.group(4)[:20], "%d/%b/%Y:%H:%M:%S")
+        elif key in ('request_method', 'request_url', 'request_http_ver'):
+            if self.request is None:
+                match = REQUEST_PARSER.match(self.match.group(5))
+                if match is None:
+                    self.request = ('', '', '') #garbage request line
+                else:
+                    self.request = (match.group(1), match.group(2), match.group(4))
+            return self.request[('request_method', 'request_url', 'request_http_ver').index(key)]
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        if key in self.keys:
+            return self[key]
+        return default
+
+
+def apache_line_parser(line):
+    match = APACHE_PARSER.match(line)
+    if match is None:
+        #malformed or unusual line, leave it to the general parser
+        return apachelogparser()(line)
+    return ApacheLine(match)
+
+
+def parserdiscrepancies(lines):
+    """Compares the specialised apache_line_parser() against apache_log_parser on the given lines, yields (line, key, fastvalue, referencevalue) for every field they disagree on"""
+    import apache_log_parser
+    referenceparser = apachelogparser()
+    for line in lines:
+        try:
+            reference = referenceparser(line)
+        except apache_log_parser.LineDoesntMatchException:
+            reference = None
+        fast = apache_line_parser(line) if reference is not None else None
+        if reference is None:
+            if APACHE_PARSER.match(line) is not None:
+                yield line, None, 'match', 'no match'
+            continue
+        for key in ApacheLine.keys:
+            if key == 'timestamp':
+                dt = reference['time_received_datetimeobj']
+                referencevalue = (int(dt.strftime('%Y%m%d%H%M%S')), dt.strftime('%Y-%m-%d'))
+            else:
+                referencevalue = reference.get(key)
+            if fast.get(key) != referencevalue:
+                yield line, key, fast.get(key), referencevalue
+
+
 def parse_line(line, mode):
     if mode == "apache":
-        parsed_line = line_parser(line)
+        parsed_line = apache_line_parser(line)
     elif mode == "nginx":
         parsed_line = nginx_line_parser(line)
     return parsed_line
 
 
-def parselog(logfiles):
-    data = {
-        'names': set(),
-        'hitsperday': defaultdict(dict),
-        'typestats': defaultdict(lambda: defaultdict(int)),
-        'platformstats': defaultdict(lambda: defaultdict(int)),
-        'countrystats': defaultdict(lambda: defaultdict(int)),
-        'totalhits': defaultdict(int),
-        'lamachine': defaultdict(list),
-        'lamachinetotal': 0,
-        'latest': "",
-    }
-    loaddata('lamastats.json', data)
-    latest = data['latest']
-    newhits = 0
-    for logfile in logfiles:
-        mode, logfile = get_mode(logfile)
-        print("[parselog] Reading " + logfile + " (" + mode + ")",file=sys.stderr)
-        if logfile[-3:] == '.gz':
-            f = gzip.open(logfile,'rt',encoding='utf-8')
-        else:
-            f = open(logfile,'r',encoding='utf-8')
-        for line in f:
-            if line.find('lamachinetracker') != -1:
-                parsed_line = parse_line(line, mode)
-                if parsed_line['request_url'].startswith("/lamachinetracker.php/"):
-                    args = parsed_line['request_url'][len("/lamachinetracker.php/"):]
-                    args = args.split('/')
-                    if len(args) == 4:
-                        form, mode,stabledev,pythonversion = args
-                    elif len(args) == 7:
-                        form, mode,stabledev,pythonversion,os_id, distrib_id,distrib_release  = args
-                    else:
-                        print("- skipping invalid lamachinetracker: " + "/".join(args), file=sys.stderr)
-                        continue
-
-                    dt = parsed_line['time_received_datetimeobj']
-                    dts = dt.strftime('%Y-%m-%d %H:%M:%S')
-                    date = dt.date().strftime('%Y-%m-%d')
-                    if dts < data['latest']:
-                        continue #already counted
-                    elif dts > latest:
-                        latest = dts
-
-                    useragent, bot = parseuseragent(parsed_line)
-                    if bot:
-                        continue
-
-                    ip = parsed_line['remote_host']
-                    if ip in ignoreips:
-                        continue
-
-                    country = 'unknown'
-                    try:
-                        country = gi.country_code_by_addr(ip)
-                    except:
-                        pass
-
-                    hit = {
-                        'form': form,
-                        'mode': mode,
-                        'stabledev': stabledev,
-                        'pythonversion': pythonversion,
-                        'ip': ip,
-                        'os': os_id,
-                        'distrib': distrib_id + ' ' + distrib_release,
-                        'country':country,
-                        'internal': ip in internalips or ininternalblock(ip),
-                    }
-                    #print("DEBUG hit:", hit,file=sys.stderr)
-
-                    exists = False
-                    if not date in data['lamachine']:
-                        data['lamachine'][date] = []
-                    for prevhit in data['lamachine'][date]:
-                        if hit == prevhit:
-                            exists = True
-                            break
-
-                    if not exists:
-                        print("- Adding LaMachine hit: ", hit, file=sys.stderr)
-                        newhits += 1
-                        data['lamachine'][date].append(hit)
-                        data['lamachinetotal'] += 1
-
-
-            elif line.find('lamabadge') != -1:
-                parsed_line = line_parser(line)
-                #print("DEBUG parsed_line:",parsed_line, file=sys.stderr)
-                if parsed_line['request_url'].startswith("/lamabadge.php/"):
-                    name = parsed_line['request_url'][len("/lamabadge.php/"):]
-                    if '/' in name or name.find('php') != -1  or ' ' in name or len(name) > 25:
-                        #some poor man's validation
-                        print("- skipping name " + name, file=sys.stderr)
-                        continue
-
-                    data['names'].add(name)
-                    dt = parsed_line['time_received_datetimeobj']
-                    dts = dt.strftime('%Y-%m-%d %H:%M:%S')
-                    date = dt.date().strftime('%Y-%m-%d')
-                    if dts < data['latest']:
-                        continue #already counted
-                    elif dts > latest:
-                        latest = dts
-
-                    if 'request_header_referer' in parsed_line:
-                        referer = parsed_line['request_header_referer']
-                    else:
-                        referer = ""
-                    ip = parsed_line['remote_host']
-                    if ip in ignoreips:
-                        continue
-
-                    proxied = False
-                    useragent, bot = parseuseragent(parsed_line)
-                    if bot:
-                        continue
-                    if useragent.lower().find("camo") != -1 or useragent.lower().find("github") != -1:
-                        hittype = 'github'
-                        ip = '0.0.0.0' #irrelevant, proxied
-                        proxied = True
-                    elif referer.find("github.io") != -1:
-                        hittype = 'ghpages'
-                    else:
-                        hittype = 'unknown'
-
-                    if useragent.lower().find('android') != -1:
-                        platform = 'android'
-                    elif useragent.lower().find('linux') != -1:
-                        platform = 'linux'
-                    elif useragent.lower().find('ios') != -1:
-                        platform = 'ios'
-                    elif useragent.lower().find('mac os x') != -1:
-                        platform = 'mac'
-                    elif useragent.lower().find('bsd') != -1:
-                        platform = 'bsd'
-                    elif useragent.lower().find('windows') != -1:
-                        platform = 'windows'
-                    else:
-                        platform = 'unknown'
-
-
-                    country = 'unknown'
-                    if not proxied:
-                        try:
-                            country = gi.country_code_by_addr(ip)
-                        except:
-                            pass
-
-                    hit = {
-                        'type': hittype,
-                        'ip': ip,
-                        'unique': hittype not in ('github',),
-                        'platform': platform,
-                        'country':country,
-                        'internal': ip in internalips or ininternalblock(ip),
-                    }
-                    #print("DEBUG hit:", hit,file=sys.stderr)
-
-                    exists = False
-                    if not date in data['hitsperday'][name]:
-                        data['hitsperday'][name][date] = []
-                    elif not proxied:
-                        for prevhit in data['hitsperday'][name][date]:
-                            if hit == prevhit:
-                                exists = True
-                                break
-
-                    if not exists:
-                        newhits += 1
-                        print("- Adding ", hit, file=sys.stderr)
-                        data['hitsperday'][name][date].append(hit) #register the hit
-                        if not name in data['totalhits']: data['totalhits'][name] = 0
-                        data['totalhits'][name] += 1
-                        if not hittype in data['typestats'][name]: data['typestats'][name][hittype] = 0
-                        data['typestats'][name][hittype] += 1
-                        if not platform in data['platformstats'][name]: data['platformstats'][name][platform] = 0
-                        data['platformstats'][name][platform] += 1
-                        if not country in data['countrystats'][name]: data['countrystats'][name][country] = 0
-                        data['countrystats'][name][country] += 1
-
-        f.close()
-    data['latest'] = latest
-
+def savedata(filename, data, label):
     #sometimes writing breaks (not sure if due to script abortion), so we first buffer to a file, check integrity and then move it to the final place
-    with open('lamastats.json.new','w',encoding='utf-8') as f:
+    with open(filename + '.new','w',encoding='utf-8') as f:
         json.dump(data, f, cls=PythonObjectEncoder)
+        f.flush()
+        os.fsync(f.fileno())
     #verify integrity
-    with open('lamastats.json.new','r',encoding='utf-8') as f:
+    with open(filename + '.new','r',encoding='utf-8') as f:
         try:
             json.load(f)
-            os.rename('lamastats.json.new', 'lamastats.json')
+            os.rename(filename + '.new', filename)
+            return True
         except:
-            print("[parselog] lamastats.json INTEGRITY CHECK FAILED!",file=sys.stderr)
-
-    print("[parselog] " + str(newhits) + " new hits",file=sys.stderr)
-    return data
-
-
-def parseclamlog(logfiles):
-    data = {
-        'names': set(),
-        'projectsperday_internal': defaultdict(lambda: defaultdict(int)),
-        'projectsperday': defaultdict(lambda: defaultdict(int)),
-        'totalprojects': defaultdict(int),
-        'latest': "",
-    }
-    loaddata('clamstats.json', data)
-    line_parser = apache_log_parser.make_parser("%h %l %u %t \"%r\" %>s %b \"%{Referer}i\" \"%{User-agent}i\"")
-    latest = data['latest']
-    newhits = 0
-    for logfile in sorted(logfiles):
-        mode, logfile = get_mode(logfile)
-        print("[parseclamlog] Reading " + logfile,file=sys.stderr)
-        if logfile[-3:] == '.gz':
-            f = gzip.open(logfile,'rt',encoding='utf-8')
-        else:
-            f = open(logfile,'r',encoding='utf-8')
-        for line in f:
-            found = False
-            if line.find('/actions/') != -1:
-                try:
-                    parsed_line = parse_line(line, mode)
-                except Exception as e:
-                    print("ERROR!! UNABLE TO PARSE LINE : " ,line, "\nException:",e, file=sys.stderr)
-                    continue
-                #print("DEBUG parsed_line:",parsed_line, file=sys.stderr)
-                if parsed_line['request_method'] in ('GET','POST','PUT') and parsed_line['status'] == '200':
-                    fields = parsed_line['request_url'].strip('/').split('/')
-                    if not fields or line.find('lamawebcheck') != -1:
-                        continue
-                    name = fields[0]
-                    found = True
-            elif line.find('PUT') != -1:
-                try:
-                    parsed_line = parse_line(line, mode)
-                except Exception as e:
-                    print("ERROR!! UNABLE TO PARSE LINE : " ,line, "\nException:",e, file=sys.stderr)
-                    continue
-                #print("DEBUG parsed_line:",parsed_line, file=sys.stderr)
-                if parsed_line['request_method'] == 'PUT' and parsed_line['status'] == '201':
-                    #found a 'project created' entry
-                    fields = parsed_line['request_url'].strip('/').split('/')
-                    if len(fields) != 2 or line.find('lamawebcheck') != -1:
-                        continue
-                    name = fields[0]
-                    found = True
-            if found:
-                data['names'].add(name)
-                dt = parsed_line['time_received_datetimeobj']
-                dts = dt.strftime('%Y-%m-%d %H:%M:%S')
-                date = dt.date().strftime('%Y-%m-%d')
-                if dts < data['latest']:
-                    continue #already counted
-                elif dts > latest:
-                    latest = dts
-
-                ip = parsed_line['remote_host']
-                if ip in ignoreips:
-                    continue
-
-                if ip in internalips or ininternalblock(ip):
-                    if not date in data['projectsperday_internal'][name]: data['projectsperday_internal'][name][date] = 0
-                    data['projectsperday_internal'][name][date] += 1
-                newhits += 1
-                if not date in data['projectsperday'][name]: data['projectsperday'][name][date] = 0
-                data['projectsperday'][name][date] += 1
-                if not name in data['totalprojects']: data['totalprojects'][name] = 0
-                data['totalprojects'][name] += 1
-
-    data['latest'] = latest
-    #sometimes writing breaks (not sure if due to script abortion), so we first buffer to a file, check integrity and then move it to the final place
-    with open('clamstats.json.new','w',encoding='utf-8') as f:
-        json.dump(data, f, cls=PythonObjectEncoder)
-    #verify integrity
-    with open('clamstats.json.new','r',encoding='utf-8') as f:
+            diagnostics.error('integrity', "[%s] %s INTEGRITY CHECK FAILED!", label, filename)
+            return False
+
+
+HEADSIZE = 4096 #number of bytes at the start of a logfile that are hashed to recognise it
+
+class LogFile:
+    """A logfile on disk, identified by its inode, size, modification time and a hash of its first block"""
+
+    def __init__(self, path, mode="apache"):
+        self.path = os.path.abspath(path)
+        self.mode = mode
+        st = os.stat(self.path)
+        self.inode = st.st_ino
+        self.size = st.st_size
+        self.mtime = st.st_mtime_ns
+        self._codec = None
+        self.heads = {}
+
+    @property
+    def codec(self):
+        if self._codec is None:
+            self._codec = detectcodec(self.path)
+        return self._codec
+
+    @property
+    def compressed(self):
+        return self.codec != 'plain'
+
+    def head(self, size=HEADSIZE):
+        if size not in self.heads:
+            with open(self.path,'rb') as f:
+                self.heads[size] = hashlib.sha1(f.read(size)).hexdigest()
+        return self.heads[size]
+
+    def matches(self, entry):
+        """Is this the file that the registry entry describes? Only opens the file if the inode matches but size or modification time changed"""
+        if entry['inode'] != self.inode:
+            return False
+        if entry['size'] == self.size and entry['mtime'] == self.mtime:
+            return True
+        return entry['headsize'] <= self.size and self.head(entry['headsize']) == entry['head']
+
+    def fingerprint(self, offset):
+        headsize = min(self.size, HEADSIZE)
+        return {
+            'inode': self.inode,
+            'size': self.size,
+            'mtime': self.mtime,
+            'headsize': headsize,
+            'head': self.head(headsize),
+            'codec': self.codec,
+            'offset': offset,
+        }
+
+    def lines(self, offset=0):
+        """Yields the raw byte lines, from the given byte offset onwards for uncompressed files"""
+        return readlines(self.path, self.codec, offset)
+
+
+class LogLine:
+    """A single log line, parsed lazily and at most once no matter how many trackers look at it"""
+
+    __slots__ = ('line', 'mode', 'source', '_parsed')
+
+    def __init__(self, line, mode, source=None):
+        self.line = line
+        self.mode = mode
+        self.source = source #see sourcename()
+        self._parsed = None
+
+    def parsed(self):
+        if self._parsed is None:
+            self._parsed = parse_line(self.line, self.mode)
+        return self._parsed
+
+
+class Tracker:
+    """Base class for all trackers. A tracker owns its state file and aggregates the log lines that are routed to it by scanlogs()"""
+
+    label = "tracker"
+    statefile = None
+    keywords = () #substrings a line must contain for processline() to be interested in it, None means every line
+
+    def __init__(self, load=True, store=None):
+        self.data = self.initdata()
+        self.data['logregistry'] = {} #path => fingerprint and consumed byte offset of every ingested logfile
+        self.data['seq'] = 0 #sequence number of the last journal record that is contained in the state file
+        self.data['watermarks'] = {} #log source (see sourcename()) => timestamp of its latest line
+        self.data['legacywatermark'] = None #the global watermark of state from before the per source watermarks, see below
+        self.store = store #database (see sqlitestore.py) that holds the state instead of the state file; the tracker then only keeps the data since its last save
+        self.silent = False #do not report new hits: set for the chunks of scanchunk() (their hits are reported when they are merged) and for journal replays
+        self.compact = False #fold the journal into the state file on the next save, regardless of its size
+        self.retention = None #keep the full records of the hits of this many days (counted back from the latest hit), older days are only kept as daily counts; None keeps everything
+        self.newhits = 0
+        if load and store is not None:
+            store.load(self)
+        elif load:
+            loaddata(self.statefile, self.data)
+            self.loaded()
+        self.latest = timestampkey(self.data['latest'])
+        self.sources = { source: timestampkey(latest) for source, latest in self.data['watermarks'].items() } #log source => key of its latest line
+        self.seq = self.data['seq']
+        self.delta = self.initdelta()
+        self.journalend = 0 #size of the intact part of the journal, see save()
+        if load and store is None:
+            self.replay()
+        #lines older than the watermark of their source were counted in an earlier run
+        self.watermarks = dict(self.sources)
+        legacy = self.data['legacywatermark']
+        if legacy is None and not self.sources and self.latest:
+            #state from before the per source watermarks only has the global one; it holds for the sources known then until each has a watermark of its own (see finish())
+            legacy = self.data['legacywatermark'] = { 'latest': self.data['latest'], 'sources': sorted({ sourcename(path) for path in self.data['logregistry'] }) }
+            self.compact = True #the journal records do not carry it, write it to the state file on the next save
+        self.watermark = timestampkey(legacy['latest']) if legacy else 0 #for sources without a watermark of their own
+        self.savedregistry = dict(self.data['logregistry'])
+        self.newhits = 0
+
+    def initdata(self):
+        raise NotImplementedError
+
+    def loaded(self):
+        """Called after the state file was loaded, before the journal is replayed"""
+        pass
+
+    def initdelta(self):
+        """Returns an empty delta: the changes since the last save, in the form of a partial() result so merge() can replay them from the journal"""
+        raise NotImplementedError
+
+    def replay(self):
+        """Applies the journal records that are newer than the state file. A damaged end of the journal is ignored but left in place: it may be a record that another process is still writing, and only save() cuts it off."""
+        journal = journalfile(self.statefile)
+        if not os.path.exists(journal):
+            return
+        end = 0
+        replayed = 0
+        self.silent = True
+        for record, end in readrecords(journal, PythonObjectDecoder):
+            if record['seq'] <= self.seq:
+                continue #already folded into the state file
+            self.merge(record['delta'])
+            self.data['logregistry'] = record['logregistry']
+            self.seq = record['seq']
+            replayed += 1
+        self.silent = False
+        self.journalend = end
+        if end < os.path.getsize(journal):
+            diagnostics.info('journal', "[%s] Ignoring the damaged or incomplete end of %s", self.label, journal)
+        self.data['latest'] = timestampstr(self.latest)
+        self.delta = self.initdelta()
+        diagnostics.note("[" + self.label + "] Replayed " + str(replayed) + " journal record(s) from " + journal)
+
+    def save(self):
+        """Appends the changes since the last save to the journal, or writes a full snapshot of the state if there is none yet or the journal is due for compaction. With a store, the changes are written to the database instead."""
+        if self.store is not None:
+            self.newhits = self.store.save(self)
+            self.clear()
+            return
+        journal = journalfile(self.statefile)
+        if self.compact or not os.path.exists(self.statefile) or needscompaction(self.statefile, journal):
+            self.data['seq'] = self.seq
+            if savedata(self.statefile, self.data, self.label) and os.path.exists(journal):
+                os.unlink(journal)
+                self.journalend = 0
+            self.compact = False
+        elif self.newhits or self.data['logregistry'] != self.savedregistry:
+            self.seq += 1
+            self.delta['latest'] = self.latest
+            self.delta['sources'] = self.sources
+            if os.path.exists(journal) and os.path.getsize(journal) > self.journalend:
+                #a torn record of an interrupted run, new records must not be appended after it
+                diagnostics.warning('journal', "[%s] Discarding the damaged end of %s", self.label, journal)
+                truncate(journal, self.journalend)
+            self.journalend += appendrecord(journal, { 'seq': self.seq, 'delta': self.delta, 'logregistry': self.data['logregistry'] }, PythonObjectEncoder)
+        self.delta = self.initdelta()
+        self.savedregistry = dict(self.data['logregistry'])
+
+    def clear(self):
+        """Drops the aggregated data after it was written to the store, keeping what is needed to continue ingesting"""
+        keep = { key: self.data[key] for key in ('names', 'latest', 'logregistry', 'seq', 'watermarks', 'legacywatermark') if key in self.data }
+        self.data = self.initdata()
+        self.data.update(keep)
+        self.delta = self.initdelta()
+        self.savedregistry = dict(self.data['logregistry'])
+
+    def cutoff(self):
+        """Returns the first day (a 'YYYY-MM-DD' key) whose full hit records are kept under the retention policy, or None if everything is kept"""
+        if self.retention is None or not self.latest:
+            return None
+        latest = datetime.strptime(str(self.latest)[:8], '%Y%m%d').date()
+        return datestr(latest - timedelta(days=self.retention - 1))
+
+    def expire(self, cutoff):
+        """Drops the full hit records of the days before the cutoff, for trackers that keep them"""
+        pass
+
+    def processline(self, logline):
+        raise NotImplementedError
+
+    def parse(self, logline):
         try:
-            json.load(f)
-            os.rename('clamstats.json.new', 'clamstats.json')
-        except:
-            print("[parselog] clamstats.json INTEGRITY CHECK FAILED!",file=sys.stderr)
-    print("[parseclamlog] " + str(newhits) + " new hits",file=sys.stderr)
-    return data
-
-def parseflatlog(logfile):
-    data = {
-        'readdocumentsperday': defaultdict(int),
-        'wrotedocumentsperday': defaultdict(int),
-        'editsperday': defaultdict(int),
-        'latest': "",
-    }
-    loaddata('flatstats.json', data)
-    latest = data['latest']
-    newhits = 0
-    print("[parseflatlog] Reading " + logfile,file=sys.stderr)
-    if logfile[-3:] == '.gz':
-        f = gzip.open(logfile,'rt',encoding='utf-8')
-    else:
-        f = open(logfile,'r',encoding='utf-8')
-    for line in f:
+            return logline.parsed()
+        except Exception as e:
+            stats.count(self.label, 'parseerrors')
+            diagnostics.warning('parseerror', "ERROR!! UNABLE TO PARSE LINE : %s\nException: %s", logline.line.rstrip('\n'), e)
+            return None
+
+    def checktime(self, parsed_line, source=None):
+        """Checks the timestamp of a line against the watermark of its source, returns its date key or None if the hit was already counted in an earlier run"""
+        try:
+            key, date = linetimestamp(parsed_line)
+        except ValueError as e:
+            stats.count(self.label, 'parseerrors')
+            diagnostics.warning('parseerror', "ERROR!! UNABLE TO PARSE TIMESTAMP : %s", e)
+            return None
+        if not self.checkkey(key, source):
+            return None
+        return date
+
+    def checkkey(self, key, source):
+        """Checks a timestamp key against the watermark of the source, returns False if the line was already counted in an earlier run"""
+        if key < self.watermarks.get(source, self.watermark):
+            stats.count(self.label, 'belowwatermark')
+            return False #already counted
+        if key > self.latest:
+            self.latest = key
+        if key > self.sources.get(source, 0):
+            self.sources[source] = key
+        return True
+
+    def checkpoint(self, logfile):
+        """Returns the byte offset from which the logfile still has to be read by this tracker, or None if it was fully ingested already"""
+        registry = self.data['logregistry']
+        entry = registry.get(logfile.path)
+        if entry is None or not logfile.matches(entry):
+            #the file may have been renamed by logrotate (access.log -> access.log.1)
+            entry = None
+            for candidate in registry.values():
+                if logfile.matches(candidate):
+                    entry = candidate
+                    break
+        if entry is None:
+            return 0 #new file, or the file was replaced
+        codec = entry['codec'] if 'codec' in entry else logfile.codec #entries from before the codec was recorded need the file opened
+        if codec != 'plain':
+            #compressed logs are immutable rotated archives, we can not seek in them so they are either done or rescanned
+            return None if entry['size'] == logfile.size else 0
+        if logfile.size < entry['offset']:
+            return 0 #truncated (copytruncate)
+        if logfile.size == entry['offset']:
+            return None
+        return entry['offset']
+
+    def partial(self):
+        """Returns the aggregates of a worker (see scanchunk()) as a picklable partial result for merge()"""
+        raise NotImplementedError
+
+    def merge(self, partial):
+        if partial['latest'] > self.latest:
+            self.latest = partial['latest']
+        for source, key in partial.get('sources',{}).items():
+            if key > self.sources.get(source, 0):
+                self.sources[source] = key
+
+    def register(self, logfile, offset):
+        self.data['logregistry'][logfile.path] = logfile.fingerprint(offset)
+
+    def finish(self):
+        #forget about logfiles that have been removed (rotated out)
+        for path in list(self.data['logregistry'].keys()):
+            if not os.path.exists(path):
+                del self.data['logregistry'][path]
+        self.data['latest'] = timestampstr(self.latest)
+        self.data['watermarks'] = { source: timestampstr(key) for source, key in self.sources.items() }
+        legacy = self.data['legacywatermark']
+        if legacy is not None and legacy['sources'] and all(source in self.sources for source in legacy['sources']):
+            #every source known before the per source watermarks has one of its own now, sources without one are new
+            self.data['legacywatermark'] = None
+            self.watermark = 0
+            self.compact = True
+        cutoff = self.cutoff()
+        if cutoff is not None and self.store is None:
+            self.expire(cutoff) #a store expires hits itself, once they are written
+        self.save()
+        stats.count(self.label, 'newhits', self.newhits)
+        diagnostics.note("[" + self.label + "] " + str(self.newhits) + " new hits")
+        self.newhits = 0 #reported, the next finish() (when following) only counts the hits since this one
+
+
+BADGEDIMENSIONS = ('type', 'platform', 'country')
+LAMACHINEFIELDS = ('form', 'mode', 'stabledev', 'pythonversion', 'os', 'distrib', 'country')
+#fields of the stored hit records (see lamastats.hitstore), in the order in which they are written to the state file
+BADGEHITFIELDS = ('type', 'ip', 'unique', 'platform', 'country', 'internal')
+LAMACHINEHITFIELDS = ('form', 'mode', 'stabledev', 'pythonversion', 'ip', 'os', 'distrib', 'country', 'internal')
+
+def rollup(cubes, date, hit, dimensions=()):
+    """Counts a hit in the rollup cube of its date: a total, the internal hits, and the hits per value of each of the dimensions"""
+    cube = cubes.get(date)
+    if cube is None:
+        cube = cubes[date] = { 'total': 0, 'internal': 0 }
+        for dimension in dimensions:
+            cube[dimension] = {}
+    cube['total'] += 1
+    if hit['internal']:
+        cube['internal'] += 1
+    for dimension in dimensions:
+        counts = cube[dimension]
+        value = hit[dimension]
+        if not value in counts: counts[value] = 0
+        counts[value] += 1
+
+
+def visitorsketch(sketches, date):
+    sketch = sketches.get(date)
+    if sketch is None:
+        sketch = sketches[date] = HyperLogLog()
+    return sketch
+
+
+class LamaTracker(Tracker):
+    """Tracks software badges and LaMachine installations, both are stored in lamastats.json"""
+
+    label = "parselog"
+    statefile = 'lamastats.json'
+    keywords = ('lamachinetracker', 'lamabadge')
+
+    def __init__(self, load=True, store=None):
+        #hash indices of hit fingerprints (their rows of codes) for duplicate detection, keyed by (name, date) and date respectively; not stored, built lazily from the hit lists
+        self.hitindex = {}
+        self.lamachineindex = {}
+        self.codebooks = Codebooks() #of the hit lists of this tracker only, so the values of dropped hits can be forgotten
+        super().__init__(load, store)
+        if (self.data['hitsperday'] and not self.data['rollup']) or (self.data['lamachine'] and not self.data['lamachinerollup']) or any('form' not in cube for cube in self.data['lamachinerollup'].values()):
+            self.rebuildrollup() #state from before the rollup cube (or its LaMachine fields) existed
+            self.compact = True #write the migrated state on the next save, rather than rebuilding it on every load
+        if (self.data['hitsperday'] or self.data['lamachine']) and not self.data['visitors'] and not self.data['lamachinevisitors']:
+            self.rebuildvisitors() #state from before the visitor sketches existed
+            self.compact = True
+
+    def fingerprints(self, index, key, hits):
+        fingerprints = index.get(key)
+        if fingerprints is None:
+            fingerprints = index[key] = set(hits.rows())
+        return fingerprints
+
+    def loaded(self):
+        #the state file has plain lists of hits, keep them as compact hit lists
+        data = self.data
+        badgeschema = self.codebooks.schema(BADGEHITFIELDS)
+        lamachineschema = self.codebooks.schema(LAMACHINEHITFIELDS)
+        for hitsperday in data['hitsperday'].values():
+            for date, hits in hitsperday.items():
+                hitsperday[date] = HitList(badgeschema, hits)
+        for date, hits in data['lamachine'].items():
+            data['lamachine'][date] = HitList(lamachineschema, hits)
+
+    def initdata(self):
+        return {
+            'names': set(),
+            'hitsperday': defaultdict(dict), #name => date => HitList
+            'typestats': defaultdict(lambda: defaultdict(int)),
+            'platformstats': defaultdict(lambda: defaultdict(int)),
+            'countrystats': defaultdict(lambda: defaultdict(int)),
+            'totalhits': defaultdict(int),
+            'lamachine': {}, #date => HitList
+            'lamachinetotal': 0,
+            'rollup': defaultdict(dict), #name => date => cube (see rollup())
+            'lamachinerollup': {}, #date => cube, with the LAMACHINEFIELDS as dimensions
+            'lamachinestats': defaultdict(dict), #field => value => all-time count
+            'visitors': defaultdict(dict), #name => date => HyperLogLog of the IPs of the (not proxied) hits
+            'lamachinevisitors': {}, #date => HyperLogLog of the IPs
+            'latest': "",
+        }
+
+    def initdelta(self):
+        return {
+            'names': self.data['names'],
+            'hitsperday': defaultdict(lambda: defaultdict(list)),
+            'lamachine': defaultdict(list),
+        }
+
+    def clear(self):
+        super().clear()
+        self.hitindex = {}
+        self.lamachineindex = {}
+        self.codebooks = Codebooks()
+
+    def rebuildrollup(self):
+        diagnostics.note("[" + self.label + "] Building rollup cube from stored hits")
+        data = self.data
+        data['rollup'] = defaultdict(dict)
+        for name, hitsperday in data['hitsperday'].items():
+            for date, hits in hitsperday.items():
+                for hit in hits:
+                    rollup(data['rollup'][name], date, hit, BADGEDIMENSIONS)
+        data['lamachinerollup'] = {}
+        data['lamachinestats'] = defaultdict(dict)
+        for date, hits in data['lamachine'].items():
+            for hit in hits:
+                self.rolluplamachine(date, hit)
+
+    def rebuildvisitors(self):
+        diagnostics.note("[" + self.label + "] Building visitor sketches from stored hits")
+        for name, hitsperday in self.data['hitsperday'].items():
+            for date, hits in hitsperday.items():
+                for hit in hits:
+                    if hit['type'] != 'github':
+                        visitorsketch(self.data['visitors'][name], date).add(hit['ip'])
+        for date, hits in self.data['lamachine'].items():
+            for hit in hits:
+                visitorsketch(self.data['lamachinevisitors'], date).add(hit['ip'])
+
+    def rolluplamachine(self, date, hit):
+        rollup(self.data['lamachinerollup'], date, hit)
+        cube = self.data['lamachinerollup'][date]
+        for field in LAMACHINEFIELDS:
+            if field in hit:
+                value = hit[field]
+                for counts in (cube.setdefault(field, {}), self.data['lamachinestats'][field]):
+                    if not value in counts: counts[value] = 0
+                    counts[value] += 1
+
+    def expire(self, cutoff):
+        #the rollup cubes keep the daily counts of the expired days
+        data = self.data
+        expired = 0
+        for name, hitsperday in data['hitsperday'].items():
+            for date in [ date for date in hitsperday if date < cutoff ]:
+                expired += len(hitsperday.pop(date))
+                self.hitindex.pop((name, date), None)
+        for date in [ date for date in data['lamachine'] if date < cutoff ]:
+            expired += len(data['lamachine'].pop(date))
+            self.lamachineindex.pop(date, None)
+        if expired:
+            #forget the values (e.g. the IPs) that only the expired hits had; the fingerprints are in the old codes
+            self.codebooks = Codebooks()
+            recode([ hits for hitsperday in data['hitsperday'].values() for hits in hitsperday.values() ] + list(data['lamachine'].values()), self.codebooks)
+            self.hitindex = {}
+            self.lamachineindex = {}
+            stats.count(self.label, 'expired', expired)
+            diagnostics.note("[" + self.label + "] Compacted " + str(expired) + " hit(s) from before " + cutoff + " into daily counts")
+
+    def processline(self, logline):
+        line = logline.line
+        if line.find('lamachinetracker') != -1:
+            self.processlamachine(logline)
+        elif line.find('lamabadge') != -1:
+            self.processbadge(logline)
+
+    def processlamachine(self, logline):
+        data = self.data
+        parsed_line = self.parse(logline)
+        if parsed_line is None or not parsed_line['request_url'].startswith("/lamachinetracker.php/"):
+            return
+        args = parsed_line['request_url'][len("/lamachinetracker.php/"):]
+        args = args.split('/')
+        if len(args) == 4:
+            form, lmmode, stabledev, pythonversion = args
+            os_id = distrib = 'unknown'
+        elif len(args) == 7:
+            form, lmmode, stabledev, pythonversion, os_id, distrib_id, distrib_release  = args
+            distrib = distrib_id + ' ' + distrib_release
+        else:
+            stats.count(self.label, 'invalid')
+            diagnostics.warning('invalid', "- skipping invalid lamachinetracker: %s", "/".join(args))
+            return
+
+        date = self.checktime(parsed_line, logline.source)
+        if date is None:
+            return
+
+        bot, _, _ = parseuseragent(parsed_line)
+        if bot:
+            stats.count(self.label, 'bots')
+            return
+
+        ip = parsed_line['remote_host']
+        if ip in ignored:
+            stats.count(self.label, 'ignored')
+            return
+
+        country = geoip.country(ip)
+
+        hit = {
+            'form': form,
+            'mode': lmmode,
+            'stabledev': stabledev,
+            'pythonversion': pythonversion,
+            'ip': ip,
+            'os': os_id,
+            'distrib': distrib,
+            'country':country,
+            'internal': ip in internal,
+        }
+        #print("DEBUG hit:", hit,file=sys.stderr)
+
+        self.addlamachinehit(date, hit)
+
+    def addlamachinehit(self, date, hit):
+        data = self.data
+        hits = data['lamachine'].get(date)
+        if hits is None:
+            hits = data['lamachine'][date] = HitList(self.codebooks.schema(LAMACHINEHITFIELDS))
+        fingerprints = self.fingerprints(self.lamachineindex, date, hits)
+        fingerprint = hits.schema.encode(hit)
+
+        if fingerprint not in fingerprints:
+            fingerprints.add(fingerprint)
+            if not self.silent:
+                diagnostics.debug('newhit', "- Adding LaMachine hit: %s", hit)
+            self.newhits += 1
+            hits.appendrow(fingerprint)
+            self.delta['lamachine'][date].append(hit)
+            data['lamachinetotal'] += 1
+            self.rolluplamachine(date, hit)
+            visitorsketch(data['lamachinevisitors'], date).add(hit['ip'])
+
+    def processbadge(self, logline):
+        data = self.data
+        parsed_line = self.parse(logline)
+        #print("DEBUG parsed_line:",parsed_line, file=sys.stderr)
+        if parsed_line is None or not parsed_line['request_url'].startswith("/lamabadge.php/"):
+            return
+        name = parsed_line['request_url'][len("/lamabadge.php/"):]
+        if '/' in name or name.find('php') != -1  or ' ' in name or len(name) > 25:
+            #some poor man's validation
+            stats.count(self.label, 'invalid')
+            diagnostics.warning('invalid', "- skipping name %s", name)
+            return
+
+        data['names'].add(name)
+        date = self.checktime(parsed_line, logline.source)
+        if date is None:
+            return
+
+        if 'request_header_referer' in parsed_line:
+            referer = parsed_line['request_header_referer']
+        else:
+            referer = ""
+        ip = parsed_line['remote_host']
+        if ip in ignored:
+            stats.count(self.label, 'ignored')
+            return
+
+        bot, proxied, platform = parseuseragent(parsed_line)
+        if bot:
+            stats.count(self.label, 'bots')
+            return
+        if proxied:
+            hittype = 'github'
+            ip = '0.0.0.0' #irrelevant, proxied
+        elif referer.find("github.io") != -1:
+            hittype = 'ghpages'
+        else:
+            hittype = 'unknown'
+
+        country = 'unknown'
+        if not proxied:
+            country = geoip.country(ip)
+
+        hit = {
+            'type': hittype,
+            'ip': ip,
+            'unique': hittype not in ('github',),
+            'platform': platform,
+            'country':country,
+            'internal': ip in internal,
+        }
+        #print("DEBUG hit:", hit,file=sys.stderr)
+
+        self.addhit(name, date, hit, proxied)
+
+    def addhit(self, name, date, hit, proxied):
+        data = self.data
+        hittype = hit['type']
+        platform = hit['platform']
+        country = hit['country']
+        hits = data['hitsperday'][name].get(date)
+        if hits is None:
+            hits = data['hitsperday'][name][date] = HitList(self.codebooks.schema(BADGEHITFIELDS))
+        fingerprints = self.fingerprints(self.hitindex, (name, date), hits)
+        fingerprint = hits.schema.encode(hit)
+
+        #proxied hits carry no visitor information, so they are never considered duplicates
+        if proxied or fingerprint not in fingerprints:
+            fingerprints.add(fingerprint)
+            self.newhits += 1
+            if not self.silent:
+                diagnostics.debug('newhit', "- Adding %s", hit)
+            hits.appendrow(fingerprint) #register the hit
+            self.delta['hitsperday'][name][date].append(hit)
+            if not name in data['totalhits']: data['totalhits'][name] = 0
+            data['totalhits'][name] += 1
+            if not hittype in data['typestats'][name]: data['typestats'][name][hittype] = 0
+            data['typestats'][name][hittype] += 1
+            if not platform in data['platformstats'][name]: data['platformstats'][name][platform] = 0
+            data['platformstats'][name][platform] += 1
+            if not country in data['countrystats'][name]: data['countrystats'][name][country] = 0
+            data['countrystats'][name][country] += 1
+            rollup(data['rollup'][name], date, hit, BADGEDIMENSIONS)
+            if not proxied:
+                visitorsketch(data['visitors'][name], date).add(hit['ip'])
+
+    def partial(self):
+        return {
+            'names': self.data['names'],
+            'hitsperday': { name: dict(hitsperday) for name, hitsperday in self.data['hitsperday'].items() },
+            'lamachine': dict(self.data['lamachine']),
+            'latest': self.latest,
+            'sources': self.sources,
+        }
+
+    def merge(self, partial):
+        #replaying the hits in order through the normal add methods gives exactly the hit lists, counters and deduplication of a serial run
+        super().merge(partial)
+        self.data['names'].update(partial['names'])
+        for name, hitsperday in partial['hitsperday'].items():
+            for date, hits in hitsperday.items():
+                for hit in hits:
+                    self.addhit(name, date, hit, hit['type'] == 'github')
+        for date, hits in partial['lamachine'].items():
+            for hit in hits:
+                self.addlamachinehit(date, hit)
+
+
+class ClamTracker(Tracker):
+    """Tracks new projects and actions on CLAM webservices, stored in clamstats.json"""
+
+    label = "parseclamlog"
+    statefile = 'clamstats.json'
+    keywords = ('/actions/', 'PUT')
+
+    def initdata(self):
+        return {
+            'names': set(),
+            'projectsperday_internal': defaultdict(lambda: defaultdict(int)),
+            'projectsperday': defaultdict(lambda: defaultdict(int)),
+            'totalprojects': defaultdict(int),
+            'latest': "",
+        }
+
+    def initdelta(self):
+        return {
+            'names': self.data['names'],
+            'projectsperday': defaultdict(lambda: defaultdict(int)),
+            'projectsperday_internal': defaultdict(lambda: defaultdict(int)),
+        }
+
+    def processline(self, logline):
+        data = self.data
+        line = logline.line
+        if line.find('/actions/') != -1:
+            parsed_line = self.parse(logline)
+            if parsed_line is None:
+                return
+            #print("DEBUG parsed_line:",parsed_line, file=sys.stderr)
+            if parsed_line['request_method'] in ('GET','POST','PUT') and parsed_line['status'] == '200':
+                fields = parsed_line['request_url'].strip('/').split('/')
+                if not fields or line.find('lamawebcheck') != -1:
+                    return
+                name = fields[0]
+            else:
+                return
+        elif line.find('PUT') != -1:
+            parsed_line = self.parse(logline)
+            if parsed_line is None:
+                return
+            #print("DEBUG parsed_line:",parsed_line, file=sys.stderr)
+            if parsed_line['request_method'] == 'PUT' and parsed_line['status'] == '201':
+                #found a 'project created' entry
+                fields = parsed_line['request_url'].strip('/').split('/')
+                if len(fields) != 2 or line.find('lamawebcheck') != -1:
+                    return
+                name = fields[0]
+            else:
+                return
+        else:
+            return
+
+        data['names'].add(name)
+        date = self.checktime(parsed_line, logline.source)
+        if date is None:
+            return
+
+        ip = parsed_line['remote_host']
+        if ip in ignored:
+            stats.count(self.label, 'ignored')
+            return
+
+        self.addprojects(name, date, 1, 1 if ip in internal else 0)
+
+    def addprojects(self, name, date, count, internalcount):
+        data = self.data
+        if internalcount:
+            if not date in data['projectsperday_internal'][name]: data['projectsperday_internal'][name][date] = 0
+            data['projectsperday_internal'][name][date] += internalcount
+            self.delta['projectsperday_internal'][name][date] += internalcount
+        self.delta['projectsperday'][name][date] += count
+        self.newhits += count
+        if not date in data['projectsperday'][name]: data['projectsperday'][name][date] = 0
+        data['projectsperday'][name][date] += count
+        if not name in data['totalprojects']: data['totalprojects'][name] = 0
+        data['totalprojects'][name] += count
+
+    def partial(self):
+        return {
+            'names': self.data['names'],
+            'projectsperday': { name: dict(projectsperday) for name, projectsperday in self.data['projectsperday'].items() },
+            'projectsperday_internal': { name: dict(projectsperday) for name, projectsperday in self.data['projectsperday_internal'].items() },
+            'latest': self.latest,
+            'sources': self.sources,
+        }
+
+    def merge(self, partial):
+        super().merge(partial)
+        self.data['names'].update(partial['names'])
+        for name, projectsperday in partial['projectsperday'].items():
+            for date, count in projectsperday.items():
+                self.addprojects(name, date, count, partial['projectsperday_internal'].get(name,{}).get(date,0))
+
+
+class FlatTracker(Tracker):
+    """Tracks document reads, writes and edits in FLAT, from the foliadocserve log, stored in flatstats.json"""
+
+    label = "parseflatlog"
+    statefile = 'flatstats.json'
+    keywords = None
+
+    def initdata(self):
+        return {
+            'readdocumentsperday': defaultdict(int),
+            'wrotedocumentsperday': defaultdict(int),
+            'editsperday': defaultdict(int),
+            'latest': "",
+        }
+
+    def initdelta(self):
+        return { key: defaultdict(int) for key in ('readdocumentsperday', 'wrotedocumentsperday', 'editsperday') }
+
+    def processline(self, logline):
+        data = self.data
+        line = logline.line
         if len(line) > 22 and line[20] == "-":
             date = line[:10] #date string only
-            dts = line[:19] #full date time string
-            if dts < data['latest']:
-                continue #already counted
-            elif dts > latest:
-                latest = dts
+            try:
+                key = timestampkey(line[:19]) #full date time
+            except ValueError:
+                stats.count(self.label, 'parseerrors')
+                return
+            if not self.checkkey(key, logline.source):
+                return #already counted
             msg = line[22:]
             if msg.startswith("Loading "):
-                newhits += 1
-                if not date in data['readdocumentsperday']: data['readdocumentsperday'][date] = 0
-                data['readdocumentsperday'][date] += 1
+                self.addevents('readdocumentsperday', date, 1)
             elif msg.startswith("Saving "):
-                newhits += 1
-                if not date in data['wrotedocumentsperday']: data['wrotedocumentsperday'][date] = 0
-                data['wrotedocumentsperday'][date] += 1
+                self.addevents('wrotedocumentsperday', date, 1)
             elif msg.startswith("[QUERY ON ") and (msg.find("EDIT ") != -1 or msg.find("ADD ") != -1 or msg.find("DELETE ") != -1):
-                newhits += 1
-                if not date in data['editsperday']: data['editsperday'][date] = 0
-                data['editsperday'][date] += 1
-    data['latest'] = latest
-    #sometimes writing breaks (not sure if due to script abortion), so we first buffer to a file, check integrity and then move it to the final place
-    with open('flatstats.json.new','w',encoding='utf-8') as f:
-        json.dump(data, f, cls=PythonObjectEncoder)
-    #verify integrity
-    with open('flatstats.json.new','r',encoding='utf-8') as f:
-        try:
-            json.load(f)
-            os.rename('flatstats.json.new', 'flatstats.json')
-        except:
-            print("[parselog] flatstats.json INTEGRITY CHECK FAILED!",file=sys.stderr)
-    print("[parseflatlog] " + str(newhits) + " new hits",file=sys.stderr)
-    return data
-
-
-
-
-
-def counttype(hits, hittype):
-    count = 0
-    for hit in hits:
-        if hit['type'] == hittype:
-            count += 1
-    return str(count)
-
-def countinternal(hits):
-    count = 0
-    for hit in hits:
-        if hit['internal']:
-            count += 1
-    return str(count)
+                self.addevents('editsperday', date, 1)
+
+    def addevents(self, key, date, count):
+        self.newhits += count
+        if not date in self.data[key]: self.data[key][date] = 0
+        self.data[key][date] += count
+        self.delta[key][date] += count
+
+    def partial(self):
+        partial = { key: dict(self.data[key]) for key in ('readdocumentsperday', 'wrotedocumentsperday', 'editsperday') }
+        partial['latest'] = self.latest
+        partial['sources'] = self.sources
+        return partial
+
+    def merge(self, partial):
+        super().merge(partial)
+        for key in ('readdocumentsperday', 'wrotedocumentsperday', 'editsperday'):
+            for date, count in partial[key].items():
+                self.addevents(key, date, count)
+
+
+def compileprefilter(trackers):
+    """Compiles one regular expression matching any line that at least one of the trackers is interested in, returns None if all lines are of interest"""
+    keywords = set()
+    for tracker in trackers:
+        if tracker.keywords is None:
+            return None
+        keywords.update(tracker.keywords)
+    #the prefilter runs on the raw bytes, so most lines are rejected before they are ever decoded
+    return re.compile(b"|".join(re.escape(keyword.encode('utf-8')) for keyword in sorted(keywords)))
+
+
+class RangeScan:
+    """Iterates over the lines of logfile between byte offsets start and end (None for EOF) that pass the prefilter, as (logline, trackers) tuples where trackers are those whose checkpoint the line is at or beyond. Afterwards, position is the offset up to which the file was consumed. An unterminated last line is left for later if keeptail is set (see livetail())."""
+
+    def __init__(self, logfile, checkpoints, prefilter, start=0, end=None, keeptail=True):
+        self.logfile = logfile
+        self.checkpoints = checkpoints
+        self.prefilter = prefilter
+        self.start = self.position = start
+        self.end = end
+        self.keeptail = keeptail
+        self.source = sourcename(logfile.path)
+
+    def __iter__(self):
+        logfile = self.logfile
+        checkpoints = self.checkpoints
+        end = self.end
+        source = self.source
+        position = self.start
+        keeptail = self.keeptail and not logfile.compressed
+        search = self.prefilter.search if self.prefilter is not None else None
+        if stats.timing:
+            if search is not None:
+                search = stats.timed('prefilter', search)
+        read = rejected = routedall = 0
+        routed = [0] * len(checkpoints)
+        alltrackers = [ tracker for tracker, _ in checkpoints ]
+        resumed = max( (offset for _, offset in checkpoints), default=0) #beyond this offset, every line goes to all trackers
+        with closing(logfile.lines(self.start)) as lines:
+            for line in (stats.timediterator('read', lines) if stats.timing else lines):
+                if end is not None and position >= end:
+                    break
+                if line[-1:] != b'\n' and keeptail:
+                    break #incomplete last line that may still be being written, pick it up next time
+                lineoffset = position
+                position += len(line)
+                self.position = position
+                read += 1
+                if search is not None and search(line) is None:
+                    rejected += 1
+                    continue
+                logline = LogLine(line.decode('utf-8', errors='replace'), logfile.mode, source)
+                if lineoffset >= resumed:
+                    routedall += 1
+                    yield logline, alltrackers
+                else:
+                    trackers = []
+                    for i, (tracker, offset) in enumerate(checkpoints):
+                        if lineoffset >= offset:
+                            routed[i] += 1
+                            trackers.append(tracker)
+                    yield logline, trackers
+        stats.count('scan', 'lines', read)
+        stats.count('scan', 'bytes', position - self.start)
+        stats.count('scan', 'prefilterrejects', rejected)
+        for (tracker, _), n in zip(checkpoints, routed):
+            stats.count(tracker.label, 'lines', n + routedall)
+
+
+def scanrange(logfile, checkpoints, prefilter, start=0, end=None, keeptail=True):
+    """Routes the lines of logfile between byte offsets start and end (None for EOF) to the trackers, each tracker only gets lines at or beyond its own checkpoint. Returns the offset up to which the file was consumed."""
+    scan = RangeScan(logfile, checkpoints, prefilter, start, end, keeptail)
+    for logline, trackers in scan:
+        for tracker in trackers:
+            tracker.processline(logline)
+    return scan.position
+
+
+def linetimekey(line):
+    """Returns the timestamp key of the first [dd/Mon/yyyy:HH:MM:SS in a log line, or None"""
+    i = line.find('[')
+    if i == -1:
+        return None
+    try:
+        return decodetimestamp(line[i+1:i+21])[0]
+    except ValueError:
+        return None
+
+
+def timestamped(scans):
+    """Yields the (logline, trackers) tuples of the scans of one source in order, prefixed with the timestamp key of the line; lines without a timestamp get the key of the line before them"""
+    key = 0
+    for scan in scans:
+        for logline, trackers in scan:
+            linekey = linetimekey(logline.line)
+            if linekey is not None:
+                key = linekey
+            yield key, logline, trackers
+
+
+def scanserial(scans):
+    """Routes the lines of the scans (RangeScan) to their trackers. The logfiles of a source are read in the given order; the lines of different sources (e.g. the logs of several web servers) are merged by timestamp, with a heap that holds one pending line per source, so the trackers see them in time order."""
+    sources = {}
+    for scan in scans:
+        sources.setdefault(scan.source, []).append(scan)
+    if len(sources) == 1:
+        lines = chain.from_iterable(scans)
+    else:
+        lines = ( (logline, trackers) for _, logline, trackers in heapq.merge(*[ timestamped(scans) for scans in sources.values() ], key=itemgetter(0)) )
+    for logline, trackers in lines:
+        for tracker in trackers:
+            tracker.processline(logline)
+
+
+CHUNKSIZE = 64 * 1024 * 1024 #uncompressed logfiles are split into chunks of at least this many bytes for parallel ingestion
+
+def chunkboundaries(logfile, start, chunksize=None):
+    """Splits an uncompressed logfile from start onwards into (start, end) byte ranges that are aligned to line boundaries, the last range is open-ended"""
+    if chunksize is None:
+        chunksize = CHUNKSIZE
+    boundaries = []
+    if not logfile.compressed:
+        with open(logfile.path,'rb') as f:
+            while start + chunksize < logfile.size:
+                f.seek(start + chunksize)
+                f.readline()
+                end = f.tell()
+                if end >= logfile.size:
+                    break
+                boundaries.append( (start, end) )
+                start = end
+    boundaries.append( (start, None) )
+    return boundaries
+
+
+def enabletiming():
+    """Installs the stage timers (see lamastats.instrumentation) by wrapping the functions of each stage, reading and prefiltering are timed by scanrange() itself"""
+    global parse_line, writereports
+    if stats.timing:
+        return
+    stats.timing = True
+    parse_line = stats.timed('parse', parse_line)
+    geoip.country = stats.timed('geoip', geoip.country)
+    LamaTracker.addhit = stats.timed('dedup', LamaTracker.addhit)
+    LamaTracker.addlamachinehit = stats.timed('dedup', LamaTracker.addlamachinehit)
+    Tracker.save = stats.timed('save', Tracker.save)
+    writereports = stats.timed('report', writereports)
+
+
+def initworker(ignore, internal, blocks, rules=UARULES, format=NGINX_FORMAT, timing=False, level=INFO, samples=5):
+    global ignoreips, internalips, internalblocks, uarules, nginxlogformat, nginxformat
+    ignoreips, internalips, internalblocks, uarules = ignore, internal, blocks, rules
+    nginxlogformat, nginxformat = format, None
+    compileclassifiers()
+    stats.reset() #a forked worker starts with a copy of the counters of its parent
+    diagnostics.reset()
+    diagnostics.configure(level, samples, collect=True) #the messages are written by the parent
+    if timing:
+        enabletiming()
+
+
+def scanchunk(task):
+    """Worker for parallel ingestion: aggregates one chunk of a logfile into fresh trackers that do not load any state, returns the consumed offset, their partial results and the instrumentation counters"""
+    trackerclasses, path, mode, offsets, watermarks, start, end, keeptail = task
+    trackers = []
+    for trackerclass, (watermark, sourcewatermarks) in zip(trackerclasses, watermarks):
+        tracker = trackerclass(load=False)
+        tracker.watermark = watermark
+        tracker.watermarks = sourcewatermarks
+        tracker.silent = True
+        trackers.append(tracker)
+    logfile = LogFile(path, mode)
+    position = scanrange(logfile, list(zip(trackers, offsets)), compileprefilter(trackers), start, end, keeptail)
+    return position, [ tracker.partial() for tracker in trackers ], stats.snapshot(), diagnostics.snapshot()
+
+
+def livetail(logfile, trackers, following=False):
+    """Can the writer of the logfile still complete an unterminated last line? Not if the file is a rotated one or a compressed archive, which no longer grow, nor if the live file did not change since the trackers last checkpointed it (the line was left for later then). When the live file is followed, it can."""
+    if logfile.compressed or sourcename(logfile.path) != logfile.path:
+        return False
+    if following:
+        return True
+    entries = [ tracker.data['logregistry'].get(logfile.path) for tracker in trackers ]
+    return not any( entry is not None and entry['size'] == logfile.size and entry['mtime'] == logfile.mtime for entry in entries )
+
+
+def scanlogs(logfiles, trackers, jobs=1, following=False):
+    """Reads all logfiles in a single pass and routes every line to all trackers, then saves the state of each tracker. Logfiles of different sources are merged in time order (see scanserial()). With jobs > 1, logfiles (and chunks of large uncompressed logfiles) are aggregated in parallel worker processes and the partial results are merged in order. Following means the live logfiles are followed afterwards (see follow()), which picks up their unterminated last lines once they are complete."""
+    prefilter = compileprefilter(trackers)
+    #establish all checkpoints before reading anything, so files that logrotate renamed are still recognised
+    plan = []
+    for logfile in logfiles:
+        mode, logfile = get_mode(logfile)
+        logfile = LogFile(logfile, mode)
+        plan.append( (logfile, [ (tracker, tracker.checkpoint(logfile)) for tracker in trackers ]) )
+    tasks = []
+    scans = []
+    for logfile, checkpoints in plan:
+        checkpoints = [ (tracker, offset) for tracker, offset in checkpoints if offset is not None ]
+        if not checkpoints:
+            diagnostics.note("[scanlogs] Skipping " + logfile.path + " (already ingested)")
+            continue
+        start = min(offset for _, offset in checkpoints)
+        diagnostics.note("[scanlogs] Reading " + logfile.path + " (" + logfile.mode + ") from offset " + str(start))
+        keeptail = livetail(logfile, trackers, following)
+        if jobs > 1:
+            tasks.append( (logfile, checkpoints, start, keeptail) )
+        else:
+            scans.append(RangeScan(logfile, checkpoints, prefilter, start, keeptail=keeptail))
+    if scans:
+        scanserial(scans)
+        for scan in scans:
+            for tracker, _ in scan.checkpoints:
+                tracker.register(scan.logfile, scan.position)
+    if tasks:
+        scanparallel(tasks, trackers, jobs)
+    for tracker in trackers:
+        tracker.finish()
+    return trackers
+
+
+def scanparallel(tasks, trackers, jobs):
+    from concurrent.futures import ProcessPoolExecutor
+    diagnostics.flush() #before the workers are forked
+    #load what is otherwise loaded on first use before the workers are forked, so it is loaded once and shared instead of loaded by every worker
+    if any(isinstance(tracker, LamaTracker) for tracker in trackers):
+        geoip.db
+    if any(logfile.mode == 'apache' and not all(isinstance(tracker, FlatTracker) for tracker, _ in checkpoints) for logfile, checkpoints, _, _ in tasks):
+        apachelogparser() #for the unusual lines that the specialised parser leaves to it
+    chunks = []
+    for logfile, checkpoints, start, keeptail in tasks:
+        for chunkstart, chunkend in chunkboundaries(logfile, start):
+            chunks.append( (logfile, checkpoints, chunkstart, chunkend, keeptail) )
+    with ProcessPoolExecutor(max_workers=jobs, initializer=initworker, initargs=(ignoreips, internalips, internalblocks, uarules, nginxlogformat, stats.timing, diagnostics.level, diagnostics.samples)) as executor:
+        results = executor.map(scanchunk, [
+            ( [ tracker.__class__ for tracker, _ in checkpoints ], logfile.path, logfile.mode, [ offset for _, offset in checkpoints ], [ (tracker.watermark, tracker.watermarks) for tracker, _ in checkpoints ], chunkstart, chunkend, keeptail )
+            for logfile, checkpoints, chunkstart, chunkend, keeptail in chunks
+        ])
+        #merge deterministically in file and chunk order, as a serial run would have seen the lines
+        for (logfile, checkpoints, chunkstart, chunkend, _), (position, partials, snapshot, messages) in zip(chunks, results):
+            stats.merge(snapshot)
+            diagnostics.merge(messages)
+            for (tracker, _), partial in zip(checkpoints, partials):
+                tracker.merge(partial)
+            if chunkend is None:
+                for tracker, _ in checkpoints:
+                    tracker.register(logfile, position)
+
+
+def routelines(lines, mode, source, trackers, prefilter):
+    stats.count('scan', 'lines', len(lines))
+    for line in lines:
+        if prefilter is not None and prefilter.search(line) is None:
+            stats.count('scan', 'prefilterrejects')
+            continue
+        logline = LogLine(line.decode('utf-8', errors='replace'), mode, source)
+        for tracker in trackers:
+            stats.count(tracker.label, 'lines')
+            tracker.processline(logline)
+
+
+def follow(sources, interval=60.0, pollinterval=1.0, onsave=None, onupdate=None, lock=None):
+    """Keeps following the uncompressed logfiles after scanlogs() caught up with them. Sources is a list of (logfiles, trackers) tuples. The trackers stay in memory and new lines are applied as they arrive, after which onupdate() is called if there were new hits; their state is persisted, and onsave() called, at most once per interval (in seconds). If a lock is given, it is held while the trackers are modified or saved. Runs until interrupted."""
+    if lock is None:
+        lock = nullcontext()
+    tails = []
+    alltrackers = []
+    for logfiles, trackers in sources:
+        alltrackers += trackers
+        prefilter = compileprefilter(trackers)
+        for logfile in logfiles:
+            mode, path = get_mode(logfile)
+            path = os.path.abspath(path)
+            if os.path.exists(path) and detectcodec(path) != 'plain':
+                continue #compressed archives do not grow
+            offsets = [ tracker.data['logregistry'][path]['offset'] for tracker in trackers if path in tracker.data['logregistry'] ]
+            tails.append( (TailedFile(path, min(offsets) if offsets else 0), mode, trackers, prefilter) )
+    if not tails:
+        diagnostics.note("[follow] No uncompressed logfiles to follow", WARNING)
+        return
+    watcher = LogWatcher([ tail.filename for tail, _, _, _ in tails ], pollinterval)
+    diagnostics.note("[follow] Following " + str(len(tails)) + " logfile(s) (" + watcher.mode + ")")
+
+    def persist():
+        with lock:
+            for tracker in alltrackers:
+                tracker.finish()
+            if onsave is not None:
+                onsave()
+        diagnostics.flush()
+
+    dirty = False
+    lastsave = time.time()
+    try:
+        while True:
+            for tail, mode, trackers, prefilter in tails:
+                lines = tail.readlines()
+                if lines:
+                    with lock:
+                        newhits = sum(tracker.newhits for tracker in trackers)
+                        routelines(lines, mode, sourcename(tail.filename), trackers, prefilter)
+                        dirty = True
+                        try:
+                            logfile = LogFile(tail.filename, mode)
+                        except FileNotFoundError:
+                            logfile = None
+                        if logfile is not None and logfile.inode == tail.inode:
+                            for tracker in trackers:
+                                tracker.register(logfile, tail.position)
+                    if onupdate is not None and sum(tracker.newhits for tracker in trackers) != newhits:
+                        onupdate()
+            now = time.time()
+            if dirty and now - lastsave >= interval:
+                persist()
+                dirty = False
+                lastsave = now
+            watcher.wait(interval - (now - lastsave) if dirty else interval)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if dirty:
+            persist()
+        watcher.close()
+        for tail, _, _, _ in tails:
+            tail.close()
+
+
+def parselog(logfiles, jobs=1):
+    tracker, = scanlogs(logfiles, [LamaTracker()], jobs)
+    return tracker.data
+
+
+def parseclamlog(logfiles, jobs=1):
+    tracker, = scanlogs(logfiles, [ClamTracker()], jobs)
+    return tracker.data
+
+
+def parseflatlog(logfile, jobs=1):
+    tracker, = scanlogs([logfile], [FlatTracker()], jobs)
+    return tracker.data
 
 
 
@@ -488,79 +1765,137 @@ def startdates():
         yield startdate, label
 
 
-def hitsperdaygraph(name, hitsperday):
-    total = len(hitsperday)
+def rollupseries(cubes, dates, key, value=None):
+    """Returns a comma separated series of the counts in the rollup cubes for the given dates, key is 'total', 'internal', or a dimension, in which case value selects its count"""
+    series = []
+    for date in dates:
+        cube = cubes.get(datestr(date))
+        if cube is None:
+            series.append('0')
+        elif value is None:
+            series.append(str(cube[key]))
+        else:
+            series.append(str(cube[key].get(value,0)))
+    return ",".join(series)
+
+def rollupcounts(cubes, dimension):
+    """Sums the counts of one dimension over all rollup cubes"""
+    counts = defaultdict(int)
+    for cube in cubes.values():
+        for value, count in cube[dimension].items():
+            counts[value] += count
+    return counts
+
+def visitorseries(sketches, dates):
+    """Returns a comma separated series of the estimated distinct visitors on each of the given dates"""
+    return ",".join( str(sketches[datestr(date)].count()) if datestr(date) in sketches else '0' for date in dates )
+
+def visitorcount(sketches, since=None):
+    """Estimates the distinct visitors over the days from since (a date key, None for all time), from the union of their sketches"""
+    return union( sketch for date, sketch in sketches.items() if since is None or date >= since ).count()
+
+def visitorstable(sketches, title):
+    pastdate7 = (datetime.now() - timedelta(7)).strftime('%Y-%m-%d')
+    pastdate30 = (datetime.now() - timedelta(30)).strftime('%Y-%m-%d')
+    yield "<h3>" + title + "</h3>"
+    yield "<table>\n"
+    yield "<tr><th>All time</th><th>Last 30 days</th><th>Last 7 days</th></tr>"
+    yield "<tr>" + "".join( "<td>" + str(visitorcount(sketches, since)) + "</td>" for since in (None, pastdate30, pastdate7) ) + "</tr>\n"
+    yield "</table>\n"
+
+def daytotal(v):
+    #a day in a totaltable() source is either a rollup cube or a plain count
+    return v if isinstance(v, int) else v['total']
+
+def hitsperdaygraph(name, rollup, visitors):
     enddate = datetime.now().date()
-    out = ""
     for i, (startdate, label) in enumerate(startdates()):
         dates = daterange(startdate,enddate)
         divisor = 1
-        out +=  "<h4>" + label + "</h4>\n"
-        out +=  "       <div class=\"legend\">Legend: <strong><span style=\"color: black\">Total</span></strong> <em>(including other sources)</em>, <strong><span style=\"color: green\">Github</span></strong> <em>(not unique! no source info!)</em>, <strong><span style=\"color: blue\">Website</span></strong>, <strong><span style=\"color: red\">Radboud internal</span></strong></div>"
-        out += "<div class=\"ct-chart ct-double-octave\" id=\"" + name + "-hitsperday-" + str(i) + "\"></div>\n"
-        out += "<script>\n"
-        out += "new Chartist.Line('#" +name + "-hitsperday-" + str(i) + "', {\n"
-        out += "   labels: " + graphlabels(startdate,enddate) + ",\n"
-        out += "   series: [\n"
-        out += "        [" + ",".join((str(len(hitsperday.get(datestr(date),[]))) for date in dates)) + " ],\n"
-        out += "        [" + ",".join((countinternal(hitsperday.get(datestr(date),{})) for date in dates)) + " ],\n"
-        out += "        [" + ",".join((counttype(hitsperday.get(datestr(date),{}),'ghpages') for date in dates)) + " ],\n"
-        out += "        [" + ",".join((counttype(hitsperday.get(datestr(date),{}),'github') for date in dates)) + " ]\n"
-        out += "   ]\n"
-        out += "},{ axisX: { scaleMinSpace: 20 }, axisY: { onlyInteger: true}, fullWidth: true, low: 0, lineSmooth: Chartist.Interpolation.cardinal({tension: 0.5, fillHoles: false}) } );\n"
-        out += "</script>\n"
-    return out
-
-def installsperdaygraph(hitsperday):
-    total = len(hitsperday)
+        yield  "<h4>" + label + "</h4>\n"
+        yield  "       <div class=\"legend\">Legend: <strong><span style=\"color: black\">Total</span></strong> <em>(including other sources)</em>, <strong><span style=\"color: green\">Github</span></strong> <em>(not unique! no source info!)</em>, <strong><span style=\"color: blue\">Website</span></strong>, <strong><span style=\"color: red\">Radboud internal</span></strong>, <strong><span style=\"color: purple\">Unique visitors</span></strong> <em>(estimated)</em></div>"
+        yield "<div class=\"ct-chart ct-double-octave\" id=\"" + name + "-hitsperday-" + str(i) + "\"></div>\n"
+        yield "<script>\n"
+        yield "new Chartist.Line('#" +name + "-hitsperday-" + str(i) + "', {\n"
+        yield "   labels: " + graphlabels(startdate,enddate) + ",\n"
+        yield "   series: [\n"
+        yield "        [" + rollupseries(rollup, dates, 'total') + " ],\n"
+        yield "        [" + rollupseries(rollup, dates, 'internal') + " ],\n"
+        yield "        [" + rollupseries(rollup, dates, 'type', 'ghpages') + " ],\n"
+        yield "        [" + rollupseries(rollup, dates, 'type', 'github') + " ],\n"
+        yield "        [" + visitorseries(visitors, dates) + " ]\n"
+        yield "   ]\n"
+        yield "},{ axisX: { scaleMinSpace: 20 }, axisY: { onlyInteger: true}, fullWidth: true, low: 0, lineSmooth: Chartist.Interpolation.cardinal({tension: 0.5, fillHoles: false}) } );\n"
+        yield "</script>\n"
+
+def installsperdaygraph(rollup, visitors):
     enddate = datetime.now().date()
-    out = ""
     for i, (startdate, label) in enumerate(startdates()):
         dates = daterange(startdate,enddate)
         labels = graphlabels(startdate, enddate)
         divisor = 1
-        out +=  "<h4>" + label + "</h4>\n"
-        out +=  "       <div class=\"legend\">Legend: <strong><span style=\"color: black\">Total</span></strong>, <strong><span style=\"color: red\">Radboud internal</span></strong></div>"
-        out += "<div class=\"ct-chart ct-double-octave\" id=\"lamachine-installsperday-" + str(i) + "\"></div>\n"
-        out += "<script>\n"
-        out += "new Chartist.Line('#lamachine-installsperday-" + str(i) + "', {\n"
-        out += "   labels: " + labels + ",\n"
-        out += "   series: [\n"
-        out += "        [" + ",".join((str(len(hitsperday.get(datestr(date),[]))) for date in dates)) + " ],\n"
-        out += "        [" + ",".join((countinternal(hitsperday.get(datestr(date),{})) for date in dates)) + " ]\n"
-        out += "   ]\n"
-        out += "},{ axisX: { divisor: " + str(divisor) + ", scaleMinSpace: 20 }, axisY: { onlyInteger: true}, fullWidth: true, low: 0, lineSmooth: Chartist.Interpolation.cardinal({tension: 0.5, fillHoles: false}) } );\n"
-        out += "</script>\n"
-    return out
+        yield  "<h4>" + label + "</h4>\n"
+        yield  "       <div class=\"legend\">Legend: <strong><span style=\"color: black\">Total</span></strong>, <strong><span style=\"color: red\">Radboud internal</span></strong>, <strong><span style=\"color: blue\">Unique IPs</span></strong> <em>(estimated)</em></div>"
+        yield "<div class=\"ct-chart ct-double-octave\" id=\"lamachine-installsperday-" + str(i) + "\"></div>\n"
+        yield "<script>\n"
+        yield "new Chartist.Line('#lamachine-installsperday-" + str(i) + "', {\n"
+        yield "   labels: " + labels + ",\n"
+        yield "   series: [\n"
+        yield "        [" + rollupseries(rollup, dates, 'total') + " ],\n"
+        yield "        [" + rollupseries(rollup, dates, 'internal') + " ],\n"
+        yield "        [" + visitorseries(visitors, dates) + " ]\n"
+        yield "   ]\n"
+        yield "},{ axisX: { divisor: " + str(divisor) + ", scaleMinSpace: 20 }, axisY: { onlyInteger: true}, fullWidth: true, low: 0, lineSmooth: Chartist.Interpolation.cardinal({tension: 0.5, fillHoles: false}) } );\n"
+        yield "</script>\n"
 
 def projectsperdaygraph(name, projectsperday, projectsperday_internal):
-    def counttype(hits, hittype):
-        count = 0
-        for hit in hits:
-            if hit['type'] == hittype:
-                count += 1
-        return str(count)
-
-    total = len(projectsperday)
     enddate = datetime.now().date()
-    out = ""
     for i, (startdate, label) in enumerate(startdates()):
         dates = daterange(startdate,enddate)
         labels = graphlabels(startdate, enddate)
         divisor = 1
-        out +=  "<h4>" + label + "</h4>\n"
-        out +=  "       <div class=\"legend\">Legend: <strong><span style=\"color: black\">Total new projects/actions per day</span></strong> <em>(including other sources)</em>, <strong><span style=\"color: red\">By internal sources</span></strong></div>"
-        out += "<div class=\"ct-chart ct-double-octave\" id=\"" + name + "-projectsperday-" + str(i) + "\"></div>\n"
-        out += "<script>\n"
-        out += "new Chartist.Line('#" +name + "-projectsperday-" + str(i) + "', {\n"
-        out += "   labels: " + labels + ",\n"
-        out += "   series: [\n"
-        out += "        [" + ",".join((str(projectsperday.get(datestr(date),0)) for date in dates)) + " ],\n"
-        out += "        [" + ",".join((str(projectsperday_internal.get(datestr(date),0)) for date in dates)) + " ],\n"
-        out += "   ]\n"
-        out += "},{ axisX: { divisor: " + str(divisor) + ", scaleMinSpace: 20 }, axisY: { onlyInteger: true}, fullWidth: true, low: 0, lineSmooth: Chartist.Interpolation.cardinal({tension: 0.5, fillHoles: false}) } );\n"
-        out += "</script>\n"
-    return out
+        yield  "<h4>" + label + "</h4>\n"
+        yield  "       <div class=\"legend\">Legend: <strong><span style=\"color: black\">Total new projects/actions per day</span></strong> <em>(including other sources)</em>, <strong><span style=\"color: red\">By internal sources</span></strong></div>"
+        yield "<div class=\"ct-chart ct-double-octave\" id=\"" + name + "-projectsperday-" + str(i) + "\"></div>\n"
+        yield "<script>\n"
+        yield "new Chartist.Line('#" +name + "-projectsperday-" + str(i) + "', {\n"
+        yield "   labels: " + labels + ",\n"
+        yield "   series: [\n"
+        yield "        [" + ",".join((str(projectsperday.get(datestr(date),0)) for date in dates)) + " ],\n"
+        yield "        [" + ",".join((str(projectsperday_internal.get(datestr(date),0)) for date in dates)) + " ],\n"
+        yield "   ]\n"
+        yield "},{ axisX: { divisor: " + str(divisor) + ", scaleMinSpace: 20 }, axisY: { onlyInteger: true}, fullWidth: true, low: 0, lineSmooth: Chartist.Interpolation.cardinal({tension: 0.5, fillHoles: false}) } );\n"
+        yield "</script>\n"
+
+
+class ReportWriter:
+    """Streams the chunks of a report to a temporary file next to its destination, which is only moved into place once the report is complete"""
+
+    def __init__(self, filename, buffersize=1024*1024):
+        self.filename = filename
+        self.tmpfilename = filename + '.tmp'
+        self.buffersize = buffersize
+        self.f = None
+
+    def __enter__(self):
+        self.f = open(self.tmpfilename,'w',encoding='utf-8',buffering=self.buffersize)
+        return self
+
+    def write(self, chunks):
+        for chunk in chunks:
+            self.f.write(chunk)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.f.close()
+        if exc_type is None:
+            os.replace(self.tmpfilename, self.filename)
+        else:
+            os.unlink(self.tmpfilename)
+        return False
+
+def writereport(filename, chunks):
+    with ReportWriter(filename) as writer:
+        writer.write(chunks)
 
 
 def header():
@@ -620,6 +1955,13 @@ def header():
                 stroke: green;
                 stroke-width: 1px;
             }
+            /* unique visitors */
+            .ct-series-e .ct-line,
+            .ct-series-e .ct-point {
+                stroke: purple;
+                stroke-width: 1px;
+                stroke-dasharray: 4px 2px;
+            }
 
             .legend {
                 margin-left: 100px;
@@ -689,222 +2031,343 @@ def nav(track):
     return s
 
 
-def totaltable(data, hits_key='hitsperday', totalhits_key='totalhits'):
+def totaltable(data, hits_key='hitsperday', totalhits_key='totalhits', visitors_key=None):
     pastdate7 = (datetime.now() - timedelta(7)).strftime('%Y-%m-%d')
     pastdate30 = (datetime.now() - timedelta(30)).strftime('%Y-%m-%d')
-    out = "<table>\n"
-    out += "<tr><th>Name</th><th>All time</th><th>Last 30 days</th><th>Avg per day</th><th>Last 7 days</th><th>Avg per day</th></tr>"
-    for name in sorted(data['names'], key= lambda x: -1 * data[totalhits_key][x]):
+    yield "<table>\n"
+    yield "<tr><th>Name</th><th>All time</th><th>Last 30 days</th><th>Avg per day</th><th>Last 7 days</th><th>Avg per day</th>"
+    if visitors_key:
+        yield "<th>Visitors all time</th><th>Last 30 days</th><th>Last 7 days</th>"
+    yield "</tr>"
+    for name in sorted(data['names'], key= lambda x: (-1 * data[totalhits_key][x], x)): #ties are ranked by name, so the order of the rows does not depend on the order in which the names were seen
         if name.strip() and data[totalhits_key][name] >= 10:
-            out += "<tr><th><a href=\"#" + name + "\">" + name + "</a></th>"
-            out += "<td>" + str(data[totalhits_key][name]) + "</td>"
-            total7 = sum( ( v if isinstance(v,int) else len(v) for k,v in data[hits_key][name].items() if k >= pastdate7 ) )
-            total30 = sum( ( v if isinstance(v, int) else len(v) for k,v in data[hits_key][name].items() if k >= pastdate30 ) )
-            out += "<td>" + str(total30) + "</td>"
-            out += "<td class=\"avg\">" + str(round(total30/30,1)) + "</td>"
-            out += "<td>" + str(total7) + "</td>"
-            out += "<td class=\"avg\">" + str(round(total7/7,1)) + "</td>"
-            out += "</tr>\n"
-    out += "</table>\n"
-    return out
+            yield "<tr><th><a href=\"#" + name + "\">" + name + "</a></th>"
+            yield "<td>" + str(data[totalhits_key][name]) + "</td>"
+            total7 = sum( ( daytotal(v) for k,v in data[hits_key][name].items() if k >= pastdate7 ) )
+            total30 = sum( ( daytotal(v) for k,v in data[hits_key][name].items() if k >= pastdate30 ) )
+            yield "<td>" + str(total30) + "</td>"
+            yield "<td class=\"avg\">" + str(round(total30/30,1)) + "</td>"
+            yield "<td>" + str(total7) + "</td>"
+            yield "<td class=\"avg\">" + str(round(total7/7,1)) + "</td>"
+            if visitors_key:
+                sketches = data[visitors_key].get(name,{})
+                for since in (None, pastdate30, pastdate7):
+                    yield "<td>" + str(visitorcount(sketches, since)) + "</td>"
+            yield "</tr>\n"
+    yield "</table>\n"
 
 def outputreport(data, track):
-    out = header()
-    out += nav(track)
-    out += "        <h1>LaMa Software Statistical Report</h1>\n"
-    out += "<section>"
-    out += "<h2>Total</h2>"
-    out += totaltable(data,'hitsperday','totalhits')
-    out += "</section>"
+    yield header()
+    yield nav(track)
+    yield "        <h1>LaMa Software Statistical Report</h1>\n"
+    yield "<section>"
+    yield "<h2>Total</h2>"
+    yield from totaltable(data,'rollup','totalhits','visitors')
+    yield "</section>"
     for name in sorted(data['names'], key= lambda x: x.lower()):
         if name.strip() and data['totalhits'][name] >= 10:
-            out += "<section>\n"
-            out += "        <a name=\"" + name + "\"></a>"
-            out += "        <h2>" + name + "</h2>\n"
-            out += "        <h3>" + name + " - Visits per day</h3>"
-            out += "<div class=\"tablebox\">" + toptable(data['hitsperday'][name],"country","Country",10, False) + "</div>"
-            out += "<div class=\"tablebox\">" + toptable(data['hitsperday'][name],"platform","Platform",10, False) + "</div>"
-            out += hitsperdaygraph(name, data['hitsperday'][name])
-            out += "</section>\n"
-    out += """    </body>
-</html>"""
-    return out
+            yield "<section>\n"
+            yield "        <a name=\"" + name + "\"></a>"
+            yield "        <h2>" + name + "</h2>\n"
+            yield "        <h3>" + name + " - Visits per day</h3>"
+            yield "<div class=\"tablebox\">"
+            yield from toptable(rollupcounts(data['rollup'][name],"country"),"Country",10, False)
+            yield "</div>"
+            yield "<div class=\"tablebox\">"
+            yield from toptable(rollupcounts(data['rollup'][name],"platform"),"Platform",10, False)
+            yield "</div>"
+            yield from hitsperdaygraph(name, data['rollup'][name], data['visitors'].get(name,{}))
+            yield "</section>\n"
+    yield """    </body>
+</html>
+"""
 
 def outputclamreport(data, track):
-    out = header()
-    out += nav(track)
-    out += "        <h1>CLAM Webservice Statistical Report</h1>\n"
-    out += "<section>"
-    out += "<h2>Total</h2>"
-    out += totaltable(data,'projectsperday','totalprojects')
-    out += "</section>"
+    yield header()
+    yield nav(track)
+    yield "        <h1>CLAM Webservice Statistical Report</h1>\n"
+    yield "<section>"
+    yield "<h2>Total</h2>"
+    yield from totaltable(data,'projectsperday','totalprojects')
+    yield "</section>"
     for name in sorted(data['names'], key= lambda x: x.lower()):
-        out += "<section>\n"
-        out += "        <a name=\"" + name + "\"></a>"
-        out += "        <h2>" + name + "</h2>\n"
-        out += "        <h3>" + name + " - New projects per day</h3>"
-        out += projectsperdaygraph(name, data['projectsperday'][name], data['projectsperday_internal'][name])
-        out += "</section>\n"
-    out += """    </body>
-</html>"""
-    return out
-
-
-def toptable(datalist, key, title, n=25, header=True):
+        yield "<section>\n"
+        yield "        <a name=\"" + name + "\"></a>"
+        yield "        <h2>" + name + "</h2>\n"
+        yield "        <h3>" + name + " - New projects per day</h3>"
+        yield from projectsperdaygraph(name, data['projectsperday'][name], data['projectsperday_internal'][name])
+        yield "</section>\n"
+    yield """    </body>
+</html>
+"""
+
+
+def toptable(d, title, n=25, header=True):
     if header:
-        out = "<h3>" + title + "</h3>"
-    else:
-        out = ""
-    out += "<table>\n"
-    d = defaultdict(int)
-    for hits in datalist.values():
-        for hit in hits:
-            if key in hit:
-                d[hit[key]] += 1
+        yield "<h3>" + title + "</h3>"
+    yield "<table>\n"
     total = sum(d.values())
     if not header and title:
-        out += "<tr><th class=\"title\">" + title + "</th><th>Total</th></tr>"
+        yield "<tr><th class=\"title\">" + title + "</th><th>Total</th></tr>"
     else:
-        out += "<tr><th>Name</th><th>Total</th></tr>"
-    for key, value in list(sorted(d.items(), key= lambda x: -1 * x[1]))[:n]:
-        out += "<tr>"
-        out += "<th>" + key+ "</th>"
-        out += "<td>" + str(value) + " (" + str(round((value/total) * 100,2)) +  "%)</td>"
-        out += "</tr>\n"
-    out += "</table>\n"
-    return out
+        yield "<tr><th>Name</th><th>Total</th></tr>"
+    for key, value in list(sorted(d.items(), key= lambda x: (-1 * x[1], str(x[0]))))[:n]: #ties are ranked by name, so the order in which the logs were read does not matter
+        yield "<tr>"
+        yield "<th>" + key+ "</th>"
+        yield "<td>" + str(value) + " (" + str(round((value/total) * 100,2)) +  "%)</td>"
+        yield "</tr>\n"
+    yield "</table>\n"
 
 
 def outputlamachinereport(data, track):
-    out = header()
-    out += nav(track)
-    out += "        <h1>LaMachine Statistical Report</h1>\n"
-    out += "<section>"
-    out += "<h2>General Statistics</h2>"
-    out += toptable(data['lamachine'], 'form','LaMachine Form')
-    out += toptable(data['lamachine'], 'mode','LaMachine Mode')
-    out += toptable(data['lamachine'], 'os','OS (type)')
-    out += toptable(data['lamachine'], 'distrib','OS (exact)')
-    out += toptable(data['lamachine'], 'pythonversion','Python Version')
-    out += toptable(data['lamachine'], 'country','Country')
-    out += "</section>"
-    out += "<section>\n"
-    out += "        <h3>Installations/updates per day</h3>"
-    out += installsperdaygraph(data['lamachine'])
-    out += "</section>\n"
-    out += """    </body>
-</html>"""
-    return out
+    yield header()
+    yield nav(track)
+    yield "        <h1>LaMachine Statistical Report</h1>\n"
+    yield "<section>"
+    yield "<h2>General Statistics</h2>"
+    yield from toptable(data['lamachinestats']['form'],'LaMachine Form')
+    yield from toptable(data['lamachinestats']['mode'],'LaMachine Mode')
+    yield from toptable(data['lamachinestats']['os'],'OS (type)')
+    yield from toptable(data['lamachinestats']['distrib'],'OS (exact)')
+    yield from toptable(data['lamachinestats']['pythonversion'],'Python Version')
+    yield from toptable(data['lamachinestats']['country'],'Country')
+    yield from visitorstable(data['lamachinevisitors'], 'Unique IPs (estimated)')
+    yield "</section>"
+    yield "<section>\n"
+    yield "        <h3>Installations/updates per day</h3>"
+    yield from installsperdaygraph(data['lamachinerollup'], data['lamachinevisitors'])
+    yield "</section>\n"
+    yield """    </body>
+</html>
+"""
 
 def outputflatreport(data, track):
-    out = header(data)
-    out += nav(track)
-    out += "        <h1>FLAT Statistical Report</h1>\n"
-    out += "<section>"
-    out += "<section>\n"
-    out += "        <h3>Documents per day</h3>"
+    yield header()
+    yield nav(track)
+    yield "        <h1>FLAT Statistical Report</h1>\n"
+    yield "<section>"
+    yield "<section>\n"
+    yield "        <h3>Documents per day</h3>"
     total = len(data['readdocumentsperday'])
     enddate = datetime.now().date()
     for i, (startdate, label) in enumerate(startdates()):
         dates = daterange(startdate,enddate)
         labels = graphlabels(startdate, enddate)
         divisor = 1
-        out +=  "<h4>" + label + "</h4>\n"
-        out +=  "       <div class=\"legend\">Legend: <strong><span style=\"color: black\">Documents read per day</span></strong> , <strong><span style=\"color: red\">Documents written per day</span></strong></div>"
-        out += "<div class=\"ct-chart ct-double-octave\" id=\"flat-documentsperday-" + str(i) + "\"></div>\n"
-        out += "<script>\n"
-        out += "new Chartist.Line('#flat-documentsperday-" + str(i) + "', {\n"
-        out += "   labels: " + labels + ",\n"
-        out += "   series: [\n"
-        out += "        [" + ",".join((str(data['readdocumentsperday'].get(datestr(date),0)) for date in dates)) + " ],\n"
-        out += "        [" + ",".join((str(data['wrotedocumentsperday'].get(datestr(date),0)) for date in dates)) + " ],\n"
-        out += "   ]\n"
-        out += "},{ axisX: { divisor: " + str(divisor) + ", scaleMinSpace: 20 }, axisY: { onlyInteger: true}, fullWidth: true, low: 0, lineSmooth: Chartist.Interpolation.cardinal({tension: 0.5, fillHoles: false}) } );\n"
-        out += "</script>\n"
-
-    out += "</section>\n"
-    out += "<section>\n"
-    out += "        <h3>Edits/Annotations per day</h3>"
+        yield  "<h4>" + label + "</h4>\n"
+        yield  "       <div class=\"legend\">Legend: <strong><span style=\"color: black\">Documents read per day</span></strong> , <strong><span style=\"color: red\">Documents written per day</span></strong></div>"
+        yield "<div class=\"ct-chart ct-double-octave\" id=\"flat-documentsperday-" + str(i) + "\"></div>\n"
+        yield "<script>\n"
+        yield "new Chartist.Line('#flat-documentsperday-" + str(i) + "', {\n"
+        yield "   labels: " + labels + ",\n"
+        yield "   series: [\n"
+        yield "        [" + ",".join((str(data['readdocumentsperday'].get(datestr(date),0)) for date in dates)) + " ],\n"
+        yield "        [" + ",".join((str(data['wrotedocumentsperday'].get(datestr(date),0)) for date in dates)) + " ],\n"
+        yield "   ]\n"
+        yield "},{ axisX: { divisor: " + str(divisor) + ", scaleMinSpace: 20 }, axisY: { onlyInteger: true}, fullWidth: true, low: 0, lineSmooth: Chartist.Interpolation.cardinal({tension: 0.5, fillHoles: false}) } );\n"
+        yield "</script>\n"
+
+    yield "</section>\n"
+    yield "<section>\n"
+    yield "        <h3>Edits/Annotations per day</h3>"
     total = len(data['readdocumentsperday'])
     enddate = datetime.now().date()
     for i, (startdate, label) in enumerate(startdates()):
         dates = daterange(startdate,enddate)
         labels = graphlabels(startdate, enddate)
         divisor = 1
-        out +=  "<h4>" + label + "</h4>\n"
-        out +=  "       <div class=\"legend\">Legend: <strong><span style=\"color: black\"> annotations per day</span></strong></div>"
-        out += "<div class=\"ct-chart ct-double-octave\" id=\"flat-editsperday-" + str(i) + "\"></div>\n"
-        out += "<script>\n"
-        out += "new Chartist.Line('#flat-editsperday-" + str(i) + "', {\n"
-        out += "   labels: " + labels + ",\n"
-        out += "   series: [\n"
-        out += "        [" + ",".join((str(data['editsperday'].get(datestr(date),0)) for date in dates)) + " ],\n"
-        out += "   ]\n"
-        out += "},{ axisX: { divisor: " + str(divisor) + ", scaleMinSpace: 20 }, axisY: { onlyInteger: true}, fullWidth: true, low: 0, lineSmooth: Chartist.Interpolation.cardinal({tension: 0.5, fillHoles: false}) } );\n"
-        out += "</script>\n"
-
-    out += "</section>\n"
-    out += """    </body>
-</html>"""
-    return out
-
-def main():
-    global ignoreips, internalips, internalblocks
-    parser = argparse.ArgumentParser(description="Generate Usage Reports", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-    parser.add_argument('-d','--outputdir', type=str,help="Path to output directory", action='store',default="./",required=False)
-    parser.add_argument('-F','--foliadocservelog', type=str,help="Path to FoLiA docserve log", action='store',required=False)
-    parser.add_argument('--ignore','-i', type=str, help="Ignore requests from these IPs (space separated list)", required=False)
+        yield  "<h4>" + label + "</h4>\n"
+        yield  "       <div class=\"legend\">Legend: <strong><span style=\"color: black\"> annotations per day</span></strong></div>"
+        yield "<div class=\"ct-chart ct-double-octave\" id=\"flat-editsperday-" + str(i) + "\"></div>\n"
+        yield "<script>\n"
+        yield "new Chartist.Line('#flat-editsperday-" + str(i) + "', {\n"
+        yield "   labels: " + labels + ",\n"
+        yield "   series: [\n"
+        yield "        [" + ",".join((str(data['editsperday'].get(datestr(date),0)) for date in dates)) + " ],\n"
+        yield "   ]\n"
+        yield "},{ axisX: { divisor: " + str(divisor) + ", scaleMinSpace: 20 }, axisY: { onlyInteger: true}, fullWidth: true, low: 0, lineSmooth: Chartist.Interpolation.cardinal({tension: 0.5, fillHoles: false}) } );\n"
+        yield "</script>\n"
+
+    yield "</section>\n"
+    yield """    </body>
+</html>
+"""
+
+def reportdata(tracker):
+    """Returns the data to report on for a tracker: its state, or the aggregates queried from its store"""
+    if tracker.store is not None:
+        return tracker.store.reportdata(tracker)
+    return tracker.data
+
+
+def writereports(track, outputdir, lamatracker=None, clamtracker=None, flattracker=None):
+    if ('badges' in track or 'lamachine' in track) and lamatracker is not None:
+        data = reportdata(lamatracker)
+        if 'badges' in track:
+            writereport(outputdir + 'lamastats.html', outputreport(data, track))
+        if 'lamachine' in track:
+            writereport(outputdir + 'lamachinestats.html', outputlamachinereport(data, track))
+    if 'clam' in track and clamtracker is not None:
+        writereport(outputdir + 'clamstats.html', outputclamreport(reportdata(clamtracker), track))
+    if 'flat' in track and flattracker is not None:
+        writereport(outputdir + 'flatstats.html', outputflatreport(reportdata(flattracker), track))
+
+
+def addclassificationarguments(parser):
+    parser.add_argument('--ignore','-i', type=str, help="Ignore requests from these IPs or CIDR ranges (space separated list)", required=False)
     parser.add_argument('--internal','-I', type=str, help="Count these IPs as internal (space separated list)", required=False, default="127.0.0.1")
-    parser.add_argument('--internalblocks', type=str, help="Count these IP prefixes as internal (space separated list)", required=False)
-    parser.add_argument('--tracklamachine',help="Track LaMachine stats", action='store_true', required=False)
-    parser.add_argument('--trackbadges',help="Track software badges", action='store_true', required=False)
-    parser.add_argument('--trackclam',help="Track clam webservices", action='store_true', required=False)
-    parser.add_argument('--trackflat',help="Track FLAT (foliadocserve)", action='store_true', required=False)
-    parser.add_argument('logfiles', nargs='+', help='Access logs, prepend filenames with "apache:" for apache, "nginx:" for nginx')
-    args = parser.parse_args()
+    parser.add_argument('--internalblocks', type=str, help="Count these IP prefixes or CIDR ranges as internal (space separated list)", required=False)
+    parser.add_argument('--ignorefile', type=str, help="Ignore requests from the IPs, CIDR ranges or prefixes in this file (one per line)", required=False)
+    parser.add_argument('--internalfile', type=str, help="Count the IPs, CIDR ranges or prefixes in this file (one per line) as internal", required=False)
+    parser.add_argument('--uarules', type=str, help="Classify user agents (bots, proxies and platforms) with the rules in this file instead of the built-in ones; one rule per line: a category ('bot', 'proxy' or a platform name) and the substring to match", required=False)
 
+def applyclassificationarguments(args):
+    global ignoreips, internalips, internalblocks, uarules
     if args.ignore:
         ignoreips = [ x for x in args.ignore.split(" ") if x ]
     if args.internal:
         internalips = [ x for x in args.internal.split(" ") if x ]
     if args.internalblocks:
         internalblocks = [ x for x in args.internalblocks.split(" ") if x ]
+    if args.ignorefile:
+        ignoreips = ignoreips + readiplist(args.ignorefile)
+    if args.internalfile:
+        internalblocks = internalblocks + readiplist(args.internalfile)
+    if args.uarules:
+        uarules = readuarules(args.uarules)
+    compileclassifiers()
+
+
+def adddiagnosticsarguments(parser):
+    parser.add_argument('--loglevel', type=str, choices=tuple(LEVELS), help="Verbosity of the diagnostics (new hits are only shown at debug level)", action='store', default='info', required=False)
+    parser.add_argument('-v','--verbose', help="Increase the verbosity of the diagnostics by one level (can be repeated)", action='count', default=0, required=False)
+    parser.add_argument('-q','--quiet', help="Decrease the verbosity of the diagnostics by one level (can be repeated)", action='count', default=0, required=False)
+    parser.add_argument('--logfile', type=str, help="Append the diagnostics to this file instead of writing them to standard error", action='store', required=False)
+    parser.add_argument('--logsamples', type=int, help="Show at most this many messages of each kind (e.g. skipped bots) per minute, the others are only counted and summarised at the end", action='store', default=5, required=False)
+
+def applydiagnosticsarguments(args):
+    level = min(max(LEVELS[args.loglevel] + args.verbose - args.quiet, min(LEVELS.values())), max(LEVELS.values()))
+    diagnostics.configure(level, args.logsamples, args.logfile)
+
+def addtrackarguments(parser):
+    parser.add_argument('-F','--foliadocservelog', type=str,help="Path to FoLiA docserve log", action='store',required=False)
+    parser.add_argument('--tracklamachine',help="Track LaMachine stats", action='store_true', required=False)
+    parser.add_argument('--trackbadges',help="Track software badges", action='store_true', required=False)
+    parser.add_argument('--trackclam',help="Track clam webservices", action='store_true', required=False)
+    parser.add_argument('--trackflat',help="Track FLAT (foliadocserve)", action='store_true', required=False)
 
-    outputdir = args.outputdir
-    if outputdir[-1] != '/': outputdir += '/'
+def addformatarguments(parser):
+    parser.add_argument('--nginxformat', type=str, help="The log_format of the nginx logs (those prepended with \"nginx:\"), as in the nginx configuration; the remote host is taken from $http_x_forwarded_for if it is set and from $remote_addr otherwise", action='store', default=NGINX_FORMAT, required=False)
 
+def applyformatarguments(args):
+    """Sets the log formats, raises ValueError if a format that was given is not usable"""
+    global nginxlogformat, nginxformat
+    nginxlogformat, nginxformat = args.nginxformat, None
+    if nginxlogformat != NGINX_FORMAT:
+        nginxparser() #compile it now, to report errors before any work is done
 
+def selecttrack(args):
     track = set()
     if args.tracklamachine:
         track.add("lamachine")
-    elif args.trackbadges:
+    if args.trackbadges:
         track.add("badges")
-    elif args.trackclam:
+    if args.trackclam:
         track.add("clam")
-    elif args.trackflat or args.foliadocservelog:
+    if args.trackflat or args.foliadocservelog:
         track.add("flat")
+    return track
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == 'serve':
+        from lamastats.server import main as servemain
+        return servemain(sys.argv[2:])
+    parser = argparse.ArgumentParser(description="Generate Usage Reports (use 'lamastats serve' to run the HTTP server)", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-d','--outputdir', type=str,help="Path to output directory", action='store',default="./",required=False)
+    addtrackarguments(parser)
+    addformatarguments(parser)
+    addclassificationarguments(parser)
+    adddiagnosticsarguments(parser)
+    parser.add_argument('-j','--jobs', type=int, help="Number of worker processes for parallel log ingestion", action='store',default=1,required=False)
+    parser.add_argument('--follow',help="Keep running: follow the (uncompressed) logs as they grow, handling log rotation, and periodically save the state and regenerate the reports", action='store_true', required=False)
+    parser.add_argument('--interval', type=float, help="In --follow mode, save the state and regenerate the reports at most once per this many seconds", action='store',default=60.0,required=False)
+    parser.add_argument('--pollinterval', type=float, help="In --follow mode, check the logs this often (in seconds) when inotify is not available", action='store',default=1.0,required=False)
+    parser.add_argument('--compact', help="Fold the journals into the state files, instead of appending the changes of this run to them", action='store_true', required=False)
+    parser.add_argument('--retention', type=int, help="Keep the full records of the hits (including IP addresses) of this many days, counted back from the latest hit; older days are compacted into daily counts. Reports are not affected.", action='store', required=False)
+    parser.add_argument('--database', type=str, help="Keep the state in this SQLite database instead of in the JSON state files (which are imported into it on first use)", action='store', required=False)
+    parser.add_argument('--stats', type=str, nargs='?', const='-', help="Time the processing stages and write the counters and timings as JSON to this file (standard error if no file is given)", action='store', required=False)
+    parser.add_argument('--profile', type=str, help="Run under cProfile and write the hottest functions to this file (worker processes are not profiled)", action='store', required=False)
+    parser.add_argument('logfiles', nargs='+', help='Access logs, prepend filenames with "apache:" for apache, "nginx:" for nginx')
+    args = parser.parse_args()
+    if args.retention is not None and args.retention < 1:
+        parser.error("--retention must be at least 1 day")
+    try:
+        applyformatarguments(args)
+    except ValueError as e:
+        parser.error(str(e))
+    applyclassificationarguments(args)
+    applydiagnosticsarguments(args)
+
+    outputdir = args.outputdir
+    if outputdir[-1] != '/': outputdir += '/'
+
+
+    track = selecttrack(args)
     if not track:
         print("No tracking options selected",file=sys.stderr)
         sys.exit(2)
 
-    data = parselog(args.logfiles)
-
-    if 'badges' in track:
-        with open(outputdir + '/lamastats.html','w',encoding='utf-8') as f:
-            print(outputreport(data, track), file=f)
-    if 'lamachine' in track:
-        with open(outputdir + '/lamachinestats.html','w',encoding='utf-8') as f:
-            print(outputlamachinereport(data, track), file=f)
-
+    if args.stats:
+        enabletiming()
+    try:
+        if args.profile:
+            profile(lambda: run(args, track, outputdir), args.profile)
+        else:
+            run(args, track, outputdir)
+    finally:
+        diagnostics.summary()
+        diagnostics.close()
+        if args.stats:
+            stats.write(args.stats)
+
+
+def run(args, track, outputdir):
+    #all access log trackers are served by a single pass over the logs
+    trackers = []
+    lamatracker = clamtracker = flattracker = None
+    store = None
+    if args.database:
+        from lamastats.sqlitestore import SQLiteStore
+        store = SQLiteStore(args.database)
+    if 'badges' in track or 'lamachine' in track:
+        lamatracker = LamaTracker(store=store)
+        trackers.append(lamatracker)
     if 'clam' in track:
-        data = parseclamlog(args.logfiles)
-        with open(outputdir + '/clamstats.html','w',encoding='utf-8') as f:
-            print(outputclamreport(data, track), file=f)
-
+        clamtracker = ClamTracker(store=store)
+        trackers.append(clamtracker)
     if 'flat' in track and args.foliadocservelog:
-        data = parseflatlog(args.foliadocservelog)
-        with open(outputdir + '/flatstats.html','w',encoding='utf-8') as f:
-            print(outputflatreport(data, track), file=f)
+        flattracker = FlatTracker(store=store)
+    for tracker in trackers + [flattracker]:
+        if tracker is not None:
+            tracker.compact = tracker.compact or args.compact
+            tracker.retention = args.retention
+    if trackers:
+        scanlogs(args.logfiles, trackers, args.jobs, args.follow)
+    if flattracker is not None:
+        scanlogs([args.foliadocservelog], [flattracker], args.jobs, args.follow)
+
+    render = lambda: writereports(track, outputdir, lamatracker, clamtracker, flattracker)
+    render()
+
+    if args.follow:
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0)) #still save the state on termination
+        sources = []
+        if trackers:
+            sources.append( (args.logfiles, trackers) )
+        if flattracker is not None:
+            sources.append( ([args.foliadocservelog], [flattracker]) )
+        follow(sources, args.interval, args.pollinterval, render)
 
 if __name__ == '__main__':
     main()
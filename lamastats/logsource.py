@@ -0,0 +1,291 @@
+#Log source layer: opens (possibly compressed) logfiles and yields their raw byte lines. Decompression happens outside of the consuming thread, either in a parallel external decompressor or in a background thread, so it overlaps with the parsing of earlier lines.
+
+import io
+import os
+import re
+import sys
+import bz2
+import gzip
+import lzma
+import queue
+import shutil
+import subprocess
+import threading
+import time
+import select
+import ctypes
+import ctypes.util
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+MAGIC = (
+    (b'\x1f\x8b', 'gzip'),
+    (b'BZh', 'bz2'),
+    (b'\xfd7zXZ\x00', 'xz'),
+    (b'\x28\xb5\x2f\xfd', 'zstd'),
+)
+
+#external decompressors in order of preference, they write the decompressed stream to stdout
+DECOMPRESSORS = {
+    'gzip': (['pigz','-dc'], ['gzip','-dc']),
+    'bz2': (['lbzip2','-dc'], ['pbzip2','-dc'], ['bzip2','-dc']),
+    'xz': (['xz','-T0','-dc'],),
+    'zstd': (['zstd','-dc'],),
+}
+
+READSIZE = 4 * 1024 * 1024 #size of the decompressed blocks handed over by the background thread
+BUFFERSIZE = 1024 * 1024 #read buffer for plain files and decompressor pipes
+
+useexternal = True #use external decompressors when they are available
+
+
+def detectcodec(filename):
+    """Determines the compression of a file by its magic bytes, returns 'plain' if it is not compressed"""
+    with open(filename,'rb') as f:
+        magic = f.read(6)
+    for prefix, codec in MAGIC:
+        if magic.startswith(prefix):
+            return codec
+    return 'plain'
+
+
+ROTATIONSUFFIX = re.compile(r'(\.\d+|-\d{8}(\d{2})?)?(\.(gz|bz2|xz|zst))?$')
+
+def sourcename(filename):
+    """Returns the name of the log source (e.g. the access log of one web server) that a logfile belongs to: its absolute path without the suffixes that logrotate adds, so access.log.1 and access.log-20240101.gz are the same source as access.log"""
+    return ROTATIONSUFFIX.sub('', os.path.abspath(filename), count=1)
+
+
+def finddecompressor(codec):
+    if useexternal:
+        for command in DECOMPRESSORS.get(codec,()):
+            if shutil.which(command[0]):
+                return command
+    return None
+
+
+def openstream(filename, codec):
+    """Opens a decompressing binary stream with one of Python's own codec modules"""
+    if codec == 'gzip':
+        return gzip.open(filename,'rb')
+    elif codec == 'bz2':
+        return bz2.open(filename,'rb')
+    elif codec == 'xz':
+        return lzma.open(filename,'rb')
+    elif codec == 'zstd':
+        if zstandard is None:
+            raise IOError("Unable to decompress " + filename + ": install the zstd command line tool or the zstandard Python module")
+        return zstandard.ZstdDecompressor().stream_reader(open(filename,'rb'), closefd=True)
+    raise ValueError("Unknown codec: " + codec)
+
+
+def splitlines(blocks):
+    """Reassembles lines from arbitrary blocks of bytes, lines are split on newlines only and keep them"""
+    rest = b''
+    for block in blocks:
+        end = block.rfind(b'\n')
+        if end == -1:
+            rest += block
+            continue
+        lines = io.BytesIO(rest + block[:end+1]) if rest else io.BytesIO(block[:end+1])
+        yield from lines
+        rest = block[end+1:]
+    if rest:
+        yield rest
+
+
+def threadedblocks(stream, queuesize=8):
+    """Reads decompressed blocks from the stream in a background thread. The codec modules release the GIL while decompressing, so this runs in parallel with the consumer."""
+    blocks = queue.Queue(queuesize)
+    stop = threading.Event()
+    failure = []
+
+    def produce():
+        try:
+            while not stop.is_set():
+                block = stream.read(READSIZE)
+                if not block:
+                    break
+                blocks.put(block)
+        except Exception as e:
+            failure.append(e)
+        finally:
+            blocks.put(None)
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            block = blocks.get()
+            if block is None:
+                break
+            yield block
+        if failure:
+            raise failure[0]
+    finally:
+        stop.set()
+        while thread.is_alive():
+            #unblock the producer if it is waiting for room in the queue
+            try:
+                blocks.get_nowait()
+            except queue.Empty:
+                thread.join(0.01)
+        stream.close()
+
+
+def externallines(command, filename):
+    process = subprocess.Popen(command + [filename], stdout=subprocess.PIPE, bufsize=BUFFERSIZE)
+    completed = False
+    try:
+        yield from process.stdout
+        completed = True
+    finally:
+        if not completed:
+            process.kill()
+        process.stdout.close()
+        returncode = process.wait()
+        if completed and returncode != 0:
+            raise IOError(" ".join(command) + " failed on " + filename + " with exit code " + str(returncode))
+
+
+def readlines(filename, codec='plain', offset=0):
+    """Yields the raw byte lines of a logfile. Plain files may start at a byte offset, compressed files are always read from the start."""
+    if codec == 'plain':
+        with open(filename,'rb',buffering=BUFFERSIZE) as f:
+            if offset:
+                f.seek(offset)
+            yield from f
+        return
+    command = finddecompressor(codec)
+    if command is not None:
+        yield from externallines(command, filename)
+    else:
+        yield from splitlines(threadedblocks(openstream(filename, codec)))
+
+
+class TailedFile:
+    """Follows a growing plain logfile by path, the way tail -F does: it keeps reading the file it has open, and switches to the new file when logrotate moves it away or truncates it"""
+
+    def __init__(self, filename, offset=0):
+        self.filename = filename
+        self.f = None
+        self.inode = None
+        self.position = 0 #byte offset up to which complete lines have been returned
+        self.pending = b'' #incomplete last line
+        self.reopen(offset)
+
+    def reopen(self, offset=0):
+        if self.f is not None:
+            self.f.close()
+        try:
+            self.f = open(self.filename,'rb')
+        except FileNotFoundError:
+            self.f = None #rotated away and not recreated yet
+            self.inode = None
+            return
+        self.inode = os.fstat(self.f.fileno()).st_ino
+        self.f.seek(offset)
+        self.position = offset
+        self.pending = b''
+
+    def drain(self):
+        lines = []
+        if self.f is None:
+            return lines
+        data = self.f.read()
+        if data:
+            data = self.pending + data
+            end = data.rfind(b'\n') + 1
+            self.pending = data[end:]
+            if end:
+                lines.extend(io.BytesIO(data[:end]))
+                self.position += end
+        return lines
+
+    def readlines(self):
+        """Returns all complete lines that were appended since the last call"""
+        lines = self.drain()
+        try:
+            st = os.stat(self.filename)
+        except FileNotFoundError:
+            return lines
+        if st.st_ino != self.inode:
+            #rotated: the old file was fully drained above, continue with the new one from the start
+            self.reopen(0)
+            lines.extend(self.drain())
+        elif st.st_size < self.position:
+            #truncated (copytruncate)
+            self.reopen(0)
+            lines.extend(self.drain())
+        return lines
+
+    def close(self):
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+
+
+IN_MODIFY = 0x00000002
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+
+def inotify():
+    """Returns the libc handle if inotify is available (Linux), None otherwise"""
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        libc.inotify_init1
+        libc.inotify_add_watch
+    except (OSError, AttributeError):
+        return None
+    return libc
+
+
+class LogWatcher:
+    """Waits for changes to a set of logfiles, using inotify on the directories that contain them (so new files created by logrotate are noticed), or plain polling where inotify is not available"""
+
+    def __init__(self, filenames, pollinterval=1.0):
+        self.pollinterval = pollinterval
+        self.fd = None
+        libc = inotify()
+        if libc is not None:
+            fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+            if fd >= 0:
+                self.fd = fd
+                for directory in sorted(set(os.path.dirname(os.path.abspath(filename)) for filename in filenames)):
+                    if libc.inotify_add_watch(fd, directory.encode(sys.getfilesystemencoding()), IN_MODIFY | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE) < 0:
+                        #can not watch everything, fall back to polling
+                        os.close(fd)
+                        self.fd = None
+                        break
+
+    @property
+    def mode(self):
+        return "inotify" if self.fd is not None else "polling"
+
+    def wait(self, timeout):
+        """Blocks until something may have changed or the timeout (in seconds) passed"""
+        if self.fd is None:
+            time.sleep(min(timeout, self.pollinterval))
+            return
+        #the poll interval is a safety net for events on files outside the watched directories (e.g. symlinks)
+        readable, _, _ = select.select([self.fd], [], [], min(timeout, max(self.pollinterval, 5.0)))
+        if readable:
+            try:
+                while os.read(self.fd, 65536):
+                    pass
+            except BlockingIOError:
+                pass
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
@@ -0,0 +1,502 @@
+#HTTP server for the usage statistics: serves the HTML reports and a JSON API on the aggregated state. Every response is rendered once per version of the data and memoized; clients can revalidate with ETag/If-None-Match and Last-Modified/If-Modified-Since.
+
+import sys
+import os
+import json
+import time
+import signal
+import argparse
+import threading
+from collections import OrderedDict, defaultdict
+from datetime import date, datetime
+from email.utils import formatdate, parsedate_to_datetime
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+
+from lamastats.lamastats import LamaTracker, ClamTracker, FlatTracker, BADGEDIMENSIONS, LAMACHINEFIELDS, \
+        scanlogs, follow, get_mode, daterange, datestr, header, nav, outputreport, outputlamachinereport, outputclamreport, outputflatreport, \
+        addtrackarguments, selecttrack, addformatarguments, applyformatarguments, addclassificationarguments, applyclassificationarguments, adddiagnosticsarguments, applydiagnosticsarguments
+from lamastats.diagnostics import diagnostics, WARNING, DEBUG
+from lamastats.journal import journalfile
+
+CACHESIZE = 256 #number of memoized responses
+
+
+def statemtime(statefile):
+    """Returns the last modification time of a state file or its journal, None if there is no state file"""
+    try:
+        mtime = os.path.getmtime(statefile)
+    except OSError:
+        return None
+    try:
+        return max(mtime, os.path.getmtime(journalfile(statefile)))
+    except OSError:
+        return mtime
+
+
+class StatsStore:
+    """Holds the trackers whose data is served. The version changes whenever the data does, which invalidates the memoized responses. With a database (see sqlitestore.py), the data is queried from it instead of held by the trackers."""
+
+    TRACKERS = (('lama', LamaTracker), ('clam', ClamTracker), ('flat', FlatTracker))
+
+    def __init__(self, track=None, checkinterval=1.0, database=None):
+        self.lock = threading.RLock()
+        self.trackers = {}
+        self.database = database
+        self.dataversion = None #of the database, changes when another process writes to it
+        self.datacache = {} #(tracker key, start, end) => data queried from the database
+        self.track = set(track) if track else set()
+        self.autotrack = not track #derive what to serve from the available state files
+        self.following = False #when following, the trackers are updated in memory instead of reloaded from disk
+        self.checkinterval = checkinterval
+        self.lastcheck = 0.0
+        self.mtimes = {}
+        self.instance = "%x" % int(time.time() * 1000) #distinguishes the versions of different server runs in the ETag
+        self.version = 0
+        self.lastmodified = time.time()
+        self.cache = OrderedDict()
+
+    def load(self):
+        """Loads the trackers of all state files in the current directory, or sets up those that have data in the database"""
+        with self.lock:
+            if self.database is not None:
+                self.dataversion = self.database.dataversion()
+                self.loaddatabase()
+            else:
+                for key, cls in self.TRACKERS:
+                    if os.path.exists(cls.statefile):
+                        self.trackers[key] = cls(load=True)
+                        self.mtimes[key] = statemtime(cls.statefile)
+            self.touch()
+
+    def loaddatabase(self):
+        #the trackers only identify what is in the database, they load nothing (the state is only imported into the database by the process that writes it)
+        for key, cls in self.TRACKERS:
+            if key not in self.trackers and self.database.getmeta(cls.label, 'latest') is not None:
+                self.trackers[key] = cls(load=False, store=self.database)
+
+    def touch(self):
+        with self.lock:
+            if self.autotrack:
+                self.track = set()
+                if 'lama' in self.trackers:
+                    self.track.update(('badges','lamachine'))
+                if 'clam' in self.trackers:
+                    self.track.add('clam')
+                if 'flat' in self.trackers:
+                    self.track.add('flat')
+            self.version += 1
+            self.lastmodified = time.time()
+            self.cache.clear()
+            self.datacache.clear()
+
+    def refresh(self):
+        """Reloads the state files that were changed by another process, checks at most once per checkinterval"""
+        if self.following:
+            return
+        now = time.time()
+        if now - self.lastcheck < self.checkinterval:
+            return
+        with self.lock:
+            self.lastcheck = now
+            if self.database is not None:
+                dataversion = self.database.dataversion()
+                if dataversion != self.dataversion:
+                    self.dataversion = dataversion
+                    self.loaddatabase()
+                    self.touch()
+                return
+            changed = False
+            for key, cls in self.TRACKERS:
+                mtime = statemtime(cls.statefile)
+                if mtime is None:
+                    continue
+                if mtime != self.mtimes.get(key):
+                    try:
+                        self.trackers[key] = cls(load=True)
+                    except ValueError as e:
+                        #caught in the middle of a write, try again on the next check
+                        diagnostics.warning('reload', "[serve] Unable to reload %s: %s", cls.statefile, e)
+                        continue
+                    self.mtimes[key] = mtime
+                    changed = True
+            if changed:
+                self.touch()
+
+    def data(self, key, start=None, end=None):
+        """Returns the data of a tracker. From a database, only the dates between start and end (inclusive, None for unbounded) are queried; the data is memoized until the next change. Otherwise the range is left to the caller."""
+        tracker = self.trackers.get(key)
+        if tracker is None:
+            raise KeyError("No " + key + " statistics available")
+        if tracker.store is None:
+            return tracker.data
+        with self.lock:
+            data = self.datacache.get((key, start, end))
+            if data is None:
+                data = self.datacache[(key, start, end)] = tracker.store.reportdata(tracker, start, end)
+            return data
+
+    def etag(self, version):
+        return '"' + self.instance + '-' + str(version) + '"'
+
+    def response(self, path, query):
+        """Returns the version, modification time, status, content type and body for a request, memoized per version of the data"""
+        with self.lock:
+            key = (path, query)
+            cached = self.cache.get(key)
+            if cached is None:
+                cached = self.cache[key] = render(self, path, parse_qs(query))
+                if len(self.cache) > CACHESIZE:
+                    self.cache.popitem(last=False)
+            else:
+                self.cache.move_to_end(key)
+            return (self.version, self.lastmodified) + cached
+
+
+def param(params, key, default=None):
+    values = params.get(key)
+    return values[0] if values else default
+
+def parsedate(s):
+    try:
+        return datetime.strptime(s,'%Y-%m-%d').date()
+    except ValueError:
+        raise ValueError("Invalid date: " + s + " (expected YYYY-MM-DD)")
+
+def dateparams(params, dates):
+    """Returns the date range selected by the from and to parameters, from defaults to the first of the dates with data, to to today"""
+    end = parsedate(param(params,'to')) if param(params,'to') else date.today()
+    if param(params,'from'):
+        start = parsedate(param(params,'from'))
+    else:
+        dates = [ d for d in dates if d ]
+        start = min(parsedate(min(dates)), end) if dates else end
+    if start > end:
+        raise ValueError("The from date lies after the to date")
+    return [ datestr(d) for d in daterange(start, end) ]
+
+def rangeparams(params):
+    """Returns the from and to parameters, None if absent"""
+    start, end = param(params,'from'), param(params,'to')
+    if start: parsedate(start)
+    if end: parsedate(end)
+    return start, end
+
+def inrange(params, dates):
+    """Filters the dates to the range selected by the from and to parameters, if any"""
+    start, end = rangeparams(params)
+    return [ d for d in dates if (not start or d >= start) and (not end or d <= end) ]
+
+def topn(params, counts):
+    try:
+        n = int(param(params,'n',25))
+    except ValueError:
+        raise ValueError("Invalid value for n")
+    return [ [value, count] for value, count in sorted(counts.items(), key=lambda x: (-1 * x[1], str(x[0])))[:n] ] #ties are ranked by value, so they do not depend on the order of the data
+
+def cubeseries(cubes, dates, dimension=None):
+    result = { 'dates': dates, 'total': [], 'internal': [] }
+    for d in dates:
+        cube = cubes.get(d)
+        result['total'].append(cube['total'] if cube else 0)
+        result['internal'].append(cube['internal'] if cube else 0)
+    if dimension is not None:
+        values = set()
+        for d in dates:
+            if d in cubes:
+                values.update(cubes[d][dimension].keys())
+        result[dimension] = { value: [ cubes[d][dimension].get(value,0) if d in cubes else 0 for d in dates ] for value in sorted(values) }
+    return result
+
+def badgecubes(data, name):
+    """Returns the rollup cubes of one name, or of all names combined"""
+    if name is not None:
+        if not name in data['rollup']:
+            raise KeyError("No such name: " + name)
+        return data['rollup'][name]
+    combined = {}
+    for cubes in data['rollup'].values():
+        for d, cube in cubes.items():
+            total = combined.get(d)
+            if total is None:
+                total = combined[d] = { 'total': 0, 'internal': 0 }
+                for dimension in BADGEDIMENSIONS:
+                    total[dimension] = defaultdict(int)
+            total['total'] += cube['total']
+            total['internal'] += cube['internal']
+            for dimension in BADGEDIMENSIONS:
+                for value, count in cube[dimension].items():
+                    total[dimension][value] += count
+    return combined
+
+def dimensionparam(params, dimensions, key='dimension', required=False):
+    dimension = param(params,key)
+    if dimension is None:
+        if required:
+            raise ValueError("Parameter " + key + " is required (" + ", ".join(dimensions) + ")")
+    elif not dimension in dimensions:
+        raise ValueError("Invalid " + key + ": " + dimension + " (" + ", ".join(dimensions) + ")")
+    return dimension
+
+
+def badgestotals(store, params):
+    data = store.data('lama', *rangeparams(params))
+    if not param(params,'from') and not param(params,'to'):
+        return { name: data['totalhits'][name] for name in sorted(data['names']) if name in data['totalhits'] }
+    totals = {}
+    for name in sorted(data['names']):
+        cubes = data['rollup'].get(name,{})
+        totals[name] = sum(cubes[d]['total'] for d in inrange(params, cubes.keys()))
+    return totals
+
+def badgesseries(store, params):
+    cubes = badgecubes(store.data('lama', *rangeparams(params)), param(params,'name'))
+    return cubeseries(cubes, dateparams(params, cubes.keys()), dimensionparam(params, BADGEDIMENSIONS))
+
+def badgestop(store, params):
+    cubes = badgecubes(store.data('lama', *rangeparams(params)), param(params,'name'))
+    dimension = dimensionparam(params, BADGEDIMENSIONS, required=True)
+    counts = defaultdict(int)
+    for d in inrange(params, cubes.keys()):
+        for value, count in cubes[d][dimension].items():
+            counts[value] += count
+    return topn(params, counts)
+
+def lamachineseries(store, params):
+    cubes = store.data('lama', *rangeparams(params))['lamachinerollup']
+    return cubeseries(cubes, dateparams(params, cubes.keys()))
+
+def lamachinetop(store, params):
+    data = store.data('lama', *rangeparams(params))
+    field = dimensionparam(params, LAMACHINEFIELDS, 'field', required=True)
+    if not param(params,'from') and not param(params,'to'):
+        return topn(params, data['lamachinestats'].get(field,{}))
+    cubes = data['lamachinerollup']
+    counts = defaultdict(int)
+    for d in inrange(params, cubes.keys()):
+        for value, count in cubes[d].get(field,{}).items():
+            counts[value] += count
+    return topn(params, counts)
+
+def clamtotals(store, params):
+    data = store.data('clam', *rangeparams(params))
+    if not param(params,'from') and not param(params,'to'):
+        return { name: data['totalprojects'][name] for name in sorted(data['names']) if name in data['totalprojects'] }
+    totals = {}
+    for name in sorted(data['names']):
+        projectsperday = data['projectsperday'].get(name,{})
+        totals[name] = sum(projectsperday[d] for d in inrange(params, projectsperday.keys()))
+    return totals
+
+def clamseries(store, params):
+    data = store.data('clam', *rangeparams(params))
+    name = param(params,'name')
+    if name is not None:
+        if not name in data['names']:
+            raise KeyError("No such name: " + name)
+        names = [name]
+    else:
+        names = data['names']
+    alldates = set()
+    for n in names:
+        alldates.update(data['projectsperday'].get(n,{}).keys())
+    dates = dateparams(params, alldates)
+    return {
+        'dates': dates,
+        'total': [ sum(data['projectsperday'].get(n,{}).get(d,0) for n in names) for d in dates ],
+        'internal': [ sum(data['projectsperday_internal'].get(n,{}).get(d,0) for n in names) for d in dates ],
+    }
+
+def flatseries(store, params):
+    data = store.data('flat', *rangeparams(params))
+    keys = (('read','readdocumentsperday'), ('wrote','wrotedocumentsperday'), ('edits','editsperday'))
+    alldates = set()
+    for _, key in keys:
+        alldates.update(data[key].keys())
+    dates = dateparams(params, alldates)
+    result = { 'dates': dates }
+    for label, key in keys:
+        result[label] = [ data[key].get(d,0) for d in dates ]
+    return result
+
+APIS = {
+    '/api/badges/totals': badgestotals,
+    '/api/badges/series': badgesseries,
+    '/api/badges/top': badgestop,
+    '/api/lamachine/series': lamachineseries,
+    '/api/lamachine/top': lamachinetop,
+    '/api/clam/totals': clamtotals,
+    '/api/clam/series': clamseries,
+    '/api/flat/series': flatseries,
+}
+
+#path => tracker, track name and report function
+REPORTS = {
+    '/lamastats.html': ('lama', 'badges', outputreport),
+    '/lamachinestats.html': ('lama', 'lamachine', outputlamachinereport),
+    '/clamstats.html': ('clam', 'clam', outputclamreport),
+    '/flatstats.html': ('flat', 'flat', outputflatreport),
+}
+
+
+def index(store):
+    yield header()
+    yield nav(store.track)
+    yield "        <h1>Usage Reports</h1>\n"
+    yield "<section>\n"
+    yield "<h2>API</h2>\n<ul>\n"
+    for path in sorted(APIS):
+        yield "<li><a href=\"" + path + "\">" + path + "</a></li>\n"
+    yield "</ul>\n</section>\n"
+    yield """    </body>
+</html>
+"""
+
+def render(store, path, params):
+    """Returns the status, content type and body of the response for a path"""
+    if path in ('/', '/index.html'):
+        return 200, 'text/html; charset=utf-8', "".join(index(store)).encode('utf-8')
+    if path in REPORTS:
+        key, trackname, report = REPORTS[path]
+        if key in store.trackers and trackname in store.track:
+            return 200, 'text/html; charset=utf-8', "".join(report(store.data(key), store.track)).encode('utf-8')
+    elif path in APIS:
+        try:
+            return 200, 'application/json', json.dumps(APIS[path](store, params)).encode('utf-8')
+        except ValueError as e:
+            return 400, 'application/json', json.dumps({'error': str(e)}).encode('utf-8')
+        except KeyError as e:
+            return 404, 'application/json', json.dumps({'error': e.args[0] if e.args else 'Not found'}).encode('utf-8')
+    return 404, 'text/plain; charset=utf-8', b'Not found\n'
+
+
+class StatsHandler(BaseHTTPRequestHandler):
+    server_version = "lamastats"
+
+    def do_GET(self):
+        self.respond()
+
+    def do_HEAD(self):
+        self.respond(False)
+
+    def notmodified(self, etag, lastmodified):
+        ifnonematch = self.headers.get('If-None-Match')
+        if ifnonematch is not None:
+            #If-None-Match takes precedence over If-Modified-Since
+            return ifnonematch.strip() == '*' or etag in [ tag.strip() for tag in ifnonematch.split(',') ]
+        ifmodifiedsince = self.headers.get('If-Modified-Since')
+        if ifmodifiedsince is not None:
+            try:
+                return int(lastmodified) <= parsedate_to_datetime(ifmodifiedsince).timestamp()
+            except (TypeError, ValueError):
+                return False
+        return False
+
+    def respond(self, body=True):
+        store = self.server.store
+        store.refresh()
+        url = urlsplit(self.path)
+        version, lastmodified, status, contenttype, content = store.response(url.path, url.query)
+        etag = store.etag(version)
+        if status == 200 and self.notmodified(etag, lastmodified):
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        self.send_response(status)
+        self.send_header('Content-Type', contenttype)
+        self.send_header('Content-Length', str(len(content)))
+        if status == 200:
+            self.send_header('ETag', etag)
+            self.send_header('Last-Modified', formatdate(lastmodified, usegmt=True))
+            self.send_header('Cache-Control', 'no-cache') #always revalidate, the data changes as logs are ingested
+        self.end_headers()
+        if body:
+            self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        diagnostics.note("[serve] " + self.address_string() + " " + (format % args), DEBUG)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="lamastats serve", description="Serve the usage reports and a JSON API over HTTP, from the state files in the state directory or from a database (--database). If logfiles are given, they are ingested and followed as they grow; otherwise the state is reloaded whenever another lamastats process updates it.", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--host', type=str, help="Address to listen on", action='store', default="127.0.0.1", required=False)
+    parser.add_argument('-p','--port', type=int, help="Port to listen on", action='store', default=8080, required=False)
+    parser.add_argument('-d','--statedir', type=str, help="Directory with the state files (lamastats.json, clamstats.json, flatstats.json)", action='store', default="./", required=False)
+    addtrackarguments(parser)
+    addformatarguments(parser)
+    addclassificationarguments(parser)
+    adddiagnosticsarguments(parser)
+    parser.add_argument('-j','--jobs', type=int, help="Number of worker processes for the initial log ingestion", action='store',default=1,required=False)
+    parser.add_argument('--interval', type=float, help="When following logs, save the state at most once per this many seconds", action='store',default=60.0,required=False)
+    parser.add_argument('--pollinterval', type=float, help="When following logs, check them this often (in seconds) when inotify is not available", action='store',default=1.0,required=False)
+    parser.add_argument('--database', type=str, help="Serve the state from this SQLite database (as written by lamastats --database) instead of from the state files; logfiles that are followed are ingested into it", action='store', required=False)
+    parser.add_argument('logfiles', nargs='*', help='Access logs to follow, prepend filenames with "apache:" for apache, "nginx:" for nginx')
+    args = parser.parse_args(argv)
+    try:
+        applyformatarguments(args)
+    except ValueError as e:
+        parser.error(str(e))
+    applyclassificationarguments(args)
+    applydiagnosticsarguments(args)
+    #paths are relative to the original working directory
+    logfiles = [ mode + ':' + os.path.abspath(path) for mode, path in map(get_mode, args.logfiles) ]
+    foliadocservelog = os.path.abspath(args.foliadocservelog) if args.foliadocservelog else None
+    databasefile = os.path.abspath(args.database) if args.database else None
+    os.chdir(args.statedir)
+
+    track = selecttrack(args)
+    database = None
+    if databasefile:
+        from lamastats.sqlitestore import SQLiteStore
+        database = SQLiteStore(databasefile)
+    store = StatsStore(track, database=database)
+    sources = []
+    if logfiles or foliadocservelog:
+        if not track:
+            print("No tracking options selected",file=sys.stderr)
+            sys.exit(2)
+        trackers = []
+        if 'badges' in track or 'lamachine' in track:
+            store.trackers['lama'] = LamaTracker(store=database)
+            trackers.append(store.trackers['lama'])
+        if 'clam' in track:
+            store.trackers['clam'] = ClamTracker(store=database)
+            trackers.append(store.trackers['clam'])
+        if trackers and logfiles:
+            scanlogs(logfiles, trackers, args.jobs, following=True)
+            sources.append( (logfiles, trackers) )
+        if 'flat' in track and foliadocservelog:
+            store.trackers['flat'] = FlatTracker(store=database)
+            scanlogs([foliadocservelog], [store.trackers['flat']], args.jobs, following=True)
+            sources.append( ([foliadocservelog], [store.trackers['flat']]) )
+        store.following = True
+        store.touch()
+    else:
+        store.load()
+        if not store.trackers:
+            diagnostics.note("[serve] No state found in " + (databasefile or os.getcwd()) + ", serving empty statistics until it appears", WARNING)
+
+    server = ThreadingHTTPServer((args.host, args.port), StatsHandler)
+    server.daemon_threads = True
+    server.store = store
+    if sources:
+        #the data in a database only changes when the trackers save to it
+        callbacks = {'onsave': store.touch} if database is not None else {'onupdate': store.touch}
+        thread = threading.Thread(target=follow, args=(sources, args.interval, args.pollinterval), kwargs=dict(callbacks, lock=store.lock), daemon=True)
+        thread.start()
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    diagnostics.note("[serve] Serving on http://" + args.host + ":" + str(server.server_address[1]) + "/")
+    try:
+        server.serve_forever()
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
+        server.server_close()
+        if sources:
+            #the follower runs in a daemon thread, save what it ingested since its last save
+            with store.lock:
+                for tracker in store.trackers.values():
+                    tracker.finish()
+        diagnostics.summary()
+        diagnostics.close()
@@ -0,0 +1,298 @@
+#SQLite storage backend (stdlib sqlite3): an alternative to the JSON state files. The hits and daily counts live in indexed tables, a tracker only keeps the data of the current run in memory and writes it in a single transaction when it saves. Reports are rendered from aggregate queries, so memory use does not grow with the history.
+
+import os
+import json
+import sqlite3
+from collections import defaultdict
+
+from lamastats.diagnostics import diagnostics
+from lamastats.hyperloglog import HyperLogLog, union
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (tracker TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, PRIMARY KEY (tracker, key));
+CREATE TABLE IF NOT EXISTS names (tracker TEXT NOT NULL, name TEXT NOT NULL, PRIMARY KEY (tracker, name));
+CREATE TABLE IF NOT EXISTS badgehits (name TEXT NOT NULL, date TEXT NOT NULL, type TEXT, ip TEXT, uniq INTEGER, platform TEXT, country TEXT, internal INTEGER);
+CREATE INDEX IF NOT EXISTS badgehits_name_date ON badgehits (name, date);
+CREATE INDEX IF NOT EXISTS badgehits_date ON badgehits (date);
+CREATE UNIQUE INDEX IF NOT EXISTS badgehits_unique ON badgehits (name, date, type, ip, uniq, platform, country, internal) WHERE type != 'github';
+CREATE TABLE IF NOT EXISTS lamachinehits (date TEXT NOT NULL, form TEXT, mode TEXT, stabledev TEXT, pythonversion TEXT, ip TEXT, os TEXT, distrib TEXT, country TEXT, internal INTEGER);
+CREATE UNIQUE INDEX IF NOT EXISTS lamachinehits_unique ON lamachinehits (date, form, mode, stabledev, pythonversion, ip, os, distrib, country, internal);
+CREATE TABLE IF NOT EXISTS badgerollup (name TEXT NOT NULL, date TEXT NOT NULL, dimension TEXT NOT NULL, value TEXT, count INTEGER NOT NULL, first INTEGER NOT NULL);
+CREATE INDEX IF NOT EXISTS badgerollup_name_date ON badgerollup (name, date);
+CREATE INDEX IF NOT EXISTS badgerollup_date ON badgerollup (date);
+CREATE TABLE IF NOT EXISTS lamachinerollup (date TEXT NOT NULL, dimension TEXT NOT NULL, value TEXT, count INTEGER NOT NULL, first INTEGER NOT NULL);
+CREATE INDEX IF NOT EXISTS lamachinerollup_date ON lamachinerollup (date);
+CREATE TABLE IF NOT EXISTS badgevisitors (name TEXT NOT NULL, date TEXT NOT NULL, sketch BLOB NOT NULL, PRIMARY KEY (name, date));
+CREATE TABLE IF NOT EXISTS lamachinevisitors (date TEXT NOT NULL PRIMARY KEY, sketch BLOB NOT NULL);
+CREATE TABLE IF NOT EXISTS clamprojects (name TEXT NOT NULL, date TEXT NOT NULL, total INTEGER NOT NULL, internal INTEGER NOT NULL, PRIMARY KEY (name, date));
+CREATE INDEX IF NOT EXISTS clamprojects_date ON clamprojects (date);
+CREATE TABLE IF NOT EXISTS flatevents (kind TEXT NOT NULL, date TEXT NOT NULL, count INTEGER NOT NULL, PRIMARY KEY (kind, date));
+"""
+
+BADGEFIELDS = ('type', 'ip', 'unique', 'platform', 'country', 'internal')
+LAMACHINECOLUMNS = ('form', 'mode', 'stabledev', 'pythonversion', 'ip', 'os', 'distrib', 'country', 'internal')
+BADGEDIMENSIONS = ('type', 'platform', 'country')
+LAMACHINEFIELDS = ('form', 'mode', 'stabledev', 'pythonversion', 'os', 'distrib', 'country')
+FLATKINDS = ('readdocumentsperday', 'wrotedocumentsperday', 'editsperday')
+
+
+def daterange(column, start, end):
+    """Returns a WHERE clause and its parameters that restrict a date column to a range, either bound may be None"""
+    clauses = []
+    parameters = []
+    if start is not None:
+        clauses.append(column + " >= ?")
+        parameters.append(start)
+    if end is not None:
+        clauses.append(column + " <= ?")
+        parameters.append(end)
+    return (" WHERE " + " AND ".join(clauses) if clauses else ""), parameters
+
+
+def cuberows(cube, dimensions):
+    """Yields (dimension, value, count) rows for a rollup cube, the total and internal counts have no value"""
+    yield 'total', None, cube['total']
+    yield 'internal', None, cube['internal']
+    for dimension in dimensions:
+        for value, count in cube.get(dimension,{}).items():
+            yield dimension, value, count
+
+
+def getcube(cubes, date, dimensions=()):
+    cube = cubes.get(date)
+    if cube is None:
+        cube = cubes[date] = { 'total': 0, 'internal': 0 }
+        for dimension in dimensions:
+            cube[dimension] = {}
+    return cube
+
+
+def addtocube(cube, dimension, value, count):
+    if value is None and dimension in ('total', 'internal'):
+        cube[dimension] += count
+    else:
+        counts = cube.setdefault(dimension, {})
+        counts[value] = counts.get(value,0) + count
+
+
+class SQLiteStore:
+    """Stores the state of the trackers in an SQLite database"""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.db = sqlite3.connect(filename, check_same_thread=False) #lamastats serve uses it from several threads, one at a time (under the lock of its StatsStore)
+        self.db.execute("PRAGMA journal_mode=WAL") #readers (lamastats serve) do not block the writer
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(SCHEMA)
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+    def dataversion(self):
+        """Changes whenever another connection commits to the database"""
+        return self.db.execute("PRAGMA data_version").fetchone()[0]
+
+    def getmeta(self, label, key, default=None):
+        row = self.db.execute("SELECT value FROM meta WHERE tracker = ? AND key = ?", (label, key)).fetchone()
+        return json.loads(row[0]) if row is not None else default
+
+    def load(self, tracker):
+        """Loads what a tracker needs to continue ingesting: the names, the watermark and the log registry. Imports the JSON state file of the tracker the first time."""
+        if self.getmeta(tracker.label, 'latest') is None and os.path.exists(tracker.statefile):
+            self.importjson(tracker)
+        tracker.data['latest'] = self.getmeta(tracker.label, 'latest', "")
+        tracker.data['logregistry'] = self.getmeta(tracker.label, 'logregistry', {})
+        tracker.data['watermarks'] = self.getmeta(tracker.label, 'watermarks', {})
+        tracker.data['legacywatermark'] = self.getmeta(tracker.label, 'legacywatermark')
+        if 'names' in tracker.data:
+            tracker.data['names'].update(name for name, in self.db.execute("SELECT name FROM names WHERE tracker = ?", (tracker.label,)))
+
+    def importjson(self, tracker):
+        diagnostics.note("[" + tracker.label + "] Importing " + tracker.statefile + " into " + self.filename)
+        jsontracker = tracker.__class__(load=True)
+        data = jsontracker.data
+        if tracker.label == 'parselog':
+            delta = { 'names': data['names'], 'hitsperday': data['hitsperday'], 'lamachine': data['lamachine'] }
+            #days whose hits were expired under a retention policy only have their rollup cube
+            delta['badgerollup'] = { name: { date: cube for date, cube in cubes.items() if not data['hitsperday'].get(name,{}).get(date) } for name, cubes in data['rollup'].items() }
+            delta['lamachinerollup'] = { date: cube for date, cube in data['lamachinerollup'].items() if not data['lamachine'].get(date) }
+            delta['visitors'] = data['visitors']
+            delta['lamachinevisitors'] = data['lamachinevisitors']
+        elif tracker.label == 'parseclamlog':
+            delta = { 'names': data['names'], 'projectsperday': data['projectsperday'], 'projectsperday_internal': data['projectsperday_internal'] }
+        else:
+            delta = { key: data[key] for key in FLATKINDS }
+        count = self.write(tracker.label, delta, data)
+        diagnostics.note("[" + tracker.label + "] Imported " + str(count) + " record(s)")
+
+    def write(self, label, delta, state):
+        """Writes the delta of a tracker (see Tracker.initdelta()) and the metadata from its state (watermarks and log registry) in a single transaction, returns the number of inserted or updated rows"""
+        with self.db:
+            if 'names' in delta:
+                self.db.executemany("INSERT OR IGNORE INTO names (tracker, name) VALUES (?, ?)", ( (label, name) for name in delta['names'] ))
+            before = self.db.total_changes
+            if 'hitsperday' in delta:
+                #proxied (github) hits carry no visitor information and are never duplicates
+                self.db.executemany("INSERT OR IGNORE INTO badgehits (name, date, type, ip, uniq, platform, country, internal) VALUES (?, ?, ?, ?, ?, ?, ?, ?)", (
+                    (name, date) + tuple(hit.get(field) for field in BADGEFIELDS)
+                    for name, hitsperday in delta['hitsperday'].items() for date, hits in hitsperday.items() for hit in hits
+                ))
+            if 'lamachine' in delta:
+                self.db.executemany("INSERT OR IGNORE INTO lamachinehits (date, " + ", ".join(LAMACHINECOLUMNS) + ") VALUES (?" + ", ?" * len(LAMACHINECOLUMNS) + ")", (
+                    (date,) + tuple(hit.get(column) for column in LAMACHINECOLUMNS)
+                    for date, hits in delta['lamachine'].items() for hit in hits
+                ))
+            if 'badgerollup' in delta:
+                #imported cubes sort before all hits (see lamadata())
+                rows = [ (name, date, dimension, value, count) for name, cubes in delta['badgerollup'].items() for date, cube in cubes.items() for dimension, value, count in cuberows(cube, BADGEDIMENSIONS) ]
+                self.db.executemany("INSERT INTO badgerollup (name, date, dimension, value, count, first) VALUES (?, ?, ?, ?, ?, ?)", ( row + (i - len(rows),) for i, row in enumerate(rows) ))
+            if 'lamachinerollup' in delta:
+                rows = [ (date, dimension, value, count) for date, cube in delta['lamachinerollup'].items() for dimension, value, count in cuberows(cube, LAMACHINEFIELDS) ]
+                self.db.executemany("INSERT INTO lamachinerollup (date, dimension, value, count, first) VALUES (?, ?, ?, ?, ?)", ( row + (i - len(rows),) for i, row in enumerate(rows) ))
+            if 'projectsperday' in delta:
+                self.db.executemany("INSERT INTO clamprojects (name, date, total, internal) VALUES (?, ?, ?, ?) ON CONFLICT (name, date) DO UPDATE SET total = total + excluded.total, internal = internal + excluded.internal", (
+                    (name, date, count, delta['projectsperday_internal'].get(name,{}).get(date,0))
+                    for name, projectsperday in delta['projectsperday'].items() for date, count in projectsperday.items()
+                ))
+            for kind in FLATKINDS:
+                if kind in delta:
+                    self.db.executemany("INSERT INTO flatevents (kind, date, count) VALUES (?, ?, ?) ON CONFLICT (kind, date) DO UPDATE SET count = count + excluded.count", (
+                        (kind, date, count) for date, count in delta[kind].items()
+                    ))
+            changes = self.db.total_changes - before
+            if 'hitsperday' in delta:
+                sketches = defaultdict(HyperLogLog)
+                for name, hitsperday in delta['hitsperday'].items():
+                    for date, hits in hitsperday.items():
+                        for hit in hits:
+                            if hit['type'] != 'github':
+                                sketches[(name, date)].add(hit['ip'])
+                for name, visitors in delta.get('visitors',{}).items():
+                    for date, sketch in visitors.items():
+                        sketches[(name, date)].update(sketch)
+                self.mergevisitors('badgevisitors', ('name', 'date'), sketches)
+            if 'lamachine' in delta:
+                sketches = defaultdict(HyperLogLog)
+                for date, hits in delta['lamachine'].items():
+                    for hit in hits:
+                        sketches[(date,)].add(hit['ip'])
+                for date, sketch in delta.get('lamachinevisitors',{}).items():
+                    sketches[(date,)].update(sketch)
+                self.mergevisitors('lamachinevisitors', ('date',), sketches)
+            self.db.executemany("INSERT OR REPLACE INTO meta (tracker, key, value) VALUES (?, ?, ?)", (
+                (label, key, json.dumps(state[key])) for key in ('latest', 'logregistry', 'watermarks', 'legacywatermark') if key in state
+            ))
+        return changes
+
+    def mergevisitors(self, table, keycolumns, sketches):
+        """Merges visitor sketches (key tuple => HyperLogLog) into the stored ones"""
+        where = " AND ".join( column + " = ?" for column in keycolumns )
+        for key, sketch in sketches.items():
+            row = self.db.execute("SELECT sketch FROM " + table + " WHERE " + where, key).fetchone()
+            if row is not None:
+                sketch = union( (HyperLogLog.frombytes(row[0]), sketch) )
+            self.db.execute("INSERT OR REPLACE INTO " + table + " (" + ", ".join(keycolumns) + ", sketch) VALUES (" + "?, " * len(keycolumns) + "?)", key + (sketch.tobytes(),))
+
+    def save(self, tracker):
+        """Writes the data a tracker aggregated since its last save, returns the number of new hits"""
+        changes = self.write(tracker.label, tracker.delta, tracker.data)
+        if tracker.label == 'parselog':
+            cutoff = tracker.cutoff()
+            if cutoff is not None:
+                self.expire(tracker, cutoff)
+            return changes #hits that duplicate hits of an earlier run (on the same day) were ignored by the unique indices
+        return tracker.newhits #counts are added up, not inserted
+
+    def expire(self, tracker, cutoff):
+        """Compacts the badge and LaMachine hits of the days before the cutoff into daily counts per dimension (see Tracker.cutoff()), dropping the hits and with them the IP addresses"""
+        with self.db:
+            self.db.execute("INSERT INTO badgerollup (name, date, dimension, value, count, first) SELECT name, date, 'total', NULL, COUNT(*), MIN(rowid) FROM badgehits WHERE date < ? GROUP BY name, date", (cutoff,))
+            self.db.execute("INSERT INTO badgerollup (name, date, dimension, value, count, first) SELECT name, date, 'internal', NULL, SUM(internal), MIN(rowid) FROM badgehits WHERE date < ? GROUP BY name, date", (cutoff,))
+            for dimension in BADGEDIMENSIONS:
+                self.db.execute("INSERT INTO badgerollup (name, date, dimension, value, count, first) SELECT name, date, ?, " + dimension + ", COUNT(*), MIN(rowid) FROM badgehits WHERE date < ? GROUP BY name, date, " + dimension, (dimension, cutoff))
+            self.db.execute("INSERT INTO lamachinerollup (date, dimension, value, count, first) SELECT date, 'total', NULL, COUNT(*), MIN(rowid) FROM lamachinehits WHERE date < ? GROUP BY date", (cutoff,))
+            self.db.execute("INSERT INTO lamachinerollup (date, dimension, value, count, first) SELECT date, 'internal', NULL, SUM(internal), MIN(rowid) FROM lamachinehits WHERE date < ? GROUP BY date", (cutoff,))
+            for field in LAMACHINEFIELDS:
+                self.db.execute("INSERT INTO lamachinerollup (date, dimension, value, count, first) SELECT date, ?, " + field + ", COUNT(*), MIN(rowid) FROM lamachinehits WHERE date < ? AND " + field + " IS NOT NULL GROUP BY date, " + field, (field, cutoff))
+            expired = self.db.execute("DELETE FROM badgehits WHERE date < ?", (cutoff,)).rowcount
+            expired += self.db.execute("DELETE FROM lamachinehits WHERE date < ?", (cutoff,)).rowcount
+        if expired:
+            diagnostics.note("[" + tracker.label + "] Compacted " + str(expired) + " hit(s) from before " + cutoff + " into daily counts")
+
+    def reportdata(self, tracker, start=None, end=None):
+        """Returns the data of a tracker in the form the report functions expect, aggregated from the hits between the start and end dates (inclusive, None for unbounded)"""
+        if tracker.label == 'parselog':
+            return self.lamadata(start, end)
+        elif tracker.label == 'parseclamlog':
+            return self.clamdata(start, end)
+        return self.flatdata(start, end)
+
+    def lamadata(self, start=None, end=None):
+        data = {
+            'names': set(name for name, in self.db.execute("SELECT name FROM names WHERE tracker = 'parselog'")),
+            'totalhits': defaultdict(int),
+            'rollup': defaultdict(dict),
+            'lamachinerollup': {},
+            'lamachinestats': defaultdict(dict),
+            'visitors': defaultdict(dict),
+            'lamachinevisitors': {},
+        }
+        where, parameters = daterange('date', start, end)
+        #the cubes are filled with the compacted days first and then with the hits, each ordered by their first hit, like the rollup that is built in memory, so ties are ranked the same in the reports
+        rollup = data['rollup']
+        for name, date, dimension, value, count in self.db.execute("SELECT name, date, dimension, value, count FROM badgerollup" + where + " ORDER BY first", parameters):
+            addtocube(getcube(rollup[name], date, BADGEDIMENSIONS), dimension, value, count)
+            if dimension == 'total':
+                data['totalhits'][name] += count
+        for name, date, total, internal in self.db.execute("SELECT name, date, COUNT(*), SUM(internal) FROM badgehits" + where + " GROUP BY name, date ORDER BY MIN(rowid)", parameters):
+            cube = getcube(rollup[name], date, BADGEDIMENSIONS)
+            addtocube(cube, 'total', None, total)
+            addtocube(cube, 'internal', None, internal)
+            data['totalhits'][name] += total
+        for dimension in BADGEDIMENSIONS:
+            for name, date, value, count in self.db.execute("SELECT name, date, " + dimension + ", COUNT(*) FROM badgehits" + where + " GROUP BY name, date, " + dimension + " ORDER BY MIN(rowid)", parameters):
+                addtocube(rollup[name][date], dimension, value, count)
+        cubes = data['lamachinerollup']
+        for date, dimension, value, count in self.db.execute("SELECT date, dimension, value, count FROM lamachinerollup" + where + " ORDER BY first", parameters):
+            addtocube(getcube(cubes, date), dimension, value, count)
+        for date, total, internal in self.db.execute("SELECT date, COUNT(*), SUM(internal) FROM lamachinehits" + where + " GROUP BY date ORDER BY MIN(rowid)", parameters):
+            cube = getcube(cubes, date)
+            addtocube(cube, 'total', None, total)
+            addtocube(cube, 'internal', None, internal)
+        for field in LAMACHINEFIELDS:
+            for date, value, count in self.db.execute("SELECT date, " + field + ", COUNT(*) FROM lamachinehits" + (where + " AND " if where else " WHERE ") + field + " IS NOT NULL GROUP BY date, " + field + " ORDER BY MIN(rowid)", parameters):
+                addtocube(cubes[date], field, value, count)
+        stats = data['lamachinestats']
+        for field, value, count in self.db.execute("SELECT dimension, value, SUM(count) FROM lamachinerollup" + (where + " AND " if where else " WHERE ") + "value IS NOT NULL GROUP BY dimension, value ORDER BY MIN(first)", parameters):
+            stats[field][value] = count
+        for field in LAMACHINEFIELDS:
+            for value, count in self.db.execute("SELECT " + field + ", COUNT(*) FROM lamachinehits" + (where + " AND " if where else " WHERE ") + field + " IS NOT NULL GROUP BY " + field + " ORDER BY MIN(rowid)", parameters):
+                stats[field][value] = stats[field].get(value,0) + count
+        for name, date, sketch in self.db.execute("SELECT name, date, sketch FROM badgevisitors" + where, parameters):
+            data['visitors'][name][date] = HyperLogLog.frombytes(sketch)
+        for date, sketch in self.db.execute("SELECT date, sketch FROM lamachinevisitors" + where, parameters):
+            data['lamachinevisitors'][date] = HyperLogLog.frombytes(sketch)
+        return data
+
+    def clamdata(self, start=None, end=None):
+        data = {
+            'names': set(name for name, in self.db.execute("SELECT name FROM names WHERE tracker = 'parseclamlog'")),
+            'projectsperday': defaultdict(lambda: defaultdict(int)),
+            'projectsperday_internal': defaultdict(lambda: defaultdict(int)),
+            'totalprojects': defaultdict(int),
+        }
+        where, parameters = daterange('date', start, end)
+        for name, date, total, internal in self.db.execute("SELECT name, date, total, internal FROM clamprojects" + where, parameters):
+            data['projectsperday'][name][date] = total
+            if internal:
+                data['projectsperday_internal'][name][date] = internal
+            data['totalprojects'][name] += total
+        return data
+
+    def flatdata(self, start=None, end=None):
+        data = { kind: defaultdict(int) for kind in FLATKINDS }
+        where, parameters = daterange('date', start, end)
+        for kind, date, count in self.db.execute("SELECT kind, date, count FROM flatevents" + where, parameters):
+            data[kind][date] = count
+        return data
@@ -43,5 +43,6 @@ setup(
         ]
     },
     package_data = {'lamastats':['GeoIP.dat'] },
-    install_requires=['pygeoip', 'apache_log_parser']
+    install_requires=['pygeoip', 'apache_log_parser'],
+    extras_require={'zstd': ['zstandard']}
 )
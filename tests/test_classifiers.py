@@ -0,0 +1,52 @@
+#Classification of IP addresses as ignored or internal by addresses, CIDR ranges and prefixes
+
+import unittest
+
+from lamastats.lamastats import IPClassifier, parsenetwork
+
+
+class IPClassifierTest(unittest.TestCase):
+
+    def test_addresses(self):
+        classifier = IPClassifier(['127.0.0.1', '2001:db8::1'])
+        self.assertIn('127.0.0.1', classifier)
+        self.assertIn('2001:db8::1', classifier)
+        self.assertIn('2001:0db8:0000::1', classifier) #same address, other notation
+        self.assertNotIn('127.0.0.2', classifier)
+        self.assertNotIn('2001:db8::2', classifier)
+
+    def test_cidr(self):
+        classifier = IPClassifier(['10.0.0.0/8', '192.168.1.0/24', '2001:db8::/32'])
+        self.assertIn('10.255.255.255', classifier)
+        self.assertIn('192.168.1.200', classifier)
+        self.assertNotIn('192.168.2.1', classifier)
+        self.assertNotIn('11.0.0.0', classifier)
+        self.assertIn('2001:db8:ffff::1', classifier)
+        self.assertNotIn('2001:db9::1', classifier)
+
+    def test_prefixes(self):
+        classifier = IPClassifier(['131.174.', '2001:db8:'])
+        self.assertIn('131.174.30.3', classifier)
+        self.assertNotIn('131.175.30.3', classifier)
+        self.assertIn('2001:db8:1::1', classifier)
+        self.assertEqual(parsenetwork('131.174.'), parsenetwork('131.174.0.0/16'))
+
+    def test_overlapping(self):
+        classifier = IPClassifier(['10.0.0.0/16', '10.0.128.0/17', '10.1.0.0/16', '10.0.5.7'])
+        for ip in ('10.0.0.1', '10.0.200.1', '10.1.255.255', '10.0.5.7'):
+            self.assertIn(ip, classifier)
+        self.assertNotIn('10.2.0.0', classifier)
+
+    def test_ipv4_mapped(self):
+        self.assertIn('::ffff:131.174.30.3', IPClassifier(['131.174.0.0/16']))
+
+    def test_other_entries(self):
+        #entries that are no address or network are matched as plain string prefixes
+        classifier = IPClassifier(['unix:'])
+        self.assertIn('unix:/run/nginx.sock', classifier)
+        self.assertNotIn('-', classifier)
+        self.assertNotIn('-', IPClassifier(['10.0.0.0/8']))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,35 @@
+#Batch country lookups resolve every IP as a single lookup would, and fill the cache
+
+import random
+import unittest
+
+from lamastats.lamastats import GeoIPLookup
+
+
+class GeoIPLookupTest(unittest.TestCase):
+
+    def test_resolve_many(self):
+        rng = random.Random(1)
+        ips = [ "%d.%d.%d.%d" % (rng.randrange(1,224), rng.randrange(256), rng.randrange(256), rng.randrange(256)) for _ in range(2000) ]
+        ips += [ "131.174.30.%d" % i for i in range(50) ] #many addresses in the same network
+        ips += ips[:100] + ['2001:db8::1', '::ffff:1.2.3.4', 'garbage', '']
+        reference = GeoIPLookup()
+        expected = { ip: reference.lookup(ip) for ip in ips }
+        lookup = GeoIPLookup()
+        self.assertEqual(lookup.resolve_many(ips), expected)
+        self.assertEqual(dict(lookup.cache), expected)
+        self.assertEqual(lookup.resolve_many([]), {})
+
+    def test_cache(self):
+        lookup = GeoIPLookup(cachesize=3)
+        lookup.resolve_many(['1.1.1.1', '8.8.8.8'])
+        self.assertEqual(lookup.country('8.8.8.8'), lookup.lookup('8.8.8.8'))
+        lookup.country('9.9.9.9')
+        lookup.country('2001:db8::1')
+        #the least recently used entry was evicted
+        self.assertEqual(list(lookup.cache), ['8.8.8.8', '9.9.9.9', '2001:db8::1'])
+        self.assertEqual(lookup.country('2001:db8::1'), 'unknown')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,81 @@
+#HyperLogLog sketches estimate distinct counts within a few standard errors (about 1.6% at the default precision), also after merging and serialisation
+
+import unittest
+
+from lamastats.hyperloglog import HyperLogLog, union, SPARSELIMIT
+
+
+def sketch(values):
+    result = HyperLogLog()
+    for value in values:
+        result.add(value)
+    return result
+
+
+def addresses(start, stop):
+    return [ "10.%d.%d.%d" % (i >> 16, (i >> 8) & 255, i & 255) for i in range(start, stop) ]
+
+
+class HyperLogLogTest(unittest.TestCase):
+
+    def assertEstimate(self, estimate, count, tolerance=0.05):
+        self.assertLessEqual(abs(estimate - count), count * tolerance, "estimate %d for %d distinct values" % (estimate, count))
+
+    def test_empty(self):
+        self.assertEqual(HyperLogLog().count(), 0)
+
+    def test_small(self):
+        #sparse sketches are nearly exact
+        self.assertEqual(sketch(addresses(0, 10)).count(), 10)
+        self.assertEqual(sketch(addresses(0, 10) * 3).count(), 10)
+
+    def test_estimate(self):
+        for count in (1000, 20000, 200000):
+            with self.subTest(count=count):
+                self.assertEstimate(sketch(addresses(0, count)).count(), count)
+
+    def test_sparse_to_dense(self):
+        few = sketch(addresses(0, SPARSELIMIT))
+        self.assertIsNone(few.dense)
+        many = sketch(addresses(0, SPARSELIMIT * 4))
+        self.assertIsNotNone(many.dense)
+        registers = sorted(few.registers())
+        few.densify()
+        self.assertEqual(sorted(few.registers()), registers)
+        self.assertEstimate(few.count(), SPARSELIMIT)
+        self.assertEstimate(many.count(), SPARSELIMIT * 4)
+
+    def test_union(self):
+        #overlapping halves: the union counts the shared values once
+        a = sketch(addresses(0, 30000))
+        b = sketch(addresses(20000, 50000))
+        self.assertEstimate(union([a, b]).count(), 50000)
+        self.assertEqual(union([a, b]).dense, sketch(addresses(0, 50000)).dense)
+        self.assertEqual(union([]).count(), 0)
+
+    def test_update_mixed(self):
+        #merging sparse into dense, dense into sparse and sparse into sparse gives the sketch of the union
+        small, large = addresses(0, 20), addresses(1000, 6000)
+        for a, b in ((small, large), (large, small), (small, small[5:] + addresses(50, 60))):
+            with self.subTest(sizes=(len(a), len(b))):
+                merged = sketch(a)
+                merged.update(sketch(b))
+                self.assertEqual(sorted(merged.registers()), sorted(sketch(a + b).registers()))
+
+    def test_precision_mismatch(self):
+        with self.assertRaises(ValueError):
+            HyperLogLog(12).update(HyperLogLog(10))
+
+    def test_encode(self):
+        for values in ([], addresses(0, 10), addresses(0, 5000)):
+            with self.subTest(count=len(values)):
+                original = sketch(values)
+                decoded = HyperLogLog.decode(original.encode())
+                self.assertEqual(decoded.p, original.p)
+                self.assertEqual(decoded.dense, original.dense)
+                self.assertEqual(decoded.sparse, original.sparse)
+                self.assertEqual(decoded.count(), original.count())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+#Journal records are checksummed; a torn or damaged end is ignored by readers and only cut off by the writer
+
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from lamastats.journal import appendrecord, readrecords, journalfile
+from lamastats.lamastats import FlatTracker
+
+
+class JournalTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.dir = tempfile.mkdtemp()
+        os.chdir(self.dir) #trackers keep their state files in the working directory
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.dir)
+
+    def test_records(self):
+        journal = os.path.join(self.dir, 'test.journal')
+        size = appendrecord(journal, {'seq': 1})
+        size += appendrecord(journal, {'seq': 2})
+        self.assertEqual(size, os.path.getsize(journal))
+        self.assertEqual([ record for record, _ in readrecords(journal) ], [{'seq': 1}, {'seq': 2}])
+        self.assertEqual([ offset for _, offset in readrecords(journal) ][-1], size)
+
+    def test_checksum(self):
+        journal = os.path.join(self.dir, 'test.journal')
+        end = appendrecord(journal, {'seq': 1})
+        appendrecord(journal, {'seq': 2})
+        appendrecord(journal, {'seq': 3})
+        with open(journal,'r+b') as f:
+            f.seek(end + 12)
+            f.write(b'9') #damage the payload of the second record
+        #reading stops at the damaged record, also the intact records after it are not trusted
+        self.assertEqual([ record['seq'] for record, _ in readrecords(journal) ], [1])
+
+    def test_torn(self):
+        journal = os.path.join(self.dir, 'test.journal')
+        appendrecord(journal, {'seq': 1})
+        with open(journal,'ab') as f:
+            f.write(b'0123abcd {"seq":') #a record that is still being written, or was interrupted
+        self.assertEqual([ record['seq'] for record, _ in readrecords(journal) ], [1])
+
+    @mock.patch('lamastats.journal.COMPACTRATIO', 1000) #the state is tiny, keep appending to the journal
+    def test_tracker(self):
+        tracker = FlatTracker()
+        tracker.save() #snapshot
+        tracker.data['logregistry']['/var/log/a.log'] = {'offset': 1}
+        tracker.save() #journal record
+        journal = journalfile(tracker.statefile)
+        with open(journal,'ab') as f:
+            f.write(b'0123abcd {"seq":')
+        size = os.path.getsize(journal)
+
+        #loading only reads: the torn end may be a record that another process is still writing
+        reader = FlatTracker()
+        self.assertIn('/var/log/a.log', reader.data['logregistry'])
+        self.assertEqual(os.path.getsize(journal), size)
+
+        #the writer cuts it off before it appends
+        writer = FlatTracker()
+        writer.data['logregistry']['/var/log/b.log'] = {'offset': 2}
+        writer.save()
+        self.assertEqual([ record['seq'] for record, _ in readrecords(journal) ], [1, 2])
+        self.assertEqual(sorted(FlatTracker().data['logregistry']), ['/var/log/a.log', '/var/log/b.log'])
+
+
+if __name__ == '__main__':
+    unittest.main()
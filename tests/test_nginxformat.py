@@ -0,0 +1,90 @@
+#The nginx parser compiled from a log_format, on the default format with the lines real servers write, and on custom formats
+
+import unittest
+
+from lamastats.lamastats import NginxFormat, NGINX_FORMAT
+
+DEFAULT = '1.2.3.4 - - [10/Oct/2023:13:55:36 +0200] "GET /lamabadge.php/frog HTTP/1.1" 200 12 "-" "Mozilla/5.0 (X11; Linux x86_64)" "-"'
+
+class NginxFormatTest(unittest.TestCase):
+
+    def setUp(self):
+        self.format = NginxFormat()
+
+    def test_default(self):
+        for ending in ('', '\n', '\r\n'):
+            with self.subTest(ending=repr(ending)):
+                line = self.format.parse(DEFAULT + ending)
+                self.assertEqual(line['remote_host'], '1.2.3.4')
+                self.assertEqual(line['request_method'], 'GET')
+                self.assertEqual(line['request_url'], '/lamabadge.php/frog')
+                self.assertEqual(line['request_http_ver'], '1.1')
+                self.assertEqual(line['status'], '200')
+                self.assertEqual(line['request_header_user_agent'], 'Mozilla/5.0 (X11; Linux x86_64)')
+                self.assertEqual(line['time_received'], '10/Oct/2023:13:55:36 +0200')
+
+    def test_ipv6(self):
+        for addr in ('2001:db8::1', '::ffff:1.2.3.4'):
+            with self.subTest(addr):
+                self.assertEqual(self.format.parse(DEFAULT.replace('1.2.3.4', addr, 1))['remote_host'], addr)
+
+    def test_http2(self):
+        line = self.format.parse(DEFAULT.replace('HTTP/1.1', 'HTTP/2.0'))
+        self.assertEqual(line['request_http_ver'], '2.0')
+        self.assertEqual(line['request_url'], '/lamabadge.php/frog')
+
+    def test_request(self):
+        line = self.format.parse(DEFAULT.replace('GET /lamabadge.php/frog HTTP/1.1', 'GET /a b HTTP/1.1'))
+        self.assertEqual(line['request_url'], '/a b')
+        line = self.format.parse(DEFAULT.replace('GET /lamabadge.php/frog HTTP/1.1', '\\x16\\x03\\x01'))
+        self.assertEqual((line['request_method'], line['request_url'], line['request_http_ver']), ('', '', None))
+
+    def test_escaped_quotes(self):
+        line = self.format.parse(DEFAULT.replace('"Mozilla/5.0 (X11; Linux x86_64)"', '"Mozilla \\"quoted\\" agent"'))
+        self.assertEqual(line['request_header_user_agent'], 'Mozilla \\"quoted\\" agent')
+        self.assertEqual(line['remote_host'], '1.2.3.4')
+
+    def test_forwarded(self):
+        #the client behind the proxy is the first address of $http_x_forwarded_for, the proxies follow it
+        for forwarded, host in (('-', '1.2.3.4'), ('', '1.2.3.4'), ('5.6.7.8', '5.6.7.8'), ('5.6.7.8, 10.0.0.1, 10.0.0.2', '5.6.7.8')):
+            with self.subTest(forwarded):
+                self.assertEqual(self.format.parse(DEFAULT[:-3] + '"' + forwarded + '"')['remote_host'], host)
+
+    def test_trailing_fields(self):
+        #servers often extend the default format, e.g. with request and upstream times
+        line = self.format.parse(DEFAULT + ' 0.003 "upstream" rt=0.001\n')
+        self.assertEqual(line['remote_host'], '1.2.3.4')
+        self.assertEqual(line['request_header_user_agent'], 'Mozilla/5.0 (X11; Linux x86_64)')
+        self.assertEqual(self.format.parse(DEFAULT.replace('"Mozilla', '"\\"Mozilla') + ' 0.003')['remote_host'], '1.2.3.4')
+        with self.assertRaises(ValueError):
+            self.format.parse(DEFAULT + 'x')
+
+    def test_nomatch(self):
+        for line in ('', 'garbage', DEFAULT[:60], DEFAULT.replace('[10/Oct/2023:13:55:36 +0200]', '[yesterday]')):
+            with self.subTest(line):
+                with self.assertRaises(ValueError):
+                    self.format.parse(line)
+
+    def test_custom(self):
+        format = NginxFormat('$http_x_forwarded_for|$time_local|"$request"')
+        line = format.parse('5.6.7.8|10/Oct/2023:13:55:36 +0200|"GET /x HTTP/1.1"\n')
+        self.assertEqual(line['remote_host'], '5.6.7.8')
+        self.assertEqual(line['request_url'], '/x')
+        self.assertNotIn('request_header_user_agent', line)
+        self.assertIsNone(line.get('request_header_user_agent'))
+        #custom formats are exact
+        with self.assertRaises(ValueError):
+            format.parse('5.6.7.8|10/Oct/2023:13:55:36 +0200|"GET /x HTTP/1.1" 200\n')
+        self.assertEqual(NginxFormat(NGINX_FORMAT, trailing=False).parse(DEFAULT)['remote_host'], '1.2.3.4')
+        with self.assertRaises(ValueError):
+            NginxFormat(NGINX_FORMAT, trailing=False).parse(DEFAULT + ' 0.003')
+
+    def test_invalid_format(self):
+        for format in ('$remote_addr$remote_user [$time_local] "$request"', '$remote_addr "$request"', '$remote_addr [$time_local]', '[$time_local] "$request" $status'):
+            with self.subTest(format):
+                with self.assertRaises(ValueError):
+                    NginxFormat(format)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,41 @@
+#The specialised Apache parser must agree with apache_log_parser on every field, also on unusual lines
+
+import unittest
+
+from lamastats.lamastats import parserdiscrepancies, apache_line_parser, ApacheLine
+
+LINES = {
+    'plain': '1.2.3.4 - - [10/Oct/2023:13:55:36 +0200] "GET /lamabadge.php/frog HTTP/1.1" 200 12 "-" "Mozilla/5.0 (X11; Linux x86_64)"',
+    'escaped quotes': '1.2.3.4 - - [10/Oct/2023:13:55:36 +0200] "GET /x?q=\\"a\\" HTTP/1.1" 200 12 "http://x/\\"r\\"" "Mozilla \\"quoted\\""',
+    'http/2': '1.2.3.4 - - [10/Oct/2023:13:55:36 +0200] "GET /lamabadge.php/frog HTTP/2.0" 200 12 "-" "curl/7.58.0"',
+    'unknown method': '1.2.3.4 - - [10/Oct/2023:13:55:36 +0200] "BREW /pot HTTP/1.1" 418 - "-" "-"',
+    'dash request': '1.2.3.4 - - [10/Oct/2023:13:55:36 +0200] "-" 400 0 "-" "-"',
+    'garbage request': '1.2.3.4 - - [10/Oct/2023:13:55:36 +0200] "\\x16\\x03\\x01\\x00" 400 0 "-" "-"',
+    'trailing fields': '1.2.3.4 - - [10/Oct/2023:13:55:36 +0200] "GET / HTTP/1.1" 200 12 "-" "curl/7.58.0" "extra" 1234',
+    'ipv6': '2001:db8::1 - - [10/Oct/2023:13:55:36 +0200] "GET / HTTP/1.1" 200 12 "-" "curl/7.58.0"',
+    'ipv4 mapped': '::ffff:1.2.3.4 - bob [10/Oct/2023:13:55:36 +0200] "POST /frog/project HTTP/1.0" 201 5 "-" "python-requests/2.19.1"',
+}
+
+class ApacheParserTest(unittest.TestCase):
+
+    def test_equivalence(self):
+        for kind, line in LINES.items():
+            with self.subTest(kind):
+                self.assertIsInstance(apache_line_parser(line), ApacheLine) #handled by the specialised parser, not by its fallback
+                self.assertEqual(list(parserdiscrepancies([line])), [])
+
+    def test_nomatch(self):
+        for line in ('garbage', '', '1.2.3.4 - - [10/Oct/2023:13:55:36 +0200] "GET /'):
+            with self.subTest(line):
+                self.assertEqual(list(parserdiscrepancies([line])), [])
+
+    def test_fields(self):
+        parsed = apache_line_parser(LINES['http/2'])
+        self.assertEqual(parsed['remote_host'], '1.2.3.4')
+        self.assertEqual(parsed['request_method'], 'GET')
+        self.assertEqual(parsed['status'], '200')
+        self.assertEqual(parsed['timestamp'], (20231010135536, '2023-10-10'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,59 @@
+#An unterminated last line is left for later only while its writer may still complete it
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from lamastats.lamastats import FlatTracker, scanlogs
+
+LINES = [ b"2017-03-02 00:0%d:00 - [QUERY ON x] EDIT foo" % i for i in range(3) ]
+
+
+class TailTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.dir = tempfile.mkdtemp()
+        os.chdir(self.dir) #trackers keep their state files in the working directory
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.dir)
+
+    def writelog(self, name):
+        path = os.path.join(self.dir, name)
+        with open(path,'wb') as f:
+            f.write(b"\n".join(LINES)) #no newline after the last line
+        return path
+
+    def scan(self, path, following=False, jobs=1):
+        tracker, = scanlogs([path], [FlatTracker()], jobs, following)
+        return tracker.data['logregistry'][path]['offset'], sum(tracker.data['editsperday'].values())
+
+    def test_live(self):
+        path = self.writelog('flat.log')
+        size = os.path.getsize(path)
+        #the last line may still be being written
+        self.assertEqual(self.scan(path), (size - len(LINES[-1]), 2))
+        #it was not completed since, so it is complete
+        self.assertEqual(self.scan(path), (size, 3))
+
+    def test_rotated(self):
+        #a rotated log does not grow anymore
+        for jobs in (1, 2):
+            with self.subTest(jobs=jobs):
+                if os.path.exists(FlatTracker.statefile):
+                    os.unlink(FlatTracker.statefile)
+                path = self.writelog('flat.log.%d' % jobs)
+                self.assertEqual(self.scan(path, jobs=jobs), (os.path.getsize(path), 3))
+
+    def test_following(self):
+        #follow() picks the line up once it is complete
+        path = self.writelog('flat.log')
+        self.scan(path, following=True)
+        self.assertEqual(self.scan(path, following=True), (os.path.getsize(path) - len(LINES[-1]), 2))
+
+
+if __name__ == '__main__':
+    unittest.main()
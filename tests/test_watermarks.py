@@ -0,0 +1,55 @@
+#State from before the per source watermarks has a single global one, which keeps protecting the sources known then until each has a watermark of its own
+
+import os
+import json
+import shutil
+import tempfile
+import unittest
+
+from lamastats.lamastats import FlatTracker, timestampkey
+
+
+class WatermarkTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.dir = tempfile.mkdtemp()
+        os.chdir(self.dir) #trackers keep their state files in the working directory
+        self.logs = [ os.path.join(self.dir, name) for name in ('a.log', 'b.log') ]
+        for log in self.logs:
+            open(log,'w').close()
+        with open(FlatTracker.statefile,'w') as f:
+            json.dump({ 'latest': "2017-03-02 12:00:00", 'logregistry': { log: {'offset': 0} for log in self.logs } }, f)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.dir)
+
+    def test_legacy(self):
+        old, new = timestampkey("2017-03-01 00:00:00"), timestampkey("2017-03-03 00:00:00")
+        tracker = FlatTracker()
+        self.assertFalse(tracker.checkkey(old, self.logs[0]))
+        self.assertTrue(tracker.checkkey(new, self.logs[0]))
+        tracker.finish()
+
+        #b.log had no lines in that run, the legacy watermark still holds for it in the next
+        tracker = FlatTracker()
+        self.assertEqual(tracker.data['legacywatermark']['sources'], self.logs)
+        self.assertFalse(tracker.checkkey(old, self.logs[1]))
+        self.assertTrue(tracker.checkkey(new, self.logs[1]))
+        tracker.finish()
+
+        #every known source has a watermark of its own now, new sources start from scratch
+        tracker = FlatTracker()
+        self.assertIsNone(tracker.data['legacywatermark'])
+        self.assertFalse(tracker.checkkey(old, self.logs[1]))
+        self.assertTrue(tracker.checkkey(old, os.path.join(self.dir, 'c.log')))
+
+    def test_new(self):
+        tracker = FlatTracker(load=False)
+        self.assertIsNone(tracker.data['legacywatermark'])
+        self.assertEqual(tracker.watermark, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()